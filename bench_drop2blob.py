@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for drop2blob.
+
+Generates a synthetic ~/Dropbox/Camera Uploads/ tree under a temporary home
+dir and times each command against an in-process fake blob container (or a
+real one such as Azurite, given a connection string). Each dataset size runs
+in its own process, so the reported peak RSS isn't inflated by earlier runs.
+Peak RSS only ever grows, so --trace-memory also reports the peak Python
+heap of each phase on its own (at some cost to the timings).
+
+Example usage:\n
+  python bench_drop2blob.py --sizes 100,1000 --save-baseline bench_baseline.json\n
+  python bench_drop2blob.py --sizes 100,1000 --baseline bench_baseline.json
+"""
+
+import click
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+
+# The phases timed for each dataset size, in the order they run
+PHASES = ["init_db", "difflocal", "cp", "upload", "diffblob", "download", "rm-dropbox-files"]
+
+BENCH_YEAR = "2024"
+BENCH_MONTH = "05"
+BENCH_DEVICE = "iPhone14"
+BENCH_CONTAINER = "bench"
+
+
+class FakeItemPaged(object):
+    """Minimal stand-in for azure.core.paging.ItemPaged."""
+    def __init__(self, items, page_size=5000):
+        self.items = items
+        self.page_size = page_size
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self):
+        for start in range(0, len(self.items), self.page_size):
+            yield iter(self.items[start:start + self.page_size])
+
+
+class FakeDownloader(object):
+    def __init__(self, data):
+        self.data = data
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return len(self.data)
+
+    def chunks(self):
+        yield self.data
+
+    def readall(self):
+        return self.data
+
+
+class FakeBlobClient(object):
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        with self.container.lock:
+            self.container.staged.setdefault(self.name, {})[block_id] = bytes(data)
+
+    def get_block_list(self, block_list_type="committed", **kwargs):
+        with self.container.lock:
+            staged = list(self.container.staged.get(self.name, {}))
+        return [], [SimpleNamespace(id=block_id) for block_id in staged]
+
+    def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        with self.container.lock:
+            staged = self.container.staged.pop(self.name)
+        data = b"".join(staged[getattr(b, "id", b)] for b in block_list)
+        self.container.put(self.name, data, content_settings)
+
+    def upload_blob(self, data, overwrite=False, content_settings=None, **kwargs):
+        self.container.upload_blob(self.name, data, overwrite, content_settings)
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        return self.container.download_blob(self.name, offset, length)
+
+    def get_blob_properties(self, **kwargs):
+        with self.container.lock:
+            if self.name not in self.container.properties:
+                raise ResourceNotFoundError("The specified blob does not exist.")
+            return self.container.properties[self.name]
+
+
+class FakeContainerClient(object):
+    """In-process, thread-safe stand-in for a ContainerClient, covering
+    the calls drop2blob makes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.properties = {}
+        self.staged = {}
+
+    def put(self, name, data, content_settings=None):
+        content_md5 = content_settings.content_md5 if content_settings else None
+        with self.lock:
+            self.blobs[name] = data
+            self.properties[name] = SimpleNamespace(
+                name=name,
+                size=len(data),
+                etag='"0x{}"'.format(hashlib.md5(data).hexdigest()[:16]),
+                last_modified=datetime.now(timezone.utc),
+                content_settings=ContentSettings(content_md5=content_md5),
+                metadata={},
+            )
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        with self.lock:
+            names = sorted(n for n in self.blobs if n.startswith(name_starts_with or ""))
+            return FakeItemPaged([self.properties[n] for n in names])
+
+    def upload_blob(self, name, data, overwrite=False, content_settings=None, **kwargs):
+        if not isinstance(data, bytes):
+            data = data.read()
+        self.put(name, data, content_settings)
+
+    def download_blob(self, blob, offset=None, length=None, **kwargs):
+        if blob not in self.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        data = self.blobs[blob]
+        offset = offset or 0
+        end = len(data) if length is None else offset + length
+        return FakeDownloader(data[offset:end])
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self, blob)
+
+
+class FakeBlobServiceClient(object):
+    def __init__(self, container):
+        self.container = container
+
+    def get_container_client(self, container_name):
+        return self.container
+
+    def create_container(self, container_name):
+        return self.container
+
+    def delete_container(self, container_name):
+        pass
+
+
+def generate_camera_uploads(uploads_dir, num_files, video_ratio, photo_kb, video_kb, seed=0):
+    """Write num_files photos/videos for BENCH_YEAR-BENCH_MONTH (plus a few
+    from other months, which the commands should ignore) and return the
+    total bytes written for the benchmarked month.
+    """
+    rng = random.Random(seed)
+    os.makedirs(uploads_dir, exist_ok=True)
+    # One random block shared by all files keeps generation fast; each file
+    # gets a unique header so that files never compare equal.
+    block = os.urandom(64 * 1024)
+    start = datetime(int(BENCH_YEAR), int(BENCH_MONTH), 1)
+    total_bytes = 0
+    for i in range(num_files + num_files // 10):
+        in_month = i < num_files
+        taken = start + timedelta(seconds=i * 37) if in_month else start - timedelta(days=40, seconds=i)
+        if rng.random() < video_ratio:
+            ext, size = rng.choice(["mov", "mp4"]), video_kb * 1024
+        else:
+            ext, size = rng.choice(["jpg", "jpg", "jpg", "heic", "png"]), photo_kb * 1024
+        size = int(size * rng.uniform(0.5, 1.5))
+        name = "{}-{:03d}.{}".format(taken.strftime("%Y-%m-%d %H.%M.%S"), i % 1000, ext)
+        header = "{}\n".format(name).encode()
+        with open(os.path.join(uploads_dir, name), "wb") as f:
+            f.write(header)
+            remaining = size - len(header)
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        if in_month:
+            total_bytes += max(size, len(header))
+    return total_bytes
+
+
+def peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but KiB on Linux
+    if sys.platform == "darwin":
+        return max_rss / 1e6
+    return max_rss * 1024 / 1e6
+
+
+def run_dataset(num_files, video_ratio, photo_kb, video_kb, connection_string, trace_memory=False):
+    """Time each phase for one dataset size in this process and return a
+    list of result dicts.
+    """
+    from click.testing import CliRunner
+    import drop2blob
+
+    home = tempfile.mkdtemp(prefix="drop2blob-bench-")
+    # Downloads are restored under another home dir, so that nothing is
+    # already present locally
+    restore_home = tempfile.mkdtemp(prefix="drop2blob-bench-restore-")
+    os.environ["HOME"] = home
+    uploads_dir = os.path.join(home, "Dropbox", "Camera Uploads")
+    total_bytes = generate_camera_uploads(uploads_dir, num_files, video_ratio, photo_kb, video_kb)
+    if connection_string is None:
+        connection_string = "fake"
+        service = FakeBlobServiceClient(FakeContainerClient())
+        drop2blob.make_blob_service_client = lambda conn_str, **kwargs: service
+    else:
+        service = drop2blob.make_blob_service_client(connection_string)
+    # A fresh container per run, so runs against a real account don't see
+    # each other's blobs
+    container_name = "{}-{}-{}".format(BENCH_CONTAINER, num_files, os.urandom(4).hex())
+    service.create_container(container_name)
+
+    runner = CliRunner()
+
+    def invoke(*args):
+        result = runner.invoke(
+            drop2blob.cli,
+            [
+                "--connection-string", connection_string,
+                "--blob-container-name", container_name,
+                "--year", BENCH_YEAR,
+                "--month", BENCH_MONTH,
+                "--device", BENCH_DEVICE,
+            ] + list(args),
+            input="y\n",
+        )
+        if result.exit_code != 0:
+            raise RuntimeError("'{}' failed:\n{}".format(" ".join(args), result.output))
+
+    def init_db():
+        backup_context = drop2blob.BackupContext(
+            connection_string, container_name, BENCH_YEAR, BENCH_MONTH, BENCH_DEVICE
+        )
+        backup_context.load_sources("dropbox", "workdir", "blob")
+
+    def download():
+        os.environ["HOME"] = restore_home
+        try:
+            invoke("download", "--dryrun", "false")
+        finally:
+            os.environ["HOME"] = home
+
+    phases = {
+        "init_db": init_db,
+        "difflocal": lambda: invoke("difflocal"),
+        "cp": lambda: invoke("cp", "--dryrun", "false"),
+        "upload": lambda: invoke("upload", "--dryrun", "false"),
+        "diffblob": lambda: invoke("diffblob", "--verify"),
+        "download": download,
+        "rm-dropbox-files": lambda: invoke("rm-dropbox-files", "--dryrun", "false"),
+    }
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        for phase in PHASES:
+            if trace_memory:
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            phases[phase]()
+            elapsed = time.perf_counter() - start
+            results.append({
+                "files": num_files,
+                "phase": phase,
+                "seconds": elapsed,
+                "files_per_sec": num_files / elapsed if elapsed else 0.0,
+                "mb_per_sec": total_bytes / 1e6 / elapsed if elapsed else 0.0,
+                # The high-water mark of this process up to the end of the phase
+                "peak_rss_mb": peak_rss_mb(),
+                # The most the Python heap grew to during this phase alone
+                "peak_alloc_mb": tracemalloc.get_traced_memory()[1] / 1e6 if trace_memory else None,
+            })
+    finally:
+        tracemalloc.stop()
+        service.delete_container(container_name)
+        shutil.rmtree(home)
+        shutil.rmtree(restore_home)
+    return results
+
+
+def print_results(results, baseline=None):
+    fmt = "{:>8}  {:<18}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}"
+    click.echo(fmt.format("Files", "Phase", "Seconds", "Files/s", "MB/s", "RSS MB", "Heap MB", "vs base"))
+    for r in results:
+        base = (baseline or {}).get((r["files"], r["phase"]))
+        ratio = "{:.2f}x".format(r["seconds"] / base["seconds"]) if base and base["seconds"] else ""
+        click.echo(fmt.format(
+            r["files"],
+            r["phase"],
+            "{:.3f}".format(r["seconds"]),
+            "{:.0f}".format(r["files_per_sec"]),
+            "{:.1f}".format(r["mb_per_sec"]),
+            "{:.0f}".format(r["peak_rss_mb"]),
+            "{:.1f}".format(r["peak_alloc_mb"]) if r.get("peak_alloc_mb") is not None else "",
+            ratio,
+        ))
+
+
+@click.command(help=__doc__)
+@click.option("--sizes", default="100,1000", show_default=True, help="Comma-separated dataset sizes (files per month).")
+@click.option("--video-ratio", default=0.1, show_default=True, help="Fraction of files that are videos.")
+@click.option("--photo-kb", default=256, show_default=True, help="Average photo size in KiB.")
+@click.option("--video-kb", default=4096, show_default=True, help="Average video size in KiB.")
+@click.option(
+    "--connection-string",
+    default=None,
+    help="Benchmark against a real account (e.g. Azurite) instead of the in-process fake container.",
+)
+@click.option("--save-baseline", type=click.Path(), default=None, help="Write the results to this JSON file.")
+@click.option("--baseline", type=click.Path(exists=True), default=None, help="Compare against results saved with --save-baseline.")
+@click.option(
+    "--max-regression",
+    default=None,
+    type=float,
+    help="Exit non-zero if any phase is more than this many times slower than the baseline.",
+)
+@click.option(
+    "--trace-memory",
+    is_flag=True,
+    help="Also report each phase's peak Python heap, which slows the phases down.",
+)
+@click.option("--single-run", is_flag=True, hidden=True, help="Run one dataset size in this process and print JSON.")
+def main(sizes, video_ratio, photo_kb, video_kb, connection_string, save_baseline, baseline, max_regression,
+         trace_memory, single_run):
+    sizes = [int(size) for size in sizes.split(",")]
+    if single_run:
+        click.echo(json.dumps(run_dataset(sizes[0], video_ratio, photo_kb, video_kb, connection_string, trace_memory)))
+        return
+
+    results = []
+    for size in sizes:
+        args = [
+            sys.executable, os.path.abspath(__file__), "--single-run",
+            "--sizes", str(size),
+            "--video-ratio", str(video_ratio),
+            "--photo-kb", str(photo_kb),
+            "--video-kb", str(video_kb),
+        ]
+        if connection_string:
+            args += ["--connection-string", connection_string]
+        if trace_memory:
+            args.append("--trace-memory")
+        output = subprocess.run(args, check=True, stdout=subprocess.PIPE).stdout
+        results.extend(json.loads(output.decode().splitlines()[-1]))
+
+    baseline_results = None
+    if baseline:
+        with open(baseline) as f:
+            baseline_results = {(r["files"], r["phase"]): r for r in json.load(f)}
+    print_results(results, baseline_results)
+
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline_results and max_regression:
+        regressed = [
+            r for r in results
+            if (r["files"], r["phase"]) in baseline_results
+            and r["seconds"] > max_regression * baseline_results[(r["files"], r["phase"])]["seconds"]
+        ]
+        for r in regressed:
+            click.echo("Regression: {} files, {}".format(r["files"], r["phase"]))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,1097 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import click
-import filecmp
+import collections
+import contextlib
+import cProfile
+import csv
+import hashlib
+import io
+import itertools
+import json
 import os
-import pandas as pd
 import pathlib
+import posixpath
+import pstats
+import random
+import re
+import select
+import shutil
 import sqlite3
+import struct
 import sys
-from azure.storage.blob import BlobServiceClient
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import wait as wait_futures
 from datetime import datetime
 from os.path import expanduser
 from pathlib import Path
-from shutil import copy2
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; copies fall back to copy_file_range/read+write
+    fcntl = None
+
+
+# A matched photo/video, with the stat info collected while scanning
+ScannedFile = collections.namedtuple("ScannedFile", ["path", "size", "mtime_ns"])
+
+# One step of a sync plan: kind is "copy" (Dropbox to workdir), "upload"
+# (workdir to blob), "verify" (workdir MD5 against blob Content-MD5) or
+# "delete" (a backed-up Dropbox file); src and dest are paths or blob names.
+PlannedAction = collections.namedtuple("PlannedAction", ["kind", "file_name", "src", "dest"])
+
+# A blob from a cached listing, with the BlobProperties attributes we use
+CachedBlob = collections.namedtuple(
+    "CachedBlob", ["name", "size", "etag", "last_modified", "content_settings"]
+)
+CachedContentSettings = collections.namedtuple("CachedContentSettings", ["content_md5"])
+
+# A file stored inside a pack blob, listed under the blob name it would have
+# had on its own; its data is at `offset` in the pack blob `pack_name`
+PackedBlob = collections.namedtuple(
+    "PackedBlob", ["name", "size", "etag", "last_modified", "content_settings", "pack_name", "offset"]
+)
+
+# Small files can be bundled into uncompressed tar "pack" blobs in a packs/
+# dir under their prefix, each with an index blob of its members
+PACK_DIR_NAME = "packs"
+PACK_INDEX_SUFFIX = ".index.json"
+
+# Packed files separated by less than this are restored with one ranged
+# read, of up to PACK_READ_MAX bytes
+PACK_READ_GAP = 1024 * 1024
+PACK_READ_MAX = 64 * 1024 * 1024
+
+# Blobs are downloaded in ranges of this size, up to --max-concurrency at a
+# time, and only a failed range is fetched again
+DOWNLOAD_RANGE_SIZE = 4 * 1024 * 1024
+
+# Sources are streamed into (and read back from) SQLite this many files at a
+# time, so memory use doesn't grow with the number of files
+SOURCE_BATCH_SIZE = 1000
+
+
+def is_pack_blob_name(blob_name):
+    return (
+        posixpath.basename(posixpath.dirname(blob_name)) == PACK_DIR_NAME
+        and posixpath.basename(blob_name).startswith("pack-")
+    )
+
+
+def get_pack_index_name(pack_name):
+    return posixpath.splitext(pack_name)[0] + PACK_INDEX_SUFFIX
+
+
+def iter_batches(iterable, size):
+    # Yield lists of up to `size` items from iterable
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def prefix_condition(column, prefix):
+    """Return an SQL condition, and its params, matching the values of
+    `column` that start with prefix. It's written as a range, so SQLite can
+    seek to the prefix on an index of the column rather than scan.
+    """
+    # The strings starting with prefix sort before the prefix with its
+    # last character bumped (text is compared in code point order)
+    upper = prefix
+    while upper:
+        code = ord(upper[-1]) + 1
+        if code == 0xD800:
+            # Skip the surrogates, which can't be stored in UTF-8
+            code = 0xE000
+        if code <= sys.maxunicode:
+            upper = upper[:-1] + chr(code)
+            break
+        upper = upper[:-1]
+    if not upper:
+        return "{} >= ?".format(column), (prefix,)
+    return "{0} >= ? AND {0} < ?".format(column), (prefix, upper)
+
+
+def walk_files(root_dir):
+    """Yield an os.DirEntry for every file under root_dir, listing each
+    dir only once.
+    """
+    dir_paths = [str(root_dir)]
+    while dir_paths:
+        try:
+            it = os.scandir(dir_paths.pop())
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+# Read buffer size used when hashing local files
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def md5_file(path):
+    # Module level, so that it can run in a ProcessPoolExecutor
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Read buffer size used when comparing local files byte-for-byte
+COMPARE_BUFFER_SIZE = 1024 * 1024
+
+
+def files_identical(path_a, path_b):
+    # Like filecmp.cmp(shallow=False), but with a larger buffer and no
+    # module-level cache
+    with open(path_a, "rb") as file_a, open(path_b, "rb") as file_b:
+        while True:
+            chunk_a = file_a.read(COMPARE_BUFFER_SIZE)
+            if chunk_a != file_b.read(COMPARE_BUFFER_SIZE):
+                return False
+            if not chunk_a:
+                return True
+
+
+# ioctl request number for cloning a file on CoW filesystems (linux/fs.h)
+FICLONE = 0x40049409
+
+# Buffer size for the read/write fallback of copy_file()
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def copy_file_data(src_file, dest_file):
+    # Try a reflink first, which shares the data blocks on CoW filesystems
+    # (btrfs, XFS) so the copy is nearly free.
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+    # Then let the kernel copy the data without a round trip to userspace
+    if hasattr(os, "copy_file_range"):
+        size = os.fstat(src_file.fileno()).st_size
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(src_file.fileno(), dest_file.fileno(), COPY_BUFFER_SIZE * 64)
+                if not n:
+                    break
+                copied += n
+        except OSError:
+            # E.g. EXDEV on older kernels
+            pass
+        # Some filesystems (e.g. FUSE and network mounts) return 0 without
+        # copying anything; the buffered copy carries on from the current
+        # offsets
+        if copied >= size:
+            return
+    shutil.copyfileobj(src_file, dest_file, COPY_BUFFER_SIZE)
+
+
+def copy_file(src_path, dest_path, hardlink=False):
+    """Copy src_path to dest_path (preserving metadata like copy2), or
+    hardlink it if `hardlink` is set. The data goes to a temp file that is
+    renamed into place, so an interrupted copy never leaves a partial file
+    under the final name.
+    """
+    dest_path = Path(dest_path)
+    tmp_path = dest_path.with_name(".{}.tmp".format(dest_path.name))
+    try:
+        if hardlink:
+            os.link(src_path, tmp_path)
+        else:
+            with open(src_path, "rb") as src_file, open(tmp_path, "wb") as dest_file:
+                copy_file_data(src_file, dest_file)
+                dest_file.flush()
+                src_size = os.fstat(src_file.fileno()).st_size
+                dest_size = os.fstat(dest_file.fileno()).st_size
+                if dest_size != src_size:
+                    raise IOError(
+                        "copy of '{}' is {} bytes rather than {}".format(src_path, dest_size, src_size)
+                    )
+            shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_total_size(paths):
+    # Total size of paths for a progress display; files that can't be
+    # stat'ed count as empty here, and fail in their own transfer
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+class FileChangedError(IOError):
+    # A file to delete changed after it was verified
+    pass
+
+
+def remove_unchanged_file(scanned):
+    """Delete the file of a ScannedFile unless its size or mtime have
+    changed since it was scanned. Returns None on success (or if the file
+    is already gone) and the error otherwise, a FileChangedError if the
+    file was left alone because it changed.
+    """
+    try:
+        stat = os.stat(scanned.path)
+    except FileNotFoundError:
+        return None
+    if (stat.st_size, stat.st_mtime_ns) != (scanned.size, scanned.mtime_ns):
+        return FileChangedError("the file has changed since it was verified")
+    try:
+        os.remove(scanned.path)
+    except OSError as e:
+        return e
+    return None
+
+
+def make_blob_service_client(connection_string, **client_options):
+    # azure.storage.blob is slow to import, and purely local commands never
+    # need it, so it's only imported once a client is actually needed.
+    from azure.storage.blob import BlobServiceClient
+    return BlobServiceClient.from_connection_string(connection_string, **client_options)
+
+
+def timed_call(fn, *args):
+    # Run fn (e.g. in a worker thread) and return (seconds, result), so that
+    # per-file latencies can be recorded
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+# HTTP statuses and storage error codes that mean the service is throttling
+# us or failed transiently, so the request is worth retrying after a pause
+RETRYABLE_STATUS_CODES = {408, 429, 500, 503}
+RETRYABLE_ERROR_CODES = {"ServerBusy", "OperationTimedOut", "InternalError"}
+
+
+def is_retryable_error(e):
+    from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+    # Connection failures and timeouts, raised before a response arrives
+    if isinstance(e, (ServiceRequestError, ServiceResponseError, TimeoutError, ConnectionError)):
+        return True
+    return (
+        getattr(e, "status_code", None) in RETRYABLE_STATUS_CODES
+        or getattr(e, "error_code", None) in RETRYABLE_ERROR_CODES
+    )
+
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+class Metrics(object):
+    """Wall time per phase (scanning, listing, DB population, comparison,
+    copying, transfers), counters such as list_blobs pages and bytes moved,
+    and per-file transfer latencies for a run, written as a JSON report.
+    """
+    def __init__(self):
+        self.started_at = datetime.now().isoformat()
+        self.start_time = time.perf_counter()
+        self.command = None
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.latencies = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase["seconds"] += time.perf_counter() - start
+            phase["calls"] += 1
+
+    def timed(self, name, iterable):
+        """Yield from iterable, timing only the work of producing each item
+        as phase `name`, and not the caller's work between items.
+        """
+        it = iter(iterable)
+        phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+        phase["calls"] += 1
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                phase["seconds"] += time.perf_counter() - start
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def record_latency(self, kind, seconds):
+        self.latencies[kind].append(seconds)
+
+    def report(self):
+        latencies = {}
+        for kind, values in self.latencies.items():
+            values = sorted(values)
+            latencies[kind] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+        return {
+            "command": self.command,
+            "started_at": self.started_at,
+            "wall_seconds": time.perf_counter() - self.start_time,
+            "phases": self.phases,
+            "counters": dict(self.counters),
+            "latency_seconds": latencies,
+        }
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullMetrics(object):
+    """Stand-in for Metrics when instrumentation is disabled; every call
+    is a no-op.
+    """
+    null_phase = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+    def record_latency(self, kind, seconds):
+        pass
+
+
+class UploadJournal(object):
+    """Local record of the blocks staged for an in-progress block upload,
+    kept next to the file being uploaded.
+
+    The first line identifies the upload (blob name, file size/mtime and
+    block size) and each further line is a staged block ID. A journal for
+    a different version of the file or block size is discarded.
+    """
+    def __init__(self, path, header):
+        self.path = path
+        self.staged_ids = set()
+        self.header_line = json.dumps(header, sort_keys=True)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] == self.header_line:
+                self.staged_ids = set(lines[1:])
+        if not self.staged_ids:
+            self.reset()
+
+    def reset(self):
+        # Start over, e.g. once the service has discarded the staged blocks
+        with open(self.path, "w") as f:
+            f.write(self.header_line + "\n")
+        self.staged_ids = set()
+
+    def record(self, block_id):
+        with open(self.path, "a") as f:
+            f.write(block_id + "\n")
+        self.staged_ids.add(block_id)
+
+    def remove(self):
+        os.remove(self.path)
+
+
+# Number of Dropbox files deleted between updates of the delete manifest
+DELETE_BATCH_SIZE = 100
+
+
+class DeleteManifest(object):
+    """Record of a batch delete of Dropbox files, written before anything
+    is deleted so that the delete can be audited and, if interrupted,
+    resumed.
+
+    The first line is a header, followed by a line for each file to delete
+    (with its size, mtime and verified MD5). After each batch, lines listing
+    the files deleted, the files skipped because they changed and the files
+    that failed to delete are appended, and a finished manifest is kept
+    under a timestamped name.
+    """
+    FILE_NAME = ".rm-dropbox-manifest.jsonl"
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def exists(self):
+        return self.path.exists()
+
+    def create(self, dir_prefix, files):
+        # Never overwrite an unfinished manifest; it's the only record of
+        # what it had still to delete
+        with open(self.path, "x") as f:
+            f.write(json.dumps({"dir_prefix": dir_prefix, "created_at": datetime.now().isoformat()}) + "\n")
+            for file_name, scanned, md5 in files:
+                f.write(json.dumps({
+                    "file": file_name,
+                    "path": scanned.path,
+                    "size": scanned.size,
+                    "mtime_ns": scanned.mtime_ns,
+                    "md5": md5,
+                }) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_pending(self):
+        """Return the (file name, ScannedFile, md5) entries not yet
+        recorded as deleted, skipped or failed.
+        """
+        files = collections.OrderedDict()
+        resolved = set()
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if "deleted" in record:
+                resolved.update(record["deleted"])
+            elif "skipped" in record:
+                resolved.update(record["skipped"])
+            elif "failed" in record:
+                resolved.update(record["failed"])
+            else:
+                files[record["file"]] = (
+                    record["file"],
+                    ScannedFile(record["path"], record["size"], record["mtime_ns"]),
+                    record["md5"],
+                )
+        return [entry for file_name, entry in files.items() if file_name not in resolved]
+
+    def record_deleted(self, file_names):
+        self.append({"deleted": file_names})
+
+    def record_skipped(self, file_names):
+        self.append({"skipped": file_names})
+
+    def record_failed(self, file_names):
+        self.append({"failed": file_names})
+
+    def append(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def complete(self):
+        # Microseconds keep two deletes finished in the same second from
+        # archiving to the same name
+        os.replace(
+            self.path,
+            self.path.with_name(".rm-dropbox-manifest-{}.jsonl".format(datetime.now().strftime("%Y%m%dT%H%M%S%f"))),
+        )
+
+
+class DedupIndex(object):
+    """Content-addressed index of the container: the name of a blob holding
+    each Content-MD5, so that an upload from any month or device can find
+    content that's already stored.
+
+    The index is kept as a JSON sidecar blob, plus a small delta blob for
+    each run that added entries since, so an upload only writes what it
+    added. Deltas are merged on load and folded back into the main blob
+    once there are COMPACT_DELTAS of them. Entries can go stale when blobs
+    are deleted, so callers check the blob before relying on it.
+    """
+    BLOB_NAME = ".drop2blob/content-md5-index.json"
+    DELTA_PREFIX = ".drop2blob/content-md5-index.d/"
+    COMPACT_DELTAS = 64
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self.blob_client = container_client.get_blob_client(self.BLOB_NAME)
+        self.blob_names = {}
+        # Entries not yet saved
+        self.added = {}
+        self.etag = None
+        # Whether the index blob exists, once exists() or load() has looked
+        self.found = None
+        # Names of the delta blobs merged by load()
+        self.delta_names = []
+
+    def exists(self):
+        """Is there an index yet? Only the main blob's properties are read."""
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            self.blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            self.found = False
+        else:
+            self.found = True
+        return self.found
+
+    def load(self):
+        """Load the index blob and its deltas, returning False if there
+        isn't an index yet.
+        """
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            downloader = self.blob_client.download_blob()
+        except ResourceNotFoundError:
+            self.found = False
+            return False
+        self.found = True
+        self.blob_names = json.loads(downloader.readall())
+        self.etag = downloader.properties.etag
+        self.delta_names = []
+        for blob in self.container_client.list_blobs(name_starts_with=self.DELTA_PREFIX):
+            try:
+                data = self.container_client.download_blob(blob.name).readall()
+            except ResourceNotFoundError:
+                # Folded into the main blob since it was listed
+                continue
+            for md5, blob_name in json.loads(data).items():
+                self.blob_names.setdefault(md5, blob_name)
+            self.delta_names.append(blob.name)
+        self.blob_names.update(self.added)
+        return True
+
+    def rebuild(self, blobs):
+        for blob in blobs:
+            content_md5 = blob.content_settings.content_md5
+            if content_md5:
+                self.add(bytes(content_md5).hex(), blob.name)
+
+    def find(self, md5):
+        return self.blob_names.get(md5)
+
+    def add(self, md5, blob_name):
+        if md5 not in self.blob_names:
+            self.blob_names[md5] = blob_name
+            self.added[md5] = blob_name
+
+    def save(self):
+        """Write the entries added since loading: the whole index if there
+        is no index blob yet (i.e. after a rebuild), and otherwise just a
+        delta blob of them.
+        """
+        from azure.core.exceptions import ResourceExistsError
+        if not self.added:
+            return
+        if not self.found:
+            data = json.dumps(self.blob_names, sort_keys=True).encode()
+            try:
+                self.etag = self.blob_client.upload_blob(data, overwrite=False)["etag"]
+                self.found = True
+                self.added = {}
+                return
+            except ResourceExistsError:
+                # Another run built the index first; add ours to it
+                self.found = True
+        delta_name = "{}{}-{}.json".format(
+            self.DELTA_PREFIX, datetime.now().strftime("%Y%m%dT%H%M%S"), os.urandom(4).hex()
+        )
+        data = json.dumps(self.added, sort_keys=True).encode()
+        self.container_client.upload_blob(delta_name, data, overwrite=False)
+        self.added = {}
+
+    def compact(self):
+        """Fold the deltas merged by load() into the index blob once there
+        are COMPACT_DELTAS of them, then delete them. Deltas written since
+        the load are left for the next compaction.
+        """
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+        if len(self.delta_names) < self.COMPACT_DELTAS:
+            return
+        saved = {md5: blob_name for md5, blob_name in self.blob_names.items() if md5 not in self.added}
+        data = json.dumps(saved, sort_keys=True).encode()
+        try:
+            result = self.blob_client.upload_blob(
+                data, overwrite=True, etag=self.etag, match_condition=MatchConditions.IfNotModified
+            )
+        except ResourceModifiedError:
+            # Another run compacted the index since we loaded it
+            return
+        self.etag = result["etag"]
+        for delta_name in self.delta_names:
+            try:
+                self.container_client.delete_blob(delta_name)
+            except ResourceNotFoundError:
+                pass
+        self.delta_names = []
+
+
+# inotify event masks (sys/inotify.h)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+
+class DirectoryWatcher(object):
+    """Blocks until files under root_dir may have changed, and says which.
+
+    On Linux this waits on inotify watches for root_dir and its subdirs,
+    and returns the paths of files that were written or moved in;
+    elsewhere (or if inotify can't be set up) it just sleeps for the
+    timeout, leaving it to the caller's rescans to spot changes.
+    """
+    def __init__(self, root_dir):
+        self.fd = None
+        self.watched_dirs = {}
+        if not sys.platform.startswith("linux"):
+            return
+        # Only needed for watch mode, so imported here
+        import ctypes
+        import ctypes.util
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self.fd = fd
+        for dir_path, _, _ in os.walk(str(root_dir)):
+            self.add_watch(dir_path)
+
+    def add_watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(dir_path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        )
+        if wd >= 0:
+            self.watched_dirs[wd] = dir_path
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return a list of the paths of
+        files written or moved in since the last call, or None if the whole
+        tree needs rescanning (without inotify, or if events were lost).
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return None
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        # Each event is a struct inotify_event followed by its name
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + name_len].rstrip(b"\0")
+            offset += 16 + name_len
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watched_dirs:
+                continue
+            path = os.path.join(self.watched_dirs[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # Files may have landed in a new dir before it was watched
+                self.add_watch(path)
+                for dir_path, subdirs, _ in os.walk(path):
+                    for subdir in subdirs:
+                        self.add_watch(os.path.join(dir_path, subdir))
+                paths.extend(entry.path for entry in walk_files(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PendingFiles(object):
+    """New files waiting for Dropbox to finish writing them.
+
+    A file is ready once its size and mtime have held steady for
+    `settle_seconds` (and it isn't empty), and each path is only handed
+    out once unless it's forgotten again.
+    """
+    def __init__(self, settle_seconds, seen_paths=()):
+        self.settle_seconds = settle_seconds
+        self.seen_paths = set(seen_paths)
+        # Path -> (ScannedFile, time it was first seen with that size/mtime)
+        self.pending = {}
+
+    def update(self, paths, now):
+        """Take the paths of new or changed files, check them along with
+        the files already pending, and return the ScannedFiles that have
+        become ready, sorted by path.
+        """
+        current = {}
+        for path in set(paths) | set(self.pending):
+            if path in self.seen_paths:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            scanned = ScannedFile(path, stat.st_size, stat.st_mtime_ns)
+            previous = self.pending.get(path)
+            if previous is not None and previous[0] == scanned:
+                current[path] = previous
+            else:
+                current[path] = (scanned, now)
+        # Files that disappeared before settling are dropped
+        self.pending = current
+        ready = sorted(
+            scanned
+            for scanned, since in current.values()
+            if scanned.size > 0 and now - since >= self.settle_seconds
+        )
+        for scanned in ready:
+            del self.pending[scanned.path]
+            self.seen_paths.add(scanned.path)
+        return ready
+
+    def forget(self, path):
+        # Let a file be picked up again once it has settled, e.g. after a
+        # failed backup
+        self.seen_paths.discard(path)
+        self.pending[path] = (None, None)
+
+
+class Catalog(object):
+    """Durable record of the files seen in each location ("dropbox",
+    "workdir" or "blob") along with their size, mtime, ETag, last-modified
+    time and hash.
+
+    Local trees are rescanned incrementally: adding, removing or renaming a
+    file always bumps its parent dir's mtime, so a dir whose mtime hasn't
+    changed since the last scan is not listed again. (Files rewritten in
+    place aren't noticed until their dir changes.)
+    """
+    def __init__(self, db):
+        self.db = db
+        with self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                Location TEXT NOT NULL,
+                Path TEXT NOT NULL,
+                Dir TEXT NOT NULL,
+                Filename TEXT NOT NULL,
+                Size INTEGER,
+                MtimeNs INTEGER,
+                ETag TEXT,
+                LastModified TEXT,
+                Hash TEXT,
+                PRIMARY KEY (Location, Path))"""
+            )
+            # Rescans and tree lookups select entries by dir
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_by_dir ON entries (Location, Dir)"
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS dirs (
+                Location TEXT NOT NULL,
+                Path TEXT NOT NULL,
+                Parent TEXT,
+                MtimeNs INTEGER,
+                PRIMARY KEY (Location, Path))"""
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (Location, Parent)"
+            )
+            # When each blob prefix was last listed in full
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS listings (
+                Prefix TEXT PRIMARY KEY,
+                ListedAt REAL NOT NULL)"""
+            )
+            # Dropbox/workdir file pairs last found to be identical, along
+            # with the (size, mtime, inode) of both files at the time
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS verified_pairs (
+                DropboxPath TEXT NOT NULL,
+                WorkdirPath TEXT NOT NULL,
+                StatKey TEXT NOT NULL,
+                PRIMARY KEY (DropboxPath, WorkdirPath))"""
+            )
+
+    def scan_tree(self, location, root_dir):
+        root_dir = str(root_dir)
+        with self.db:
+            if os.path.isdir(root_dir):
+                self.scan_dir(location, root_dir, None)
+            else:
+                self.forget_tree(location, root_dir)
+
+    def scan_dir(self, location, dir_path, parent):
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            # Removed since its parent was listed, or since it was cached
+            # as a subdir of an unchanged parent
+            self.forget_tree(location, dir_path)
+            return
+        row = self.db.execute(
+            "SELECT MtimeNs FROM dirs WHERE Location = ? AND Path = ?",
+            (location, dir_path),
+        ).fetchone()
+        cached_subdirs = [
+            r[0]
+            for r in self.db.execute(
+                "SELECT Path FROM dirs WHERE Location = ? AND Parent = ?",
+                (location, dir_path),
+            )
+        ]
+        if row is not None and row[0] == mtime_ns:
+            subdirs = cached_subdirs
+        else:
+            subdirs = []
+            files = []
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files.append(
+                            (location, entry.path, dir_path, entry.name, stat.st_size, stat.st_mtime_ns)
+                        )
+            # Keep the hash of files whose size and mtime are unchanged
+            self.db.executemany(
+                """
+                INSERT INTO entries (Location, Path, Dir, Filename, Size, MtimeNs)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (Location, Path)
+                DO UPDATE SET
+                    Hash = CASE WHEN Size = excluded.Size AND MtimeNs = excluded.MtimeNs
+                        THEN Hash ELSE NULL END,
+                    Size = excluded.Size,
+                    MtimeNs = excluded.MtimeNs""",
+                files,
+            )
+            current_paths = set(f[1] for f in files)
+            removed_paths = [
+                (location, r[0])
+                for r in self.db.execute(
+                    "SELECT Path FROM entries WHERE Location = ? AND Dir = ?",
+                    (location, dir_path),
+                )
+                if r[0] not in current_paths
+            ]
+            self.db.executemany(
+                "DELETE FROM entries WHERE Location = ? AND Path = ?", removed_paths
+            )
+            for removed_dir in set(cached_subdirs) - set(subdirs):
+                self.forget_tree(location, removed_dir)
+            self.db.execute(
+                """
+                INSERT INTO dirs (Location, Path, Parent, MtimeNs) VALUES (?, ?, ?, ?)
+                ON CONFLICT (Location, Path)
+                DO UPDATE SET Parent = excluded.Parent, MtimeNs = excluded.MtimeNs""",
+                (location, dir_path, parent, mtime_ns),
+            )
+        for subdir in subdirs:
+            self.scan_dir(location, subdir, dir_path)
+
+    def forget_tree(self, location, dir_path):
+        # Everything in the tree has a path under dir_path + os.sep, so
+        # these seek on the primary keys (an OR with dir_path wouldn't)
+        under_dir, params = prefix_condition("Path", dir_path + os.sep)
+        self.db.execute(
+            "DELETE FROM dirs WHERE Location = ? AND Path = ?", (location, dir_path)
+        )
+        self.db.execute(
+            "DELETE FROM dirs WHERE Location = ? AND {}".format(under_dir), (location,) + params
+        )
+        self.db.execute(
+            "DELETE FROM entries WHERE Location = ? AND {}".format(under_dir), (location,) + params
+        )
+
+    def get_tree_entries(self, location, root_dir):
+        # Returns a cursor, so the rows are read as they're used
+        under_dir, params = prefix_condition("Path", str(root_dir) + os.sep)
+        return self.db.execute(
+            """SELECT * FROM entries
+            WHERE Location = ? AND {}
+            ORDER BY Path""".format(under_dir),
+            (location,) + params,
+        )
+
+    def refresh_blobs(self, prefix, pages):
+        """Apply a listing of the blobs under prefix, given a page at a
+        time, to the catalog, yielding each page once it's written. Only
+        rows for new or changed blobs are written, and blobs that are no
+        longer listed are deleted once the listing is complete.
+        """
+        # The names listed so far are kept in SQLite rather than in memory
+        self.db.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS listed_blobs (Path TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+        with self.db:
+            self.db.execute("DELETE FROM listed_blobs")
+        for page in pages:
+            with self.db:
+                self.db.executemany(
+                    """
+                    INSERT INTO entries
+                    (Location, Path, Dir, Filename, Size, ETag, LastModified, Hash)
+                    VALUES ('blob', ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (Location, Path)
+                    DO UPDATE SET
+                        Size = excluded.Size,
+                        ETag = excluded.ETag,
+                        LastModified = excluded.LastModified,
+                        Hash = excluded.Hash
+                    WHERE ETag IS NOT excluded.ETag""",
+                    (
+                        (
+                            blob.name,
+                            posixpath.dirname(blob.name),
+                            posixpath.basename(blob.name),
+                            blob.size,
+                            blob.etag,
+                            blob.last_modified.isoformat() if blob.last_modified else None,
+                            bytes(blob.content_settings.content_md5).hex()
+                            if blob.content_settings.content_md5 else None,
+                        )
+                        for blob in page
+                    ),
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO listed_blobs (Path) VALUES (?)",
+                    ((blob.name,) for blob in page),
+                )
+            yield page
+        under_prefix, params = prefix_condition("Path", prefix)
+        with self.db:
+            # Whatever wasn't listed isn't in the container anymore
+            self.db.execute(
+                """DELETE FROM entries
+                WHERE Location = 'blob' AND {}
+                AND Path NOT IN (SELECT Path FROM listed_blobs)""".format(under_prefix),
+                params,
+            )
+            self.db.execute("DELETE FROM listed_blobs")
+            self.db.execute(
+                "INSERT OR REPLACE INTO listings (Prefix, ListedAt) VALUES (?, ?)",
+                (prefix, time.time()),
+            )
+
+    def get_listing_age(self, prefix):
+        # Seconds since prefix (or a prefix containing it) was last listed,
+        # or None if it never was
+        row = self.db.execute(
+            "SELECT MAX(ListedAt) FROM listings WHERE substr(?, 1, length(Prefix)) = Prefix",
+            (prefix,),
+        ).fetchone()
+        return time.time() - row[0] if row[0] is not None else None
+
+    def iter_blobs(self, prefix):
+        # Yield a CachedBlob for each blob under prefix, in name order
+        under_prefix, params = prefix_condition("Path", prefix)
+        for row in self.db.execute(
+            """SELECT * FROM entries
+            WHERE Location = 'blob' AND {}
+            ORDER BY Path""".format(under_prefix),
+            params,
+        ):
+            yield CachedBlob(
+                row["Path"],
+                row["Size"],
+                row["ETag"],
+                datetime.fromisoformat(row["LastModified"]) if row["LastModified"] else None,
+                CachedContentSettings(bytes.fromhex(row["Hash"]) if row["Hash"] else None),
+            )
+
+    def record_blob(self, blob_name, size, md5):
+        # The ETag is filled in by the next listing of the blob's prefix
+        with self.db:
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO entries (Location, Path, Dir, Filename, Size, Hash)
+                VALUES ('blob', ?, ?, ?, ?, ?)""",
+                (blob_name, posixpath.dirname(blob_name), posixpath.basename(blob_name), size, md5),
+            )
+
+    def is_verified_pair(self, dropbox_path, workdir_path, stat_key):
+        row = self.db.execute(
+            "SELECT StatKey FROM verified_pairs WHERE DropboxPath = ? AND WorkdirPath = ?",
+            (dropbox_path, workdir_path),
+        ).fetchone()
+        return row is not None and row[0] == stat_key
+
+    def set_verified_pairs(self, pairs):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO verified_pairs (DropboxPath, WorkdirPath, StatKey) VALUES (?, ?, ?)",
+                pairs,
+            )
+
+    def get_local_hash(self, location, scanned):
+        row = self.db.execute(
+            "SELECT Hash FROM entries WHERE Location = ? AND Path = ? AND Size = ? AND MtimeNs = ?",
+            (location, scanned.path, scanned.size, scanned.mtime_ns),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_local_hashes(self, location, hashes):
+        # Only cache hashes for files that haven't changed since the scan
+        with self.db:
+            self.db.executemany(
+                """
+                UPDATE entries SET Hash = ?
+                WHERE Location = ? AND Path = ? AND Size = ? AND MtimeNs = ?""",
+                [
+                    (md5, location, scanned.path, scanned.size, scanned.mtime_ns)
+                    for scanned, md5 in hashes.items()
+                ],
+            )
 
 
 class BackupContext(object):
-    def __init__(self, connection_string, blob_container_name, year, month, device):
-        self.db = sqlite3.connect(":memory:")
-        self.db.row_factory = sqlite3.Row
-        self.dbcursor = self.db.cursor()
+    def __init__(self, connection_string, blob_container_name, year, month, device, catalog=False, metrics=None):
+        self.metrics = metrics or NullMetrics()
         self.connection_string = connection_string
-        self.blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
         self.blob_container_name = blob_container_name
-        # Get a client to interact with the container
-        self.container_client = self.blob_service_client.get_container_client(self.blob_container_name)
+        # Blob clients are created on first use; see container_client
+        self._blob_service_client = None
+        self._container_client = None
         self.homedir = expanduser("~")
         self.year = year
         self.month = month
@@ -44,100 +1112,1584 @@ class BackupContext(object):
                 local_blob_dir=self.local_blob_dir, dir_prefix=self.dir_prefix
             )
         )
-        # The file extensions that we'll operate on
-        self.supported_file_extensions = ["jpg", "png", "mov", "3gp", "heic", "mp4"]
+        # The file extensions that we'll operate on, matched case-insensitively
+        self.supported_file_extensions = {"jpg", "png", "mov", "3gp", "heic", "mp4"}
         self.video_file_extensions = [".mov", ".3gp", ".mp4"]
+        if catalog:
+            # A persistent catalog lets repeat runs skip unchanged dirs
+            os.makedirs(self.local_blob_dir, exist_ok=True)
+            self.db = sqlite3.connect(str(self.local_blob_dir / ".drop2blob-catalog.sqlite3"))
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+        else:
+            self.db = sqlite3.connect(":memory:")
+        self.db.row_factory = sqlite3.Row
+        self.dbcursor = self.db.cursor()
+        self.catalog = Catalog(self.db) if catalog else None
+        # Read-only commands may accept a cached blob listing up to this
+        # many seconds old; see use_cached_listing()
+        self.max_listing_age = None
+        # Content-MD5 -> name of each blob uploaded by this run, not yet
+        # added to the dedup index; see update_dedup_index()
+        self.new_blob_md5s = {}
+        # Loaders for each file source; sources are only walked/listed the
+        # first time a command asks for them via load_sources().
+        self.source_loaders = {
+            "dropbox": self.load_dropbox_source,
+            "workdir": self.load_workdir_source,
+            "blob": self.load_blob_source,
+        }
 
         self.init_db()
 
-    def get_glob_pattern(self, file_ext):
+    @property
+    def blob_service_client(self):
+        if self._blob_service_client is None:
+            self._blob_service_client = make_blob_service_client(self.connection_string)
+        return self._blob_service_client
+
+    @property
+    def container_client(self):
+        # Get a client to interact with the container
+        if self._container_client is None:
+            self._container_client = self.blob_service_client.get_container_client(
+                self.blob_container_name
+            )
+        return self._container_client
+
+    def match_filename(self, file_name):
+        # Is this a photo/video from the given year/month or device?
+        file_ext = os.path.splitext(file_name)[1][1:].lower()
+        if file_ext not in self.supported_file_extensions:
+            return False
         if self.device == "NikonCoolpix":
-            pattern = "**/*DSCN*.{}".format(file_ext.upper())
-        else:
-            pattern = "**/{}-{}-*.{}".format(self.year, self.month, file_ext)
-        return pattern
+            return "DSCN" in file_name
+        return file_name.startswith("{}-{}-".format(self.year, self.month))
 
     def init_db(self):
-        # Walk Dropbox and working dir paths and find all files matching
-        # the given year/month.
-        # TODO - if we're asked to 'lsdropbox' then there's no need to glob
-        # other dir contents.
-        self.dropbox_filenames = []
-        self.working_dir_filenames = []
-        for file_ext in self.supported_file_extensions:
-            pattern = self.get_glob_pattern(file_ext)
-            dropbox_glob = self.dropbox_camera_uploads_dir.glob(pattern)
-            self.dropbox_filenames.extend([x.name for x in sorted(dropbox_glob)])
-            workdir_glob = self.local_working_dir.glob(pattern)
-            self.working_dir_filenames.extend([x.name for x in sorted(workdir_glob)])
-        self.blob_container_paths = [
-            blob.name
-            for blob in self.container_client.list_blobs()
-            if Path(blob.name).suffix != ""
-        ]
-        self.blob_container_filenames = [Path(x).name for x in self.blob_container_paths]
-
-        # Populate DB
+        # Create an empty files table. The Dropbox, working dir and blob
+        # sources are populated lazily by load_sources(), so e.g. 'lsdropbox'
+        # or 'mkdir' never list the blob container.
         # TODO - add an IsVideo column so we don't have to check for .mov extension
         # TODO
         # Use dataset instead of raw queries:
         # https://dataset.readthedocs.io/en/latest/
+        self.loaded_sources = set()
+        # MD5s of local files keyed by ScannedFile, i.e. (path, size, mtime)
+        self.hash_cache = {}
+        # (dropbox path, workdir path, stat key) of pairs found identical
+        self.verified_pairs = set()
         self.dbcursor.execute(
             """DROP TABLE IF EXISTS files"""
         )
+        # The files table is rebuilt on every run, even when the catalog
+        # tables are persisted alongside it. Without a rowid the table is
+        # stored in Filename order, which is how the diff commands read it.
         self.dbcursor.execute(
-            """CREATE TABLE files (
+            """CREATE TEMP TABLE files (
             Filename TEXT PRIMARY KEY,
             InDropbox INTEGER DEFAULT 0,
             InWorkingDir INTEGER DEFAULT 0,
-            InBlob INTEGER DEFAULT 0)"""
+            InBlob INTEGER DEFAULT 0) WITHOUT ROWID"""
+        )
+        # Each file found in a source ("dropbox", "workdir" or "blob"): its
+        # path or blob name, the stat info of local files and the
+        # Content-MD5 of blobs. Commands read it back a batch at a time
+        # (see iter_source_rows) rather than holding every name in memory.
+        self.dbcursor.execute(
+            """DROP TABLE IF EXISTS sources"""
         )
-        for file_name in self.dropbox_filenames:
+        self.dbcursor.execute(
+            """CREATE TEMP TABLE sources (
+            Location TEXT NOT NULL,
+            Path TEXT NOT NULL,
+            Filename TEXT NOT NULL,
+            Size INTEGER,
+            MtimeNs INTEGER,
+            Hash TEXT,
+            PRIMARY KEY (Location, Path)) WITHOUT ROWID"""
+        )
+        self.dbcursor.execute(
+            "CREATE INDEX temp.sources_by_filename ON sources (Location, Filename)"
+        )
+
+    def use_cached_listing(self, max_age):
+        """Let the blob source come from the catalog's cached listing if
+        it's at most max_age seconds old.
+        """
+        if max_age is None:
+            return
+        if self.catalog is None:
+            raise click.UsageError("--max-age needs a catalog; pass --catalog as well.")
+        self.max_listing_age = max_age
+
+    def load_sources(self, *sources):
+        """Populate the files table from the given sources ("dropbox",
+        "workdir", "blob"), skipping any that are already loaded.
+        """
+        for source in sources:
+            if source in self.loaded_sources:
+                continue
+            self.source_loaders[source]()
+            self.loaded_sources.add(source)
+
+    def scan_files(self, location, root_dir, match=None):
+        # Walk a dir once and yield a ScannedFile for each file matching
+        # the given year/month (or `match`).
+        match = match or self.match_filename
+
+        def scan():
+            if self.catalog is not None:
+                self.catalog.scan_tree(location, root_dir)
+                for row in self.catalog.get_tree_entries(location, root_dir):
+                    if match(row["Filename"]):
+                        yield ScannedFile(row["Path"], row["Size"], row["MtimeNs"])
+                return
+            for entry in walk_files(root_dir):
+                if match(entry.name):
+                    stat = entry.stat()
+                    yield ScannedFile(entry.path, stat.st_size, stat.st_mtime_ns)
+
+        return self.metrics.timed("scan:" + location, scan())
+
+    def iter_blobs(self, prefix, max_age=None):
+        """Yield the blobs under prefix, in name order, from the catalog's
+        cached listing if it's at most `max_age` seconds old, and otherwise
+        from the container a page at a time (updating the cache as it goes).
+        """
+        if max_age is not None and self.catalog is not None:
+            age = self.catalog.get_listing_age(prefix)
+            if age is not None and age <= max_age:
+                self.metrics.count("cached_listings")
+                yield from self.catalog.iter_blobs(prefix)
+                return
+        # Only list blobs under the given prefix; listing the whole
+        # container takes thousands of pages once it holds years of photos.
+        pages = self.iter_blob_pages(prefix)
+        if self.catalog is not None:
+            pages = self.catalog.refresh_blobs(prefix, pages)
+        for page in self.metrics.timed("list:blob", pages):
+            yield from page
+
+    def iter_blob_pages(self, prefix):
+        for page in self.container_client.list_blobs(name_starts_with=prefix).by_page():
+            self.metrics.count("list_blobs_pages")
+            yield [blob for blob in page if Path(blob.name).suffix != ""]
+
+    def load_dropbox_source(self):
+        self.set_local_source("dropbox", self.scan_files("dropbox", self.dropbox_camera_uploads_dir))
+
+    def load_workdir_source(self):
+        self.set_local_source("workdir", self.scan_files("workdir", self.local_working_dir))
+
+    def load_blob_source(self):
+        self.set_blob_source(self.expand_packs(self.iter_blobs(self.dir_prefix, max_age=self.max_listing_age)))
+
+    def expand_packs(self, blobs):
+        """Yield the blobs of a listing, replacing pack and pack index blobs
+        with a PackedBlob for each packed file. Packs without an index (i.e.
+        whose upload didn't finish) are left out.
+        """
+        # Listings are in name order, so a pack's index comes just before it
+        index_blobs = {}
+        for blob in blobs:
+            if not is_pack_blob_name(blob.name):
+                yield blob
+                continue
+            if blob.name.endswith(PACK_INDEX_SUFFIX):
+                index_blobs[blob.name] = blob
+                continue
+            index_blob = index_blobs.pop(get_pack_index_name(blob.name), None)
+            if index_blob is None:
+                continue
+            for member in self.load_pack_index(index_blob)["members"]:
+                yield PackedBlob(
+                    member["name"],
+                    member["size"],
+                    blob.etag,
+                    blob.last_modified,
+                    CachedContentSettings(bytes.fromhex(member["md5"])),
+                    blob.name,
+                    member["offset"],
+                )
+
+    def load_pack_index(self, index_blob):
+        # Index blobs never change once written, so a local copy (kept where
+        # download would put the blob) is used when there is one.
+        local_path = self.local_blob_dir / index_blob.name
+        if local_path.exists() and local_path.stat().st_size == index_blob.size:
+            data = local_path.read_bytes()
+        else:
+            data = self.container_client.download_blob(index_blob.name, offset=0, length=index_blob.size).readall()
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            local_path.write_bytes(data)
+        return json.loads(data)
+
+    def set_local_source(self, location, scanned):
+        # Stream ScannedFiles into the sources and files tables, keeping
+        # their size/mtime for later steps
+        column = "InDropbox" if location == "dropbox" else "InWorkingDir"
+        for batch in iter_batches(scanned, SOURCE_BATCH_SIZE):
+            self.add_source_files(
+                (location, f.path, os.path.basename(f.path), f.size, f.mtime_ns, None) for f in batch
+            )
             self.do_upsert_true_value_for_column(
-                file_name=file_name, column="InDropbox"
+                file_names=[os.path.basename(f.path) for f in batch], column=column
+            )
+
+    def set_blob_source(self, blobs):
+        # Stream a blob listing into the sources and files tables
+        for batch in iter_batches(blobs, SOURCE_BATCH_SIZE):
+            self.add_source_files(
+                (
+                    "blob",
+                    blob.name,
+                    posixpath.basename(blob.name),
+                    blob.size,
+                    None,
+                    bytes(blob.content_settings.content_md5).hex() if blob.content_settings.content_md5 else None,
+                )
+                for blob in batch
             )
-        for file_name in self.working_dir_filenames:
             self.do_upsert_true_value_for_column(
-                file_name=file_name, column="InWorkingDir"
+                file_names=[posixpath.basename(blob.name) for blob in batch], column="InBlob"
             )
-        for file_name in self.blob_container_filenames:
-            self.do_upsert_true_value_for_column(file_name=file_name, column="InBlob")
 
-    def do_upsert_true_value_for_column(self, file_name, column):
-        #print("Inserting '{}' into column '{}'".format(file_name, column))
-        self.dbcursor.execute(
-            """
-            INSERT INTO files (Filename, {column})
-            VALUES ('{file_name}', 1)
-            ON CONFLICT (Filename)
-            DO UPDATE SET {column} = 1 WHERE Filename = '{file_name}'""".format(
-                file_name=file_name, column=column
-            )
-        )
-        # self.dbcursor.execute("""
-        #    INSERT INTO files (Filename, :column)
-        #    VALUES (:file_name, 1)
-        #    ON CONFLICT (Filename)
-        #    DO UPDATE SET :column=1 WHERE Filename=:file_name""", {"column": column, "file_name": file_name})
-        self.db.commit()
-
-    def do_upsert_true_value_for_in_blob_column(self, file_name, column):
-        #print("Inserting '{}' into column '{}'".format(file_name, column))
-        self.dbcursor.execute(
-            """
-            INSERT INTO files (Filename, InBlob)
-            VALUES (:file_name, 1)
-            ON CONFLICT (Filename)
-            DO UPDATE SET InBlob=1 WHERE Filename=:file_name""",
-            {"file_name": file_name},
+    def add_source_files(self, rows):
+        # (Location, Path, Filename, Size, MtimeNs, Hash) rows
+        with self.db:
+            self.db.executemany(
+                """
+                INSERT OR REPLACE INTO sources (Location, Path, Filename, Size, MtimeNs, Hash)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+
+    def iter_source_rows(self, location):
+        """Yield the sources rows of a location in path order. Rows are
+        read a batch at a time, without holding a cursor open in between,
+        so callers are free to update the DB as they go.
+        """
+        last_path = ""
+        while True:
+            rows = self.db.execute(
+                """SELECT * FROM sources
+                WHERE Location = ? AND Path > ?
+                ORDER BY Path LIMIT ?""",
+                (location, last_path, SOURCE_BATCH_SIZE),
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_path = rows[-1]["Path"]
+
+    def get_source_row(self, location, file_name):
+        # Where a name was found more than once, the last path wins
+        return self.db.execute(
+            """SELECT * FROM sources
+            WHERE Location = ? AND Filename = ?
+            ORDER BY Path DESC LIMIT 1""",
+            (location, file_name),
+        ).fetchone()
+
+    def stat_source_file(self, location, file_name):
+        # A ScannedFile for the current size/mtime of a local source file
+        path = self.get_source_row(location, file_name)["Path"]
+        stat = os.stat(path)
+        return ScannedFile(path, stat.st_size, stat.st_mtime_ns)
+
+    def get_scanned_file(self, location, file_name):
+        # The ScannedFile of a local file, or None if it wasn't found
+        row = self.get_source_row(location, file_name)
+        if row is None:
+            return None
+        return ScannedFile(row["Path"], row["Size"], row["MtimeNs"])
+
+    def share_sources(self, partitions):
+        """Walk Dropbox and list the container once for several
+        BackupContexts (e.g. one per month and device), streaming each of
+        them its own share of the files.
+        """
+        dropbox_files = self.scan_files(
+            "dropbox",
+            self.dropbox_camera_uploads_dir,
+            match=lambda name: any(p.match_filename(name) for p in partitions),
+        )
+        for batch in iter_batches(dropbox_files, SOURCE_BATCH_SIZE):
+            # Each Dropbox file goes to the first partition that matches it,
+            # so it's never backed up under two prefixes
+            files_by_partition = collections.defaultdict(list)
+            for f in batch:
+                name = os.path.basename(f.path)
+                i = next(i for i, p in enumerate(partitions) if p.match_filename(name))
+                files_by_partition[i].append(f)
+            for i, files in files_by_partition.items():
+                partitions[i].set_local_source("dropbox", files)
+        # List the deepest prefix shared by all partitions. The listing is
+        # in name order, so each partition's blobs arrive together and are
+        # found by bisecting the sorted prefixes.
+        prefix = os.path.commonprefix([p.dir_prefix for p in partitions])
+        prefix = prefix[:prefix.rfind("/") + 1]
+        by_prefix = {p.dir_prefix: p for p in partitions}
+        prefixes = sorted(by_prefix)
+
+        def blob_partition(blob):
+            i = bisect.bisect_right(prefixes, blob.name) - 1
+            if i >= 0 and blob.name.startswith(prefixes[i]):
+                return by_prefix[prefixes[i]]
+            return None
+
+        for batch in iter_batches(self.expand_packs(self.iter_blobs(prefix)), SOURCE_BATCH_SIZE):
+            for partition, blobs in itertools.groupby(batch, blob_partition):
+                if partition is not None:
+                    partition.set_blob_source(blobs)
+        for partition in partitions:
+            partition.loaded_sources.update(["dropbox", "blob"])
+
+    def make_partition(self, year, month, device):
+        """Create a BackupContext for another year/month/device that shares
+        this one's settings, metrics and blob client.
+        """
+        partition = BackupContext(
+            self.connection_string,
+            self.blob_container_name,
+            year,
+            month,
+            device,
+            catalog=self.catalog is not None,
+            metrics=self.metrics,
+        )
+        partition._blob_service_client = self.blob_service_client
+        return partition
+
+    # The source properties below are generators reading the sources
+    # table, so use list() where a list is needed.
+
+    @property
+    def dropbox_filenames(self):
+        self.load_sources("dropbox")
+        return (row["Filename"] for row in self.iter_source_rows("dropbox"))
+
+    @property
+    def working_dir_filenames(self):
+        self.load_sources("workdir")
+        return (row["Filename"] for row in self.iter_source_rows("workdir"))
+
+    @property
+    def blob_container_paths(self):
+        self.load_sources("blob")
+        return (row["Path"] for row in self.iter_source_rows("blob"))
+
+    @property
+    def blob_container_filenames(self):
+        self.load_sources("blob")
+        return (row["Filename"] for row in self.iter_source_rows("blob"))
+
+    def get_blob_md5(self, file_name):
+        # Hex Content-MD5 of a blob by filename, or None if it has none
+        self.load_sources("blob")
+        row = self.get_source_row("blob", file_name)
+        return row["Hash"] if row is not None else None
+
+    def get_local_hashes(self, location, file_names, jobs=None):
+        """Return {file_name: md5 hex} for the given scanned local files.
+        Files whose (path, size, mtime) aren't in the hash cache are hashed
+        in a pool of `jobs` processes.
+        """
+        # Stat the files afresh: the catalog doesn't notice files rewritten
+        # in place, and a stale size/mtime would match a stale cached hash
+        return self.hash_scanned_files(
+            location, {file_name: self.stat_source_file(location, file_name) for file_name in file_names}, jobs
         )
-        self.db.commit()
+
+    def hash_scanned_files(self, location, scanned_files, jobs=None):
+        """Return {file_name: md5 hex} for a {file_name: ScannedFile} of
+        freshly stat'ed local files (see get_local_hashes).
+        """
+        hashes = {}
+        to_hash = []
+        for file_name, scanned in scanned_files.items():
+            md5 = self.hash_cache.get(scanned)
+            if md5 is None and self.catalog is not None:
+                md5 = self.catalog.get_local_hash(location, scanned)
+            if md5 is None:
+                to_hash.append((file_name, scanned))
+            else:
+                hashes[file_name] = md5
+        if to_hash:
+            with self.metrics.phase("hash"), ProcessPoolExecutor(max_workers=jobs) as executor:
+                digests = executor.map(md5_file, [scanned.path for _, scanned in to_hash], chunksize=16)
+                new_hashes = {}
+                for (file_name, scanned), md5 in zip(to_hash, digests):
+                    hashes[file_name] = md5
+                    new_hashes[scanned] = md5
+            self.cache_local_hashes(location, new_hashes)
+        return hashes
+
+    def compare_local_files(self, file_names, jobs=8):
+        """Return {file_name: True/False} for whether each file's Dropbox and
+        workdir copies are identical. Sizes are checked first, pairs whose
+        (size, mtime, inode) haven't changed since they were last found
+        identical aren't read again, and the rest are compared in a pool of
+        `jobs` threads.
+        """
+        results = {}
+        to_compare = []
+        for file_name in file_names:
+            dropbox_path = str(self.get_dropbox_file_abspath(file_name))
+            workdir_path = str(self.get_workdir_file_abspath(file_name))
+            dropbox_stat = os.stat(dropbox_path)
+            workdir_stat = os.stat(workdir_path)
+            if dropbox_stat.st_size != workdir_stat.st_size:
+                results[file_name] = False
+                continue
+            stat_key = "{}:{}:{}/{}:{}:{}".format(
+                dropbox_stat.st_size, dropbox_stat.st_mtime_ns, dropbox_stat.st_ino,
+                workdir_stat.st_size, workdir_stat.st_mtime_ns, workdir_stat.st_ino,
+            )
+            pair = (dropbox_path, workdir_path, stat_key)
+            if pair in self.verified_pairs or (
+                self.catalog is not None and self.catalog.is_verified_pair(*pair)
+            ):
+                results[file_name] = True
+                continue
+            to_compare.append((file_name, pair))
+        if to_compare:
+            with self.metrics.phase("compare"), ThreadPoolExecutor(max_workers=jobs) as executor:
+                identical = executor.map(
+                    lambda item: files_identical(item[1][0], item[1][1]), to_compare
+                )
+                new_pairs = []
+                for (file_name, pair), same in zip(to_compare, identical):
+                    results[file_name] = same
+                    if same:
+                        new_pairs.append(pair)
+            self.verified_pairs.update(new_pairs)
+            if self.catalog is not None:
+                self.catalog.set_verified_pairs(new_pairs)
+        return results
+
+    def cache_local_hashes(self, location, hashes):
+        self.hash_cache.update(hashes)
+        if self.catalog is not None:
+            self.catalog.set_local_hashes(location, hashes)
+
+    def do_upsert_true_value_for_column(self, file_names, column):
+        """Set `column` to 1 for all of file_names, inserting rows for new
+        names, in a single transaction.
+        """
+        # Column names can't be bound as parameters, so only allow ours
+        if column not in ("InDropbox", "InWorkingDir", "InBlob"):
+            raise ValueError("Unknown files column '{}'".format(column))
+        with self.metrics.phase("db:" + column), self.db:
+            self.dbcursor.executemany(
+                """
+                INSERT INTO files (Filename, {column})
+                VALUES (?, 1)
+                ON CONFLICT (Filename)
+                DO UPDATE SET {column} = 1""".format(column=column),
+                ((file_name,) for file_name in file_names),
+            )
 
     def get_file_db_row(self, file_name):
         query = "SELECT * FROM files WHERE Filename = ?"
         row = self.dbcursor.execute(query, (file_name,)).fetchone()
         return row
 
+    def is_video_file(self, file_name):
+        return os.path.splitext(file_name)[1].lower() in self.video_file_extensions
+
+    def get_dropbox_file_abspath(self, file_name):
+        # Prefer the path found by the scan, which may be in a subdir
+        scanned = self.get_scanned_file("dropbox", file_name)
+        if scanned is not None:
+            return Path(scanned.path)
+        return self.dropbox_camera_uploads_dir / file_name
+
+    def get_workdir_file_abspath(self, file_name):
+        # Prefer the path found by the scan: workdirs built by older
+        # versions keep some videos (e.g. Nikon .MOV files) in the root
+        scanned = self.get_scanned_file("workdir", file_name)
+        if scanned is not None:
+            return Path(scanned.path)
+        return self.get_new_workdir_file_abspath(file_name)
+
+    def get_new_workdir_file_abspath(self, file_name):
+        # Where a new copy goes: videos are stored in a "video" subdir of
+        # the working dir
+        if self.is_video_file(file_name):
+            return self.local_working_dir / "video" / file_name
+        return self.local_working_dir / file_name
+
+    def get_blob_file_key(self, file_name):
+        if self.is_video_file(file_name):
+            return self.dir_prefix + "video/" + file_name
+        return self.dir_prefix + file_name
+
+    def record_copied_file(self, file_name, dest_path):
+        # Keep the files table in sync after a copy, so that later steps
+        # don't need to rescan the workdir.
+        self.do_upsert_true_value_for_column(file_names=[file_name], column="InWorkingDir")
+        if "workdir" in self.loaded_sources:
+            stat = os.stat(dest_path)
+            self.add_source_files([("workdir", str(dest_path), file_name, stat.st_size, stat.st_mtime_ns, None)])
+
+    def copy_files(self, copies, jobs, hardlink):
+        """Copy (file_name, src_path, dest_path) tuples using a pool of
+        `jobs` threads. Returns a TransferProgress.
+        """
+        if hardlink and (
+            os.stat(self.dropbox_camera_uploads_dir).st_dev != os.stat(self.local_working_dir).st_dev
+        ):
+            click.echo("Dropbox and workdir are on different filesystems; copying instead of hardlinking")
+            hardlink = False
+        progress = TransferProgress(len(copies), get_total_size(src_path for _, src_path, _ in copies))
+
+        def copy(src_path, dest_path):
+            # Stat the file in its task, so one that has gone or can't be
+            # read fails on its own
+            size = os.path.getsize(src_path)
+            copy_file(src_path, dest_path, hardlink)
+            return size
+
+        with self.metrics.phase("copy"), ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(timed_call, copy, src_path, dest_path): (file_name, dest_path)
+                for file_name, src_path, dest_path in copies
+            }
+            for future in as_completed(futures):
+                file_name, dest_path = futures[future]
+                try:
+                    elapsed, size = future.result()
+                except Exception as e:
+                    progress.record(file_name, 0, error=e)
+                    click.echo(
+                        "{} Failed to copy '{}': {}".format(progress.format_status(), file_name, e)
+                    )
+                    continue
+                progress.record(file_name, size)
+                self.metrics.record_latency("copy", elapsed)
+                self.metrics.count("bytes_copied", size)
+                self.record_copied_file(file_name, dest_path)
+                click.echo(
+                    "{} Copied '{}' to {}".format(progress.format_status(), file_name, dest_path)
+                )
+        return progress
+
+    def record_uploaded_blob(self, file_name, blob_file_key, size, md5, packed=False):
+        # Keep the files table in sync after an upload, so that later
+        # steps don't need to re-list the container. The catalog holds the
+        # real blobs, so packed files are recorded there as their pack.
+        self.do_upsert_true_value_for_column(file_names=[file_name], column="InBlob")
+        if self.catalog is not None and not packed:
+            self.catalog.record_blob(blob_file_key, size, md5)
+        if not packed:
+            self.new_blob_md5s.setdefault(md5, blob_file_key)
+        if "blob" in self.loaded_sources:
+            self.add_source_files([("blob", blob_file_key, file_name, size, None, md5)])
+        # The upload read the whole workdir file, so remember its hash too
+        scanned = self.get_scanned_file("workdir", file_name)
+        if scanned is not None and scanned.size == size:
+            self.cache_local_hashes("workdir", {scanned: md5})
+
+    def upload_file(self, container_client, file_path, blob_file_key, max_concurrency, block_size, scheduler):
+        """Upload a file with its Content-MD5 set, reading the file only
+        once, and return the MD5 as hex. Requests go through `scheduler`.
+        """
+        from azure.storage.blob import ContentSettings
+        if os.path.getsize(file_path) > block_size:
+            return self.upload_file_in_blocks(
+                container_client, file_path, blob_file_key, max_concurrency, block_size, scheduler
+            )
+        with open(file=file_path, mode="rb") as f:
+            data = f.read()
+        # Small files go up in a single request with their MD5
+        md5 = hashlib.md5(data).digest()
+        # With the default upload_blob() params large video files almost always
+        # time out - setting connection_timeout to a high value seems to avoid that:
+        # https://stackoverflow.com/a/71000273
+        scheduler.call(
+            container_client.upload_blob,
+            name=blob_file_key,
+            data=data,
+            overwrite=True,
+            content_settings=ContentSettings(content_md5=md5),
+            connection_timeout=60,
+            retry_total=0,
+            num_bytes=len(data),
+        )
+        return md5.hex()
+
+    def upload_file_in_blocks(self, container_client, file_path, blob_file_key, max_concurrency, block_size, scheduler):
+        """Upload a large file as staged blocks, up to `max_concurrency` at
+        a time, then commit the block list with the file's MD5.
+
+        Block IDs are derived from each block's offset and MD5, and staged
+        blocks are recorded in an UploadJournal. When an interrupted upload
+        is retried, blocks that the journal lists and the service still
+        holds as uncommitted aren't sent again.
+        """
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.blob import ContentSettings
+        blob_client = container_client.get_blob_client(blob_file_key)
+        file_path = Path(file_path)
+        stat = os.stat(file_path)
+        journal = UploadJournal(
+            file_path.with_name(".{}.upload-journal".format(file_path.name)),
+            {
+                "blob": blob_file_key,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "block_size": block_size,
+            },
+        )
+        already_staged = set()
+        if journal.staged_ids:
+            try:
+                _, uncommitted = blob_client.get_block_list("uncommitted")
+            except ResourceNotFoundError:
+                # Uncommitted blocks are garbage collected after about a
+                # week, along with the blob if it has never been committed
+                journal.reset()
+                uncommitted = []
+            already_staged = journal.staged_ids & set(block.id for block in uncommitted)
+        md5 = hashlib.md5()
+        block_ids = []
+        in_flight = []
+        with open(file_path, "rb") as f, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            offset = 0
+            for data in iter(lambda: f.read(block_size), b""):
+                md5.update(data)
+                # All block IDs of a blob must have the same length
+                block_id = "{:016x}-{}".format(offset, hashlib.md5(data).hexdigest())
+                block_ids.append(block_id)
+                offset += len(data)
+                if block_id in already_staged:
+                    continue
+                in_flight.append(
+                    (block_id, executor.submit(
+                        scheduler.call,
+                        blob_client.stage_block,
+                        block_id,
+                        data,
+                        length=len(data),
+                        connection_timeout=60,
+                        retry_total=0,
+                        num_bytes=len(data),
+                    ))
+                )
+                # Bound the number of blocks held in memory
+                while len(in_flight) >= max_concurrency:
+                    staged_id, future = in_flight.pop(0)
+                    future.result()
+                    journal.record(staged_id)
+            for staged_id, future in in_flight:
+                future.result()
+                journal.record(staged_id)
+        # The service doesn't compute an MD5 for a committed block list,
+        # so set the one we computed while reading the blocks.
+        scheduler.call(
+            blob_client.commit_block_list,
+            block_ids,
+            content_settings=ContentSettings(content_md5=md5.digest()),
+            connection_timeout=60,
+            retry_total=0,
+        )
+        journal.remove()
+        return md5.hexdigest()
+
+    def upload_files(self, uploads, container_client, jobs, max_concurrency, block_size, scheduler):
+        """Upload (file_name, file_path, blob_file_key) tuples using a pool
+        of `jobs` threads. Video files additionally upload up to
+        `max_concurrency` blocks in parallel, within the request limit of
+        `scheduler`. Returns a TransferProgress.
+        """
+        progress = TransferProgress(len(uploads), get_total_size(path for _, path, _ in uploads))
+
+        def upload(file_path, blob_file_key, blob_concurrency):
+            # Stat the file in its task, so one that has gone or can't be
+            # read fails on its own
+            size = os.path.getsize(file_path)
+            return size, self.upload_file(
+                container_client, file_path, blob_file_key, blob_concurrency, block_size, scheduler
+            )
+
+        with self.metrics.phase("upload"), ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for file_name, file_path, blob_file_key in uploads:
+                blob_concurrency = max_concurrency if self.is_video_file(file_name) else 1
+                future = executor.submit(timed_call, upload, file_path, blob_file_key, blob_concurrency)
+                futures[future] = (file_name, blob_file_key)
+            # The DB connection belongs to this thread, so results are
+            # recorded here as uploads complete rather than in the workers.
+            for future in as_completed(futures):
+                file_name, blob_file_key = futures[future]
+                try:
+                    elapsed, (size, md5) = future.result()
+                except Exception as e:
+                    progress.record(file_name, 0, error=e)
+                    click.echo(
+                        "{} Failed to upload '{}': {}".format(progress.format_status(), file_name, e)
+                    )
+                    continue
+                progress.record(file_name, size)
+                self.metrics.record_latency("upload", elapsed)
+                self.metrics.count("bytes_uploaded", size)
+                self.record_uploaded_blob(file_name, blob_file_key, size, md5)
+                click.echo(
+                    "{} Uploaded '{}' to blob container path '{}'".format(
+                        progress.format_status(), file_name, blob_file_key
+                    )
+                )
+        return progress
+
+    def plan_sync(self, verify=False, delete=False):
+        """Work out, from the files table, the PlannedActions that bring the
+        workdir and blob container up to date with Dropbox: copying
+        Dropbox-only files, uploading files that aren't in the container,
+        and optionally verifying files that were already uploaded and
+        deleting the Dropbox copies of backed-up files.
+        """
+        self.load_sources("dropbox", "workdir", "blob")
+        actions = []
+        for row in self.dbcursor.execute("SELECT * FROM files ORDER BY Filename").fetchall():
+            file_name = row["Filename"]
+            workdir_path = self.get_workdir_file_abspath(file_name)
+            blob_file_key = self.get_blob_file_key(file_name)
+            if row["InDropbox"] and not row["InWorkingDir"]:
+                actions.append(
+                    PlannedAction("copy", file_name, self.get_dropbox_file_abspath(file_name), workdir_path)
+                )
+            if (row["InDropbox"] or row["InWorkingDir"]) and not row["InBlob"]:
+                actions.append(PlannedAction("upload", file_name, workdir_path, blob_file_key))
+            elif row["InWorkingDir"] and row["InBlob"] and verify:
+                actions.append(PlannedAction("verify", file_name, workdir_path, blob_file_key))
+            if row["InDropbox"] and delete:
+                actions.append(
+                    PlannedAction("delete", file_name, self.get_dropbox_file_abspath(file_name), None)
+                )
+        return actions
+
+    def execute_plan(self, actions, jobs, max_concurrency, block_size, scheduler, hardlink=False):
+        """Run the actions of a plan from plan_sync(), returning a
+        TransferProgress per kind of action.
+
+        Copies and uploads are pipelined by execute_transfers(). Verifies and
+        deletes run once the transfers are done. The files table (and
+        catalog) are updated as each action completes, so nothing needs
+        rescanning in between.
+        """
+        progress = self.execute_transfers([(self, actions)], jobs, max_concurrency, block_size, scheduler, hardlink)
+        verifies = [action for action in actions if action.kind == "verify"]
+        deletes = [action for action in actions if action.kind == "delete"]
+        progress["verify"], progress["delete"] = self.verify_and_delete(verifies, deletes, jobs)
+        return progress
+
+    def execute_transfers(self, plans, jobs, max_concurrency, block_size, scheduler, hardlink=False, failed_actions=None):
+        """Run the copies and uploads of the plans of one or more
+        BackupContexts (e.g. batch partitions), given as (context, actions)
+        pairs, returning a TransferProgress for each kind over all of them.
+        The (context, action) of each failed copy or upload is appended to
+        `failed_actions`, if given, since file names needn't be unique
+        across contexts.
+
+        All the plans share the same pools and `scheduler`, and each file's
+        upload starts, in its own pool of `jobs` threads, as soon as its
+        copy is done, while later files are still being copied. Other kinds
+        of action are left to the caller.
+        """
+        copies = []
+        uploads = []
+        for context, actions in plans:
+            copies += [(context, action) for action in actions if action.kind == "copy"]
+            uploads += [(context, action) for action in actions if action.kind == "upload"]
+        copy_srcs = {(context, action.file_name): action.src for context, action in copies}
+        uploads_after_copy = {
+            (context, action.file_name): (context, action)
+            for context, action in uploads
+            if (context, action.file_name) in copy_srcs
+        }
+        # Files to upload once copied aren't in the workdir yet, so their
+        # Dropbox copy is counted
+        upload_srcs = [copy_srcs.get((context, action.file_name), action.src) for context, action in uploads]
+        progress = {
+            "copy": TransferProgress(len(copy_srcs), get_total_size(copy_srcs.values())),
+            "upload": TransferProgress(len(upload_srcs), get_total_size(upload_srcs)),
+        }
+
+        # Files are stat'ed in their tasks, so one that has gone or can't
+        # be read fails on its own
+        def copy(context, action):
+            size = os.path.getsize(action.src)
+            copy_file(action.src, action.dest, hardlink)
+            return size
+
+        def upload(context, action, blob_concurrency):
+            size = os.path.getsize(action.src)
+            return size, context.upload_file(
+                context.container_client, action.src, action.dest, blob_concurrency, block_size, scheduler
+            )
+
+        # Create the clients up front rather than racing to in the workers
+        for context, _ in plans:
+            context.container_client
+        with self.metrics.phase("sync"), ThreadPoolExecutor(max_workers=jobs) as copy_executor, \
+                ThreadPoolExecutor(max_workers=jobs) as upload_executor:
+            futures = {}
+
+            def submit_upload(context, action):
+                blob_concurrency = max_concurrency if context.is_video_file(action.file_name) else 1
+                futures[upload_executor.submit(timed_call, upload, context, action, blob_concurrency)] = (
+                    context, action
+                )
+
+            for context, action in copies:
+                futures[copy_executor.submit(timed_call, copy, context, action)] = (context, action)
+            for context, action in uploads:
+                if (context, action.file_name) not in uploads_after_copy:
+                    submit_upload(context, action)
+            # Results are recorded here, since the DB connections belong to
+            # this thread, and copied files are handed on to the uploaders.
+            while futures:
+                done, _ = wait_futures(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    context, action = futures.pop(future)
+                    file_name = action.file_name
+                    kind_progress = progress[action.kind]
+                    try:
+                        elapsed, result = future.result()
+                    except Exception as e:
+                        kind_progress.record(file_name, 0, error=e)
+                        click.echo(
+                            "{} Failed to {} '{}': {}".format(kind_progress.format_status(), action.kind, file_name, e)
+                        )
+                        if failed_actions is not None:
+                            failed_actions.append((context, action))
+                        if (context, file_name) in uploads_after_copy:
+                            progress["upload"].record(file_name, 0, error=IOError("the copy to workdir failed"))
+                            if failed_actions is not None:
+                                failed_actions.append(uploads_after_copy[(context, file_name)])
+                        continue
+                    self.metrics.record_latency(action.kind, elapsed)
+                    if action.kind == "copy":
+                        kind_progress.record(file_name, result)
+                        self.metrics.count("bytes_copied", result)
+                        context.record_copied_file(file_name, action.dest)
+                        click.echo(
+                            "{} Copied '{}' to {}".format(kind_progress.format_status(), file_name, action.dest)
+                        )
+                        if (context, file_name) in uploads_after_copy:
+                            submit_upload(*uploads_after_copy[(context, file_name)])
+                    else:
+                        size, md5 = result
+                        kind_progress.record(file_name, size)
+                        self.metrics.count("bytes_uploaded", size)
+                        context.record_uploaded_blob(file_name, action.dest, size, md5)
+                        click.echo(
+                            "{} Uploaded '{}' to blob container path '{}'".format(
+                                kind_progress.format_status(), file_name, action.dest
+                            )
+                        )
+        return progress
+
+    def verify_and_delete(self, verifies, deletes, jobs):
+        """Check the workdir MD5 of files against their blob's Content-MD5,
+        and delete Dropbox files whose workdir copy is identical and whose
+        blob checks out, `jobs` at a time. Returns a TransferProgress for
+        each.
+        """
+        verify_progress = TransferProgress(len(verifies), 0)
+        delete_progress = TransferProgress(len(deletes), 0)
+        # Only files that are (now) in both the workdir and the container
+        # can be checked
+        backed_up = set()
+        for action in verifies + deletes:
+            row = self.get_file_db_row(action.file_name)
+            if row["InWorkingDir"] and row["InBlob"]:
+                backed_up.add(action.file_name)
+        hashes = self.get_local_hashes("workdir", sorted(backed_up))
+
+        def check_blob(file_name):
+            # Returns an error describing why the file can't be trusted, or None
+            if file_name not in hashes:
+                return IOError("not in both the workdir and the blob container")
+            blob_md5 = self.get_blob_md5(file_name)
+            if blob_md5 is None:
+                return IOError("blob has no Content-MD5")
+            if blob_md5 != hashes[file_name]:
+                return IOError("checksum of workdir file and blob differ")
+            return None
+
+        with self.metrics.phase("verify"):
+            for action in verifies:
+                error = check_blob(action.file_name)
+                verify_progress.record(action.file_name, 0, error=error)
+                if error is None:
+                    click.echo("Verified '{}' against '{}'".format(action.file_name, action.dest))
+                else:
+                    click.echo("Failed to verify '{}': {}".format(action.file_name, error))
+        if not deletes:
+            return verify_progress, delete_progress
+        verified, problems, unverifiable = self.verify_dropbox_backups(
+            [action.file_name for action in deletes if action.file_name in backed_up]
+        )
+        problems += [(file_name, "its blob has no Content-MD5") for file_name in unverifiable]
+        problems += [
+            (action.file_name, "not in both the workdir and the blob container")
+            for action in deletes
+            if action.file_name not in backed_up
+        ]
+        for file_name, reason in problems:
+            delete_progress.record(file_name, 0, error=IOError(reason))
+            click.echo("Not deleting Dropbox file '{}': {}".format(file_name, reason))
+        if verified:
+            self.delete_dropbox_files(verified, DELETE_BATCH_SIZE, jobs, progress=delete_progress)
+        return verify_progress, delete_progress
+
+    def verify_dropbox_backups(self, file_names, jobs=None):
+        """Hash the Dropbox and workdir copies of file_names in parallel and
+        check both against the blob's Content-MD5. Returns a list of
+        (file name, Dropbox ScannedFile, md5) for the files whose backups
+        check out, a list of (file name, reason) for those that don't, and
+        a list of the names of files whose blob has no Content-MD5 to check
+        against (e.g. block uploads by older versions).
+        """
+        # Stat before hashing, so a file that changes while it's hashed is
+        # left alone when it comes to deleting it
+        dropbox_files = {file_name: self.stat_source_file("dropbox", file_name) for file_name in file_names}
+        dropbox_hashes = self.get_local_hashes("dropbox", file_names, jobs)
+        workdir_hashes = self.get_local_hashes("workdir", file_names, jobs)
+        verified = []
+        problems = []
+        unverifiable = []
+        for file_name in file_names:
+            blob_md5 = self.get_blob_md5(file_name)
+            if blob_md5 is None:
+                unverifiable.append(file_name)
+            elif dropbox_hashes[file_name] != workdir_hashes[file_name]:
+                problems.append((file_name, "the Dropbox file and its workdir copy differ"))
+            elif workdir_hashes[file_name] != blob_md5:
+                problems.append((file_name, "the workdir copy and the blob differ"))
+            else:
+                verified.append((file_name, dropbox_files[file_name], blob_md5))
+        return verified, problems, unverifiable
+
+    def delete_dropbox_files(self, files, batch_size, jobs, progress=None):
+        """Delete verified Dropbox files, given as (file name, ScannedFile,
+        md5), after listing them in a DeleteManifest. An unfinished manifest
+        left by an interrupted delete is resumed first. Returns a
+        TransferProgress.
+        """
+        if progress is None:
+            progress = TransferProgress(len(files), sum(scanned.size for _, scanned, _ in files))
+        manifest = DeleteManifest(self.local_working_dir / DeleteManifest.FILE_NAME)
+        if manifest.exists():
+            pending = manifest.load_pending()
+            click.echo("Resuming delete of {} Dropbox file(s) listed in {}".format(len(pending), manifest.path))
+            file_names = {file_name for file_name, _, _ in files}
+            extra = [scanned for file_name, scanned, _ in pending if file_name not in file_names]
+            progress.add(len(extra), sum(scanned.size for scanned in extra))
+            self.run_delete_manifest(manifest, pending, batch_size, jobs, progress)
+            resumed = {file_name for file_name, _, _ in pending}
+            files = [entry for entry in files if entry[0] not in resumed]
+        if files:
+            manifest.create(self.dir_prefix, files)
+            self.run_delete_manifest(manifest, files, batch_size, jobs, progress)
+        return progress
+
+    def run_delete_manifest(self, manifest, files, batch_size, jobs, progress=None):
+        """Delete the pending files of a manifest in batches of batch_size
+        using `jobs` threads, recording each batch in the manifest. Files
+        changed since they were verified are left alone, and recorded as
+        skipped so that they don't hold up the manifest, and files that
+        fail to delete are recorded as failed for the same reason. Both are
+        still in Dropbox, so a later run verifies them afresh.
+        """
+        if progress is None:
+            progress = TransferProgress(len(files), sum(scanned.size for _, scanned, _ in files))
+        with self.metrics.phase("delete"), ThreadPoolExecutor(max_workers=jobs) as executor:
+            for start in range(0, len(files), batch_size):
+                batch = files[start:start + batch_size]
+                errors = executor.map(remove_unchanged_file, [scanned for _, scanned, _ in batch])
+                deleted = []
+                skipped = []
+                failed = []
+                for (file_name, scanned, _), error in zip(batch, errors):
+                    if isinstance(error, FileChangedError):
+                        progress.record_skipped(file_name, scanned.size)
+                        skipped.append(file_name)
+                        click.echo("{} Skipping '{}': {}".format(progress.format_status(), scanned.path, error))
+                        continue
+                    progress.record(file_name, scanned.size, error=error)
+                    if error is None:
+                        deleted.append(file_name)
+                    else:
+                        failed.append(file_name)
+                        click.echo("{} Failed to delete '{}': {}".format(progress.format_status(), scanned.path, error))
+                if skipped:
+                    manifest.record_skipped(skipped)
+                if failed:
+                    manifest.record_failed(failed)
+                manifest.record_deleted(deleted)
+                self.record_deleted_dropbox_files(deleted)
+                click.echo("{} Deleted {} Dropbox file(s)".format(progress.format_status(), len(deleted)))
+        manifest.complete()
+        return progress
+
+    def record_deleted_dropbox_files(self, file_names):
+        with self.db:
+            self.dbcursor.executemany(
+                "UPDATE files SET InDropbox = 0 WHERE Filename = ?",
+                ((file_name,) for file_name in file_names),
+            )
+
+    def load_dedup_index(self):
+        index = DedupIndex(self.container_client)
+        if not index.load():
+            click.echo("Building the dedup index from a listing of the whole container...")
+            index.rebuild(self.iter_blobs("photos/"))
+        index.compact()
+        return index
+
+    def update_dedup_index(self, index=None):
+        """Add the blobs uploaded so far to the dedup index, so the index
+        keeps up with every upload path, not just --dedup uploads. Without
+        a loaded `index`, only a delta of the new blobs is written.
+        """
+        if not self.new_blob_md5s:
+            return
+        if index is None:
+            index = DedupIndex(self.container_client)
+            if not index.exists():
+                # The first --dedup upload builds it from a listing, which
+                # will include these blobs
+                self.new_blob_md5s = {}
+                return
+        for md5, blob_name in self.new_blob_md5s.items():
+            index.add(md5, blob_name)
+        index.save()
+        self.new_blob_md5s = {}
+
+    def copy_blob_in_container(self, source_name, blob_file_key, md5, copy, scheduler):
+        """Check that blob source_name still has Content-MD5 `md5` and, if
+        `copy` is set, server-side copy it to blob_file_key. Returns False if
+        the source is gone or has changed.
+        """
+        from azure.core.exceptions import ResourceNotFoundError
+        source_client = self.container_client.get_blob_client(source_name)
+        try:
+            properties = source_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        content_md5 = properties.content_settings.content_md5
+        if content_md5 is None or bytes(content_md5).hex() != md5:
+            return False
+        if not copy:
+            return True
+        dest_client = self.container_client.get_blob_client(blob_file_key)
+        # Copies within an account usually complete before this returns;
+        # Content-MD5 is copied along with the data.
+        status = scheduler.call(dest_client.start_copy_from_url, source_client.url, retry_total=0)["copy_status"]
+        while status == "pending":
+            time.sleep(1)
+            status = dest_client.get_blob_properties().copy.status
+        if status != "success":
+            raise IOError("server-side copy from '{}' ended with status '{}'".format(source_name, status))
+        return True
+
+    def dedup_uploads(self, uploads, index, mode, jobs, scheduler):
+        """Server-side copy (mode "copy") or skip (mode "skip") the uploads
+        whose content the dedup index says is already in the container,
+        using a pool of `jobs` threads. Returns a TransferProgress for those
+        files and the uploads that still need sending.
+        """
+        # Stat each file once, for both its hash and its size; one that has
+        # gone or can't be read fails on its own
+        scanned_files = {}
+        errors = {}
+        for file_name, _, _ in uploads:
+            try:
+                scanned_files[file_name] = self.stat_source_file("workdir", file_name)
+            except OSError as e:
+                errors[file_name] = e
+        hashes = self.hash_scanned_files("workdir", scanned_files)
+        sizes = {file_name: scanned.size for file_name, scanned in scanned_files.items()}
+        remaining = []
+        candidates = []
+        for file_name, file_path, blob_file_key in uploads:
+            if file_name in errors:
+                continue
+            source_name = index.find(hashes[file_name])
+            if source_name is None or source_name == blob_file_key:
+                remaining.append((file_name, file_path, blob_file_key))
+            else:
+                candidates.append((file_name, file_path, blob_file_key, source_name))
+        progress = TransferProgress(
+            len(candidates) + len(errors), sum(sizes[file_name] for file_name, _, _, _ in candidates)
+        )
+        for file_name, e in errors.items():
+            progress.record(file_name, 0, error=e)
+            click.echo("{} Failed to read '{}': {}".format(progress.format_status(), file_name, e))
+        with self.metrics.phase("dedup"), ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    self.copy_blob_in_container,
+                    source_name,
+                    blob_file_key,
+                    hashes[file_name],
+                    mode == "copy",
+                    scheduler,
+                ): (file_name, file_path, blob_file_key, source_name)
+                for file_name, file_path, blob_file_key, source_name in candidates
+            }
+            for future in as_completed(futures):
+                file_name, file_path, blob_file_key, source_name = futures[future]
+                try:
+                    found = future.result()
+                except Exception as e:
+                    found = False
+                    click.echo("Server-side copy of '{}' failed ({}); uploading it instead".format(file_name, e))
+                if not found:
+                    progress.total_files -= 1
+                    progress.total_bytes -= sizes[file_name]
+                    remaining.append((file_name, file_path, blob_file_key))
+                    continue
+                if mode == "skip":
+                    progress.record_skipped(file_name, sizes[file_name])
+                    click.echo(
+                        "{} Skipping '{}'; identical content is already stored as '{}'".format(
+                            progress.format_status(), file_name, source_name
+                        )
+                    )
+                    continue
+                progress.record(file_name, sizes[file_name])
+                self.metrics.count("bytes_deduplicated", sizes[file_name])
+                self.record_uploaded_blob(file_name, blob_file_key, sizes[file_name], hashes[file_name])
+                click.echo(
+                    "{} Copied '{}' to blob container path '{}' from identical blob '{}'".format(
+                        progress.format_status(), file_name, blob_file_key, source_name
+                    )
+                )
+        return progress, remaining
+
+    def upload_packs(self, uploads, sizes, pack_size, max_concurrency, block_size, scheduler):
+        """Bundle (file_name, file_path, blob_file_key) uploads, whose sizes
+        are given by file name in `sizes`, into packs of up to pack_size
+        bytes (see upload_pack). Returns a TransferProgress.
+        """
+        progress = TransferProgress(len(uploads), sum(sizes[file_name] for file_name, _, _ in uploads))
+        packs = []
+        pack_bytes = 0
+        for upload in uploads:
+            if not packs or pack_bytes + sizes[upload[0]] > pack_size:
+                packs.append([])
+                pack_bytes = 0
+            packs[-1].append(upload)
+            pack_bytes += sizes[upload[0]]
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        with self.metrics.phase("pack"):
+            for n, members in enumerate(packs, 1):
+                pack_name = "{}{}/pack-{}-{:03d}.tar".format(self.dir_prefix, PACK_DIR_NAME, stamp, n)
+                try:
+                    index = self.upload_pack(pack_name, members, max_concurrency, block_size, scheduler)
+                except Exception as e:
+                    for file_name, _, _ in members:
+                        progress.record(file_name, 0, error=e)
+                    click.echo("{} Failed to upload pack '{}': {}".format(progress.format_status(), pack_name, e))
+                    continue
+                for member in index["members"]:
+                    file_name = posixpath.basename(member["name"])
+                    progress.record(file_name, member["size"])
+                    self.record_uploaded_blob(file_name, member["name"], member["size"], member["md5"], packed=True)
+                self.metrics.count("bytes_uploaded", sum(member["size"] for member in index["members"]))
+                click.echo(
+                    "{} Uploaded {} file(s) in pack '{}'".format(progress.format_status(), len(members), pack_name)
+                )
+        return progress
+
+    def upload_pack(self, pack_name, members, max_concurrency, block_size, scheduler):
+        """Upload (file_name, file_path, blob_file_key) files as one
+        uncompressed tar blob, followed by an index blob giving each file's
+        blob name, data offset, size and MD5. Returns the index.
+        """
+        # Only needed for pack mode, so imported here
+        import tarfile
+        from azure.storage.blob import ContentSettings
+        pack_path = self.local_working_dir / ".{}.tmp".format(posixpath.basename(pack_name))
+        try:
+            with tarfile.open(str(pack_path), "w", format=tarfile.PAX_FORMAT) as tar:
+                for _, file_path, blob_file_key in members:
+                    tar.add(str(file_path), arcname=blob_file_key[len(self.dir_prefix):])
+            # Read the members back from the finished tar, so the index
+            # describes exactly the bytes that get uploaded
+            index = {"pack": pack_name, "members": []}
+            with tarfile.open(str(pack_path)) as tar, open(pack_path, "rb") as f:
+                for info in tar:
+                    f.seek(info.offset_data)
+                    index["members"].append({
+                        "name": self.dir_prefix + info.name,
+                        "offset": info.offset_data,
+                        "size": info.size,
+                        "md5": hashlib.md5(f.read(info.size)).hexdigest(),
+                    })
+            pack_md5 = self.upload_file(
+                self.container_client, pack_path, pack_name, max_concurrency, block_size, scheduler
+            )
+            pack_size = pack_path.stat().st_size
+        finally:
+            if pack_path.exists():
+                os.remove(pack_path)
+        # The index goes up last, so a pack is only used once it's complete
+        index_name = get_pack_index_name(pack_name)
+        data = json.dumps(index, indent=1).encode()
+        scheduler.call(
+            self.container_client.upload_blob,
+            name=index_name,
+            data=data,
+            overwrite=True,
+            content_settings=ContentSettings(content_md5=hashlib.md5(data).digest()),
+            retry_total=0,
+            num_bytes=len(data),
+        )
+        local_index_path = self.local_blob_dir / index_name
+        local_index_path.parent.mkdir(parents=True, exist_ok=True)
+        local_index_path.write_bytes(data)
+        if self.catalog is not None:
+            self.catalog.record_blob(pack_name, pack_size, pack_md5)
+            self.catalog.record_blob(index_name, len(data), hashlib.md5(data).hexdigest())
+        return index
+
+    def download_packed_files(self, packed_blobs, scheduler):
+        """Restore PackedBlobs from the same pack to their paths under
+        local_blob_dir. Files that aren't present locally are fetched with
+        ranged reads of the pack, one per run of nearby files, so restoring
+        a single photo only reads that photo. Returns {blob name: bytes
+        written, or None if the file was already present}.
+        """
+        from azure.core import MatchConditions
+        results = {}
+        missing = []
+        for blob in sorted(packed_blobs, key=lambda blob: blob.offset):
+            dest_path = self.local_blob_dir / blob.name
+            if self.is_already_downloaded(blob, dest_path):
+                results[blob.name] = None
+            else:
+                missing.append(blob)
+        runs = []
+        for blob in missing:
+            if (
+                runs
+                and blob.offset - (runs[-1][-1].offset + runs[-1][-1].size) < PACK_READ_GAP
+                and blob.offset + blob.size - runs[-1][0].offset <= PACK_READ_MAX
+            ):
+                runs[-1].append(blob)
+            else:
+                runs.append([blob])
+        for run in runs:
+            start = run[0].offset
+            length = run[-1].offset + run[-1].size - start
+            buf = io.BytesIO()
+
+            def read_run():
+                buf.seek(0)
+                buf.truncate()
+                # Packs recorded by an upload have no ETag until relisted
+                downloader = self.container_client.download_blob(
+                    run[0].pack_name,
+                    offset=start,
+                    length=length,
+                    etag=run[0].etag,
+                    match_condition=MatchConditions.IfNotModified if run[0].etag else None,
+                    retry_total=0,
+                )
+                downloader.readinto(ThrottledWriter(buf, scheduler))
+
+            scheduler.call(read_run)
+            data = buf.getbuffer()
+            for blob in run:
+                file_data = bytes(data[blob.offset - start:blob.offset - start + blob.size])
+                if hashlib.md5(file_data).digest() != bytes(blob.content_settings.content_md5):
+                    raise IOError("'{}' doesn't match its MD5 in the pack index".format(blob.name))
+                dest_path = self.local_blob_dir / blob.name
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = dest_path.with_name(".{}.tmp".format(dest_path.name))
+                tmp_path.write_bytes(file_data)
+                os.replace(tmp_path, dest_path)
+                self.mark_downloaded(blob, dest_path)
+                results[blob.name] = blob.size
+            del data
+        return results
+
+    def download_blob_to_file(self, blob, max_concurrency, scheduler):
+        """Stream a blob into its path under local_blob_dir via a temp file,
+        resuming a partial download of the same blob version. Returns the
+        number of bytes transferred, or None if the file was already present.
+        The blob is fetched in DOWNLOAD_RANGE_SIZE ranges, so a throttled or
+        failed request is retried by `scheduler` for just that range.
+        """
+        from azure.core import MatchConditions
+        dest_path = self.local_blob_dir / blob.name
+        if self.is_already_downloaded(blob, dest_path):
+            return None
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        # Partial downloads are keyed by ETag, so we never append to bytes
+        # from an older version of the blob.
+        part_path = dest_path.with_name(
+            ".{}.{}.part".format(dest_path.name, blob.etag.strip('"'))
+        )
+        start_offset = part_path.stat().st_size if part_path.exists() else 0
+        if start_offset > blob.size:
+            start_offset = 0
+            os.remove(part_path)
+
+        def read_range(offset, length):
+            buf = io.BytesIO()
+            downloader = self.container_client.download_blob(
+                blob.name,
+                offset=offset,
+                length=length,
+                etag=blob.etag,
+                match_condition=MatchConditions.IfNotModified,
+                retry_total=0,
+            )
+            downloader.readinto(ThrottledWriter(buf, scheduler))
+            return buf.getvalue()
+
+        # Ranges are fetched in parallel and each is retried on its own by the
+        # scheduler, but they're written in order, so the part file is always
+        # a prefix of the blob that a later run can resume from. At most
+        # max_concurrency ranges are held in memory.
+        with open(part_path, "ab") as part_file, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            in_flight = collections.deque()
+            for offset in range(start_offset, blob.size, DOWNLOAD_RANGE_SIZE):
+                length = min(DOWNLOAD_RANGE_SIZE, blob.size - offset)
+                in_flight.append(executor.submit(scheduler.call, read_range, offset, length))
+                if len(in_flight) >= max_concurrency:
+                    part_file.write(in_flight.popleft().result())
+            while in_flight:
+                part_file.write(in_flight.popleft().result())
+        content_md5 = blob.content_settings.content_md5
+        if content_md5 and md5_file(str(part_path)) != bytes(content_md5).hex():
+            os.remove(part_path)
+            raise IOError("'{}' doesn't match its Content-MD5".format(blob.name))
+        os.replace(part_path, dest_path)
+        self.mark_downloaded(blob, dest_path)
+        return blob.size - start_offset
+
+    def is_already_downloaded(self, blob, dest_path):
+        """Is dest_path already this version of the blob? A file of the same
+        size counts if its mtime is the blob's last-modified time (which
+        mark_downloaded() sets) or its MD5 matches the blob's Content-MD5.
+        """
+        try:
+            stat = dest_path.stat()
+        except FileNotFoundError:
+            return False
+        if stat.st_size != blob.size:
+            return False
+        if blob.last_modified is not None and abs(stat.st_mtime - blob.last_modified.timestamp()) < 0.001:
+            return True
+        content_md5 = blob.content_settings.content_md5
+        return content_md5 is not None and md5_file(str(dest_path)) == bytes(content_md5).hex()
+
+    def mark_downloaded(self, blob, dest_path):
+        # Stamp a downloaded file with its blob's last-modified time, so
+        # later runs can skip it without hashing it
+        if blob.last_modified is not None:
+            timestamp = blob.last_modified.timestamp()
+            os.utime(str(dest_path), (timestamp, timestamp))
+
+    def download_blobs(self, blobs, jobs, max_concurrency, scheduler):
+        """Download blobs (e.g. a listing generator) using a pool of `jobs`
+        threads, within the request limit of `scheduler`. Only a couple of
+        downloads per thread are queued ahead, so memory use doesn't grow
+        with the listing. Returns a TransferProgress.
+        """
+        progress = TransferProgress(0, 0)
+        # Files in the same pack are listed together, and restored together
+        batches = itertools.groupby(
+            blobs, key=lambda blob: blob.pack_name if isinstance(blob, PackedBlob) else blob.name
+        )
+        # Create the client up front rather than racing to in the workers
+        self.container_client
+        with self.metrics.phase("download"), ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for _, batch in batches:
+                batch = list(batch)
+                progress.add(len(batch), sum(blob.size for blob in batch))
+                if isinstance(batch[0], PackedBlob):
+                    future = executor.submit(timed_call, self.download_packed_files, batch, scheduler)
+                else:
+                    future = executor.submit(
+                        timed_call, self.download_blob_to_file, batch[0], max_concurrency, scheduler
+                    )
+                futures[future] = batch
+                if len(futures) >= 2 * jobs:
+                    done, _ = wait_futures(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.record_download_result(progress, future, futures.pop(future))
+            for future in as_completed(list(futures)):
+                self.record_download_result(progress, future, futures.pop(future))
+        return progress
+
+    def record_download_result(self, progress, future, batch):
+        # Report the outcome of a download_blobs() future for its blobs
+        try:
+            elapsed, result = future.result()
+        except Exception as e:
+            for blob in batch:
+                progress.record(blob.name, 0, error=e)
+                click.echo(
+                    "{} Failed to download '{}': {}".format(progress.format_status(), blob.name, e)
+                )
+            return
+        self.metrics.record_latency("download", elapsed)
+        for blob in batch:
+            num_bytes = result[blob.name] if isinstance(blob, PackedBlob) else result
+            if num_bytes is None:
+                progress.record_skipped(blob.name, blob.size)
+                click.echo(
+                    "{} Skipping '{}'; it already exists locally".format(
+                        progress.format_status(), blob.name
+                    )
+                )
+                continue
+            progress.record(blob.name, num_bytes)
+            self.metrics.count("bytes_downloaded", num_bytes)
+            click.echo(
+                "{} Downloaded blob object '{}' to '{}'".format(
+                    progress.format_status(), blob.name, self.local_blob_dir / blob.name
+                )
+            )
+
+    def get_watch_partition(self, file_name):
+        # The (year, month) a new Camera Uploads file belongs to, taken from
+        # the date Dropbox puts in its name (or this context's year/month
+        # for devices matched by name), or None if it isn't a photo/video.
+        file_ext = os.path.splitext(file_name)[1][1:].lower()
+        if file_name.startswith(".") or file_ext not in self.supported_file_extensions:
+            return None
+        if self.device == "NikonCoolpix":
+            return (self.year, self.month) if self.match_filename(file_name) else None
+        match = re.match(r"(\d{4})-(\d{2})-", file_name)
+        return match.groups() if match else None
+
+    def back_up_new_file(self, file_name, src_path, workdir_path, copy, upload, max_concurrency, block_size, scheduler):
+        # Runs in a watch worker thread: copy a new file into the workdir
+        # and/or upload it, returning its MD5 if uploaded
+        if copy:
+            copy_file(src_path, workdir_path)
+        if upload:
+            return self.upload_file(
+                self.container_client,
+                workdir_path,
+                self.get_blob_file_key(file_name),
+                max_concurrency,
+                block_size,
+                scheduler,
+            )
+        return None
+
+    def watch(self, settle_seconds, poll_interval, jobs, queue_size, max_concurrency, block_size, scheduler, should_stop=None):
+        """Copy and upload new Camera Uploads files as they appear, until
+        interrupted or should_stop() returns True.
+
+        Files already present when watching starts are left to the other
+        commands. New files are picked up once Dropbox has finished writing
+        them (see PendingFiles), and at most `queue_size` of them are queued
+        or in flight at once. Each year/month gets a partition context whose
+        sources are loaded once and then kept up to date for the session.
+        """
+        should_stop = should_stop or (lambda: False)
+        root_dir = self.dropbox_camera_uploads_dir
+        partitions = {}
+        in_flight = {}
+        with DirectoryWatcher(root_dir) as watcher, ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Walk the tree once the watches are in place, so that no new
+            # file falls between the two
+            pending = PendingFiles(settle_seconds, [entry.path for entry in walk_files(root_dir)])
+            # Paths of new files, or None to rescan the whole tree
+            changed = []
+            while not should_stop():
+                if changed is None:
+                    changed = [entry.path for entry in walk_files(root_dir)]
+                candidates = [
+                    path for path in changed
+                    if self.get_watch_partition(os.path.basename(path)) is not None
+                ]
+                for scanned in pending.update(candidates, time.monotonic()):
+                    while len(in_flight) >= queue_size:
+                        self.finish_new_files(in_flight, pending, wait=True)
+                    file_name = os.path.basename(scanned.path)
+                    year, month = self.get_watch_partition(file_name)
+                    partition = partitions.get((year, month))
+                    if partition is None:
+                        partition = self.make_partition(year, month, self.device)
+                        os.makedirs(partition.local_working_dir / "video", exist_ok=True)
+                        partition.load_sources("workdir", "blob")
+                        partitions[(year, month)] = partition
+                    row = partition.get_file_db_row(file_name)
+                    copy = row is None or not row["InWorkingDir"]
+                    upload = row is None or not row["InBlob"]
+                    if not copy and not upload:
+                        click.echo("Skipping '{}'; it's already backed up".format(file_name))
+                        continue
+                    blob_concurrency = max_concurrency if self.is_video_file(file_name) else 1
+                    # Resolved here, as the workers can't use the DB
+                    workdir_path = partition.get_workdir_file_abspath(file_name)
+                    future = executor.submit(
+                        timed_call,
+                        partition.back_up_new_file,
+                        file_name,
+                        scanned.path,
+                        workdir_path,
+                        copy,
+                        upload,
+                        blob_concurrency,
+                        block_size,
+                        scheduler,
+                    )
+                    in_flight[future] = (partition, scanned, workdir_path, copy, upload)
+                self.finish_new_files(in_flight, pending, wait=False)
+                # Check back sooner while files are settling or in flight
+                busy = pending.pending or in_flight
+                if not busy:
+                    # Catch the dedup index up while there's nothing to do
+                    for partition in partitions.values():
+                        try:
+                            partition.update_dedup_index()
+                        except Exception as e:
+                            click.echo("Failed to update the dedup index: {}".format(e))
+                changed = watcher.wait(min(settle_seconds, poll_interval) if busy else poll_interval)
+            while in_flight:
+                self.finish_new_files(in_flight, pending, wait=True)
+
+    def finish_new_files(self, in_flight, pending, wait):
+        # Record the results of completed watch workers; the DB connections
+        # belong to this thread, so this is done here rather than in them.
+        done, _ = wait_futures(
+            list(in_flight), timeout=None if wait else 0, return_when=FIRST_COMPLETED
+        )
+        for future in done:
+            partition, scanned, workdir_path, copy, upload = in_flight.pop(future)
+            file_name = os.path.basename(scanned.path)
+            try:
+                elapsed, md5 = future.result()
+            except Exception as e:
+                # Try again the next time the dir is checked
+                pending.forget(scanned.path)
+                click.echo("Failed to back up '{}': {}".format(file_name, e))
+                continue
+            self.metrics.record_latency("watch", elapsed)
+            blob_file_key = partition.get_blob_file_key(file_name)
+            if copy:
+                partition.record_copied_file(file_name, workdir_path)
+            if upload:
+                partition.record_uploaded_blob(
+                    file_name, blob_file_key, os.path.getsize(workdir_path), md5
+                )
+            click.echo("Backed up '{}' to blob container path '{}'".format(file_name, blob_file_key))
+
     def mkdir(self):
         if not os.path.exists(self.local_working_dir):
             click.echo(
@@ -151,12 +2703,232 @@ class BackupContext(object):
                 "Working dir already exists at {}".format(self.local_working_dir)
             )
 
-    def __repr__(self):
-        return "<BackupContext %r>" % self.local_working_dir
+    def __repr__(self):
+        return "<BackupContext %r>" % self.local_working_dir
+
+
+class TransferProgress(object):
+    """Aggregate progress, throughput and per-file results for a batch of
+    transfers.
+    """
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.succeeded = []
+        self.skipped = []
+        self.failed = []
+        self.start_time = time.monotonic()
+
+    def record(self, file_name, num_bytes, error=None):
+        self.done_files += 1
+        if error is None:
+            self.done_bytes += num_bytes
+            self.succeeded.append(file_name)
+        else:
+            self.failed.append((file_name, error))
+
+    def add(self, num_files, num_bytes):
+        # Grow the totals of a batch whose size isn't known up front
+        self.total_files += num_files
+        self.total_bytes += num_bytes
+
+    def record_skipped(self, file_name, num_bytes):
+        # Skipped files count towards progress but not throughput
+        self.done_files += 1
+        self.total_bytes -= num_bytes
+        self.skipped.append(file_name)
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.done_bytes / elapsed if elapsed > 0 else 0.0
+
+    def format_status(self):
+        return "[{}/{} files, {:.1f}/{:.1f} MB, {:.1f} MB/s]".format(
+            self.done_files,
+            self.total_files,
+            self.done_bytes / 1e6,
+            self.total_bytes / 1e6,
+            self.throughput() / 1e6,
+        )
+
+    def echo_summary(self, verb):
+        click.echo(
+            "{} {} file(s), {} failed, {} skipped, {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+                verb,
+                len(self.succeeded),
+                len(self.failed),
+                len(self.skipped),
+                self.done_bytes / 1e6,
+                time.monotonic() - self.start_time,
+                self.throughput() / 1e6,
+            )
+        )
+        for file_name, error in self.failed:
+            click.echo("  FAILED '{}': {}".format(file_name, error))
+
+
+class TransferScheduler(object):
+    """Paces the blob requests of a run to adapt to throttling and cap
+    bandwidth, shared by all of its transfer threads.
+
+    Each request goes through call(), which waits for one of `limit`
+    request slots and for the rate cap, and retries throttled or timed out
+    requests with jittered exponential backoff (the SDK's own retries are
+    turned off by the callers, via retry_total=0). The limit adapts AIMD
+    style: it's halved, at most once a second, when a request is throttled
+    and grows by one after `limit` successes in a row, up to max_limit.
+    """
+    def __init__(self, initial_limit, max_limit, max_bytes_per_sec=None, max_retries=5, retry_base_seconds=0.5, metrics=None):
+        self.limit = max(1, min(initial_limit, max_limit))
+        self.max_limit = max_limit
+        self.min_limit_seen = self.limit
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.metrics = metrics or NullMetrics()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.last_backoff_time = None
+        self.throttled = 0
+        self.retries = 0
+        self.rate_lock = threading.Lock()
+        self.bytes_sent = 0
+        self.next_send_time = self.start_time = time.monotonic()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, throttled):
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                self.metrics.count("throttled_requests")
+                self.successes = 0
+                # One backoff per burst of failures from the same overload
+                if self.last_backoff_time is None or now - self.last_backoff_time >= 1.0:
+                    self.limit = max(1, self.limit // 2)
+                    self.min_limit_seen = min(self.min_limit_seen, self.limit)
+                    self.last_backoff_time = now
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def throttle(self, num_bytes):
+        # Reserve the next num_bytes / max_bytes_per_sec seconds of the
+        # shared send schedule, and wait for them to start
+        with self.rate_lock:
+            self.bytes_sent += num_bytes
+            if not self.max_bytes_per_sec:
+                return
+            now = time.monotonic()
+            start = max(now, self.next_send_time)
+            self.next_send_time = start + num_bytes / self.max_bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+    def call(self, fn, *args, num_bytes=0, **kwargs):
+        """Run fn(*args, **kwargs) in a request slot once num_bytes may be
+        sent, retrying it if it's throttled.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                self.throttle(num_bytes)
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                retryable = is_retryable_error(e)
+                self.release(throttled=retryable)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                self.metrics.count("transfer_retries")
+                # "Full jitter" keeps retrying threads from moving in lockstep
+                time.sleep(random.uniform(0, self.retry_base_seconds * 2 ** attempt))
+                continue
+            self.release(throttled=False)
+            return result
+
+    def echo_summary(self):
+        elapsed = time.monotonic() - self.start_time
+        click.echo(
+            "Settled at {} concurrent request(s) (min {}), {:.1f} MB/s; {} throttled, {} retried".format(
+                self.limit,
+                self.min_limit_seen,
+                self.bytes_sent / 1e6 / elapsed if elapsed > 0 else 0.0,
+                self.throttled,
+                self.retries,
+            )
+        )
+
+
+class ThrottledWriter(object):
+    # File wrapper that charges a download's writes to a TransferScheduler
+    def __init__(self, f, scheduler):
+        self.f = f
+        self.scheduler = scheduler
+
+    def write(self, data):
+        self.scheduler.throttle(len(data))
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
 
 
 pass_backup_context = click.make_pass_decorator(BackupContext)
 
+OUTPUT_FORMATS = ["table", "json", "ndjson", "csv"]
+
+
+def format_option(f):
+    return click.option(
+        "--format",
+        "output_format",
+        type=click.Choice(OUTPUT_FORMATS),
+        default="table",
+        show_default=True,
+        help="Output format. json, ndjson and csv stream one record per file, with status codes.",
+    )(f)
+
+
+def echo_records(output_format, columns, records):
+    """Write records (tuples of `columns` values) as they're produced, in
+    the given machine-readable format, without holding them in memory.
+    """
+    if output_format == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow(record)
+            click.echo(buf.getvalue(), nl=False)
+            buf.seek(0)
+            buf.truncate()
+        click.echo(buf.getvalue(), nl=False)
+    elif output_format == "ndjson":
+        for record in records:
+            click.echo(json.dumps(dict(zip(columns, record))))
+    else:
+        # A JSON array, written one element per line
+        separator = "["
+        for record in records:
+            click.echo(separator + json.dumps(dict(zip(columns, record))))
+            separator = ","
+        click.echo("[]" if separator == "[" else "]")
+
 
 @click.group()
 @click.option(
@@ -183,8 +2955,28 @@ pass_backup_context = click.make_pass_decorator(BackupContext)
     default="iPhone14",
     help="The device name to use in the working dir path.",
 )
+@click.option(
+    "--catalog",
+    is_flag=True,
+    default=False,
+    help="Keep a persistent file catalog in the local blob dir, so repeat runs only rescan changed dirs.",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write a JSON report of per-phase timings, counters and transfer latencies to this file.",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write cProfile stats for the run, worker threads included, to this file.",
+)
 @click.pass_context
-def cli(ctx, connection_string, blob_container_name, year, month, device):
+def cli(ctx, connection_string, blob_container_name, year, month, device, catalog, metrics_path, profile_path):
     """
     This utility copies image/video files from ~/Dropbox/Camera Uploads/
     into a local working dir, then uploads the files to a blob container.
@@ -197,7 +2989,43 @@ def cli(ctx, connection_string, blob_container_name, year, month, device):
     # Create a BackupContext object and remember it as as the context object.
     # From this point onwards other commands can refer to it by using the
     # @pass_backup_context decorator.
-    ctx.obj = BackupContext(connection_string, blob_container_name, year, month, device)
+    metrics = None
+    if metrics_path:
+        metrics = Metrics()
+        metrics.command = ctx.invoked_subcommand
+        ctx.call_on_close(lambda: metrics.write_report(metrics_path))
+    if profile_path:
+        profiler = cProfile.Profile()
+        thread_profilers = []
+
+        def profile_thread(frame, event, arg):
+            # Runs on the first profile event in each new (e.g. pool worker)
+            # thread, which a Profile only sees on Python 3.12+; otherwise
+            # give the thread a profiler of its own
+            sys.setprofile(None)
+            thread_profiler = cProfile.Profile()
+            try:
+                thread_profiler.enable()
+            except ValueError:
+                # Another profiler is already active, i.e. 3.12+
+                return
+            thread_profilers.append(thread_profiler)
+
+        threading.setprofile(profile_thread)
+        profiler.enable()
+
+        def write_profile():
+            threading.setprofile(None)
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)
+            stats.dump_stats(profile_path)
+
+        ctx.call_on_close(write_profile)
+    ctx.obj = BackupContext(
+        connection_string, blob_container_name, year, month, device, catalog=catalog, metrics=metrics
+    )
 
 
 @cli.command()
@@ -219,7 +3047,19 @@ def mkdir(backup_context):
     default=True,
     help="Do not actually copy files.",
 )
-def cp(backup_context, dryrun):
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of files to copy concurrently.",
+)
+@click.option(
+    "--hardlink",
+    is_flag=True,
+    default=False,
+    help="Hardlink files into the working dir instead of copying them (same filesystem only).",
+)
+def cp(backup_context, dryrun, jobs, hardlink):
     """Copy files from Dropbox to working dir.
 
     Note that files with video extensions will be copied into
@@ -233,7 +3073,9 @@ def cp(backup_context, dryrun):
     click.echo("To local working dir: {}".format(backup_context.local_working_dir))
     dest_images = backup_context.local_working_dir
     dest_videos = backup_context.local_working_dir / "video"
+    backup_context.load_sources("dropbox", "workdir")
 
+    copies = []
     for dropbox_file_name in backup_context.dropbox_filenames:
         file_row = backup_context.get_file_db_row(dropbox_file_name)
         if file_row["InWorkingDir"]:
@@ -244,8 +3086,7 @@ def cp(backup_context, dryrun):
             )
             continue
         # Set destination dir
-        file_ext = os.path.splitext(dropbox_file_name)[1]
-        if file_ext in backup_context.video_file_extensions:
+        if backup_context.is_video_file(dropbox_file_name):
             dest_root = dest_videos
         else:
             dest_root = dest_images
@@ -253,11 +3094,19 @@ def cp(backup_context, dryrun):
             click.echo(
                 "Dry run; would have copied '{}' to workdir".format(dropbox_file_name)
             )
-        else:
-            click.echo("Copying '{}' to {}".format(dropbox_file_name, dest_root))
-            copy2(
-                backup_context.dropbox_camera_uploads_dir / dropbox_file_name, dest_root
-            )
+            continue
+        copies.append((
+            dropbox_file_name,
+            backup_context.get_dropbox_file_abspath(dropbox_file_name),
+            dest_root / dropbox_file_name,
+        ))
+
+    if not copies:
+        return
+    progress = backup_context.copy_files(copies, jobs, hardlink)
+    progress.echo_summary("Copied")
+    if progress.failed:
+        sys.exit(1)
 
 
 @cli.command()
@@ -269,48 +3118,54 @@ def cp(backup_context, dryrun):
     default=True,
     help="Do not actually delete files.",
 )
-def rm_dropbox_files(backup_context, dryrun):
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of processes hashing files, and of threads deleting them.",
+)
+@click.option(
+    "--batch-size",
+    default=DELETE_BATCH_SIZE,
+    show_default=True,
+    help="Number of files deleted between updates of the delete manifest.",
+)
+def rm_dropbox_files(backup_context, dryrun, jobs, batch_size):
     """Delete backed-up files in your Camera Uploads dir.
+
+    A Dropbox file is only deleted if its MD5 matches both its workdir copy
+    and its blob's Content-MD5 (files whose blob has none are kept, and
+    listed). The files are listed in a manifest in the working dir before
+    any are deleted, and an interrupted run is resumed from it. The blob
+    container is always listed afresh, never answered from a cached
+    listing.
     """
+    manifest = DeleteManifest(backup_context.local_working_dir / DeleteManifest.FILE_NAME)
+    failed = False
+    if manifest.exists():
+        pending = manifest.load_pending()
+        if dryrun:
+            click.echo(
+                "[dry run] would have resumed deleting {} Dropbox file(s) listed in {}".format(
+                    len(pending), manifest.path
+                )
+            )
+        else:
+            click.echo("Resuming delete of {} Dropbox file(s) listed in {}".format(len(pending), manifest.path))
+            progress = backup_context.run_delete_manifest(manifest, pending, batch_size, jobs)
+            progress.echo_summary("Deleted")
+            # Files that failed are reported at the end, and newly backed-up
+            # files are still verified and deleted
+            failed = bool(progress.failed)
     # Double check that all the files to be deleted in Dropbox also exist
     # in the working dir and the blob container:
     click.echo("Checking for Dropbox files in workdir and blob container...")
+    backup_context.load_sources("dropbox", "workdir", "blob")
+    backed_up = []
     for dropbox_file_name in backup_context.dropbox_filenames:
         file_row = backup_context.get_file_db_row(dropbox_file_name)
-        in_workdir = file_row["InWorkingDir"]
-        in_blob = file_row["InBlob"]
-        dropbox_file_abspath = (
-            backup_context.dropbox_camera_uploads_dir / dropbox_file_name
-        )
-        file_ext = os.path.splitext(dropbox_file_name)[1]
-        if file_ext in (backup_context.video_file_extensions):
-            workdir_file_abspath = (
-                backup_context.local_working_dir / "video" / dropbox_file_name
-            )
-        else:
-            workdir_file_abspath = backup_context.local_working_dir / dropbox_file_name
-        if in_workdir and in_blob:
-            # Before rm'ing, diff the dropbox and workdir files to make sure
-            # neither copy is corrupt
-            if filecmp.cmp(dropbox_file_abspath, workdir_file_abspath, shallow=False):
-                if dryrun:
-                    click.echo(
-                        "[dry run] would have deleted Dropbox file '{}'".format(
-                            dropbox_file_name
-                        )
-                    )
-                    continue
-                else:
-                    click.echo("Deleting {}...".format(dropbox_file_abspath))
-                    os.remove(dropbox_file_abspath)
-            else:
-                click.echo(
-                    "Error: cmp() failed for Dropbox file '{}' and its workdir backup '{}'!".format(
-                        dropbox_file_name, workdir_file_abspath
-                    )
-                )
-                click.echo("Aborting clean; please investigate before continuing.")
-                sys.exit(1)
+        if file_row["InWorkingDir"] and file_row["InBlob"]:
+            backed_up.append(dropbox_file_name)
         else:
             click.echo(
                 "Skipping rm of Dropbox file '{}'; it's not present in both workdir and blob container...".format(
@@ -318,64 +3173,164 @@ def rm_dropbox_files(backup_context, dryrun):
                 )
             )
             click.echo("Please run the upload command to back the file up in blob storage first.")
-            continue
+    # Before rm'ing, check the Dropbox file against both of its backups
+    # to make sure neither copy is corrupt
+    verified, problems, unverifiable = backup_context.verify_dropbox_backups(backed_up, jobs)
+    for file_name, reason in problems:
+        click.echo("Error: can't verify the backups of Dropbox file '{}': {}!".format(file_name, reason))
+    if problems:
+        click.echo("Aborting clean; please investigate before continuing.")
+        sys.exit(1)
+    # Blobs uploaded in blocks by older versions have no Content-MD5, so
+    # their Dropbox files are kept rather than trusted, without holding up
+    # the rest
+    for file_name in unverifiable:
+        click.echo(
+            "Skipping rm of Dropbox file '{}'; its blob has no Content-MD5 to verify it against".format(file_name)
+        )
+    if dryrun:
+        for file_name, _, _ in verified:
+            click.echo("[dry run] would have deleted Dropbox file '{}'".format(file_name))
+        return
+    if verified:
+        progress = backup_context.delete_dropbox_files(verified, batch_size, jobs)
+        progress.echo_summary("Deleted")
+        failed = failed or bool(progress.failed)
+    if failed:
+        sys.exit(1)
 
 
-@cli.command()
-@pass_backup_context
-def difflocal(backup_context):
-    """Diff Dropbox and working dir contents.
-    """
-    fmt = "{:<40}{:<20}"
-    print(fmt.format("File name", "Status"))
+# Table text and style for each difflocal status code
+DIFFLOCAL_STATUSES = {
+    "diff_ok": ("👍 diff OK", {}),
+    "diff_mismatch": ("❌ diff NOT OK - files differ!", {}),
+    "dropbox_only": ("dropbox only", {"bg": "red", "fg": "white"}),
+    "blob_only": ("blob storage only", {"bg": "blue", "fg": "white"}),
+}
+
+
+def iter_difflocal_statuses(backup_context):
+    # Yield (file name, status code) in file name order
+    backup_context.load_sources("dropbox", "workdir", "blob")
+    identical = backup_context.compare_local_files(
+        [
+            row["Filename"]
+            for row in backup_context.dbcursor.execute(
+                "SELECT Filename FROM files WHERE InDropbox = 1 AND InWorkingDir = 1"
+            ).fetchall()
+        ]
+    )
     query = "SELECT * FROM files ORDER BY Filename"
     for row in backup_context.dbcursor.execute(query):
         filename = row["Filename"]
         in_dropbox = row["InDropbox"]
         in_workdir = row["InWorkingDir"]
         in_blob = row["InBlob"]
-        dropbox_file_abspath = backup_context.dropbox_camera_uploads_dir / filename
-        file_ext = os.path.splitext(filename)[1]
-        if file_ext in (backup_context.video_file_extensions):
-            workdir_file_abspath = backup_context.local_working_dir / "video" / filename
-        else:
-            workdir_file_abspath = backup_context.local_working_dir / filename
         if in_dropbox == 1 and in_workdir == 1:
-            if filecmp.cmp(dropbox_file_abspath, workdir_file_abspath, shallow=False):
-                print(fmt.format(filename, "👍 diff OK"))
-            else:
-                print(fmt.format(filename, "❌ diff NOT OK - files differ!"))
+            yield filename, "diff_ok" if identical[filename] else "diff_mismatch"
         elif in_dropbox == 1 and in_workdir == 0:
-            click.secho(fmt.format(filename, "dropbox only"), bg="red", fg="white")
+            yield filename, "dropbox_only"
         # Silencing since this is a little verbose:
         #elif in_dropbox == 0 and in_workdir == 1:
-        #    click.secho(fmt.format(filename, "workdir only"))
+        #    yield filename, "workdir_only"
         elif in_dropbox == 0 and in_workdir == 0 and in_blob == 1:
-            click.secho(fmt.format(filename, "blob storage only"), bg="blue", fg="white")
+            yield filename, "blob_only"
+
+
+def echo_status_table(statuses, status_texts):
+    fmt = "{:<40}{:<20}"
+    print(fmt.format("File name", "Status"))
+    for filename, status in statuses:
+        text, style = status_texts[status]
+        click.secho(fmt.format(filename, text), **style)
 
 
 @cli.command()
 @pass_backup_context
-def diffblob(backup_context):
-    """Diff working dir and blob container contents.
+@format_option
+def difflocal(backup_context, output_format):
+    """Diff Dropbox and working dir contents.
     """
-    fmt = "{:<40}{:<20}"
-    print(fmt.format("File name", "Status"))
+    statuses = iter_difflocal_statuses(backup_context)
+    if output_format == "table":
+        echo_status_table(statuses, DIFFLOCAL_STATUSES)
+    else:
+        echo_records(output_format, ["filename", "status"], statuses)
+
+
+# Table text and style for each diffblob status code
+DIFFBLOB_STATUSES = {
+    "no_content_md5": ("❔ blob has no Content-MD5", {}),
+    "checksum_ok": ("👍 checksum OK", {}),
+    "checksum_mismatch": ("❌ checksum NOT OK - files differ!", {"bg": "red", "fg": "white"}),
+    "in_blob_and_workdir": ("👍 found in blob ctr & workdir", {}),
+    "workdir_only": ("workdir only", {"bg": "red", "fg": "white"}),
+    "blob_only": ("blob storage only", {}),
+    "dropbox_only": ("dropbox only", {"bg": "red", "fg": "white"}),
+}
+
+
+def iter_diffblob_statuses(backup_context, verify):
+    # Yield (file name, status code) in file name order
+    backup_context.load_sources("dropbox", "workdir", "blob")
+    if verify:
+        local_hashes = backup_context.get_local_hashes(
+            "workdir",
+            [
+                row["Filename"]
+                for row in backup_context.dbcursor.execute(
+                    "SELECT Filename FROM files WHERE InWorkingDir = 1 AND InBlob = 1"
+                ).fetchall()
+            ],
+        )
     query = "SELECT * FROM files ORDER BY Filename"
     for row in backup_context.dbcursor.execute(query):
         filename = row["Filename"]
         in_dropbox = row["InDropbox"]
         in_workdir = row["InWorkingDir"]
         in_blob = row["InBlob"]
-        if in_workdir == 1 and in_blob == 1:
-            print(fmt.format(filename, "👍 found in blob ctr & workdir"))
-            # TODO - compare blob container file checksum against md5 of local file?
+        if in_workdir == 1 and in_blob == 1 and verify:
+            blob_md5 = backup_context.get_blob_md5(filename)
+            if blob_md5 is None:
+                yield filename, "no_content_md5"
+            elif blob_md5 == local_hashes[filename]:
+                yield filename, "checksum_ok"
+            else:
+                yield filename, "checksum_mismatch"
+        elif in_workdir == 1 and in_blob == 1:
+            yield filename, "in_blob_and_workdir"
         elif in_workdir == 1 and in_blob == 0:
-            click.secho(fmt.format(filename, "workdir only"), bg="red", fg="white")
+            yield filename, "workdir_only"
         elif in_workdir == 0 and in_blob == 1:
-            click.secho(fmt.format(filename, "blob storage only"))
+            yield filename, "blob_only"
         elif in_workdir == 0 and in_blob == 0 and in_dropbox == 1:
-            click.secho(fmt.format(filename, "dropbox only"), bg="red", fg="white")
+            yield filename, "dropbox_only"
+
+
+@cli.command()
+@pass_backup_context
+@click.option(
+    "--verify",
+    is_flag=True,
+    default=False,
+    help="Compare MD5s of workdir files against the Content-MD5 of their blobs.",
+)
+@click.option(
+    "--max-age",
+    type=int,
+    default=None,
+    help="Use the catalog's cached blob listing if it's at most this many seconds old (needs --catalog).",
+)
+@format_option
+def diffblob(backup_context, verify, max_age, output_format):
+    """Diff working dir and blob container contents.
+    """
+    backup_context.use_cached_listing(max_age)
+    statuses = iter_diffblob_statuses(backup_context, verify)
+    if output_format == "table":
+        echo_status_table(statuses, DIFFBLOB_STATUSES)
+    else:
+        echo_records(output_format, ["filename", "status"], statuses)
 
 
 @cli.command()
@@ -387,9 +3342,66 @@ def diffblob(backup_context):
     default=True,
     help="Do not actually upload files.",
 )
-def upload(backup_context, dryrun):
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of files to upload concurrently.",
+)
+@click.option(
+    "--block-size",
+    default=8,
+    show_default=True,
+    help="Block size in MiB used when uploading large files in chunks.",
+)
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Number of blocks to upload in parallel for each video file.",
+)
+@click.option(
+    "--max-rate",
+    default=0.0,
+    show_default=True,
+    help="Cap on the total transfer rate in MB/s (0 for no cap).",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    help="Number of times to retry a throttled or timed out request.",
+)
+@click.option(
+    "--dedup",
+    type=click.Choice(["none", "copy", "skip"]),
+    default="none",
+    show_default=True,
+    help="For files whose content is already in the container under another name, "
+    "server-side copy the existing blob (copy) or don't upload them at all (skip). "
+    "Skipped files aren't stored under their own name, so diffblob still lists them "
+    "as missing from the container and rm-dropbox-files keeps them; use copy for those.",
+)
+@click.option(
+    "--pack-threshold",
+    default=0,
+    show_default=True,
+    help="Bundle files of up to this many KiB into tar pack blobs, to save a request per file (0 to disable).",
+)
+@click.option(
+    "--pack-size",
+    default=256,
+    show_default=True,
+    help="Maximum size in MiB of each pack blob.",
+)
+def upload(backup_context, dryrun, jobs, block_size, max_concurrency, max_rate, max_retries, dedup, pack_threshold, pack_size):
     """Uploads local working dir files to the given blob container.
+
+    Up to --jobs files (and --max-concurrency blocks of each video) are sent
+    at once, backing off when the service throttles requests.
     """
+    backup_context.load_sources("workdir", "blob")
+    uploads = []
     for workdir_filename in backup_context.working_dir_filenames:
         file_row = backup_context.get_file_db_row(workdir_filename)
         if file_row["InBlob"]:
@@ -399,19 +3411,8 @@ def upload(backup_context, dryrun):
             #)
             continue
 
-        blob_dest_images = backup_context.dir_prefix
-        blob_dest_videos = backup_context.dir_prefix + "video/"
-        file_ext = os.path.splitext(workdir_filename)[1]
-        if file_ext in backup_context.video_file_extensions:
-            blob_root = blob_dest_videos
-            workdir_file_abspath = (
-                backup_context.local_working_dir / "video" / workdir_filename
-            )
-        else:
-            blob_root = blob_dest_images
-            workdir_file_abspath = backup_context.local_working_dir / workdir_filename
-
-        blob_file_key = blob_root + workdir_filename
+        workdir_file_abspath = backup_context.get_workdir_file_abspath(workdir_filename)
+        blob_file_key = backup_context.get_blob_file_key(workdir_filename)
         if dryrun:
             click.echo(
                 "Dry run; would have uploaded '{}' to blob container path '{}'".format(
@@ -419,18 +3420,55 @@ def upload(backup_context, dryrun):
                 )
             )
             continue
-        else:
-            click.echo(
-                "Uploading '{}' to blob container path '{}'".format(
-                    workdir_file_abspath, blob_file_key
-                )
+        uploads.append((workdir_filename, workdir_file_abspath, blob_file_key))
+
+    if not uploads:
+        return
+    scheduler = TransferScheduler(
+        jobs,
+        jobs * max_concurrency,
+        max_bytes_per_sec=max_rate * 1e6,
+        max_retries=max_retries,
+        metrics=backup_context.metrics,
+    )
+    index = None
+    failed = False
+    if dedup != "none":
+        # Look for each file's content elsewhere in the container (e.g.
+        # under another device or month) before sending any bytes
+        index = backup_context.load_dedup_index()
+        dedup_progress, uploads = backup_context.dedup_uploads(uploads, index, dedup, jobs, scheduler)
+        dedup_progress.echo_summary("Deduplicated")
+        failed = bool(dedup_progress.failed)
+    if pack_threshold:
+        # Small files go up in packs, each a single (block) upload. A file
+        # that can't be stat'ed is left to upload_files, which fails it on
+        # its own.
+        sizes = {}
+        for file_name, file_path, _ in uploads:
+            try:
+                sizes[file_name] = os.path.getsize(file_path)
+            except OSError:
+                pass
+        small_uploads = [u for u in uploads if u[0] in sizes and sizes[u[0]] <= pack_threshold * 1024]
+        uploads = [u for u in uploads if u[0] not in sizes or sizes[u[0]] > pack_threshold * 1024]
+        if small_uploads:
+            click.echo("Packing {} small file(s)...".format(len(small_uploads)))
+            pack_progress = backup_context.upload_packs(
+                small_uploads, sizes, pack_size * 1024 * 1024, max_concurrency, block_size * 1024 * 1024, scheduler
             )
-            # Upload the file
-            with open(file=workdir_file_abspath, mode="rb") as data:
-                # With the default upload_blob() params large video files almost always
-                # time out - setting connection_timeout to a high value seems to avoid that:
-                # https://stackoverflow.com/a/71000273
-                blob_client = backup_context.container_client.upload_blob(name=blob_file_key, data=data, overwrite=True, connection_timeout=60)
+            pack_progress.echo_summary("Packed")
+            # A failed pack doesn't hold up the larger files
+            failed = failed or bool(pack_progress.failed)
+    click.echo("Uploading {} file(s) with {} jobs...".format(len(uploads), jobs))
+    progress = backup_context.upload_files(
+        uploads, backup_context.container_client, jobs, max_concurrency, block_size * 1024 * 1024, scheduler
+    )
+    progress.echo_summary("Uploaded")
+    scheduler.echo_summary()
+    backup_context.update_dedup_index(index)
+    if failed or progress.failed:
+        sys.exit(1)
 
 
 @cli.command()
@@ -442,65 +3480,165 @@ def upload(backup_context, dryrun):
     default=True,
     help="Do not actually download files.",
 )
-def download(backup_context, dryrun):
+@click.option(
+    "--all-prefixes",
+    is_flag=True,
+    default=False,
+    help="Download the whole container rather than just the given year/month/device.",
+)
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of blobs to download concurrently.",
+)
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Number of parallel range requests for each blob.",
+)
+@click.option(
+    "--max-rate",
+    default=0.0,
+    show_default=True,
+    help="Cap on the total transfer rate in MB/s (0 for no cap).",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    help="Number of times to retry a throttled or timed out request.",
+)
+@click.option(
+    "--file",
+    "file_names",
+    multiple=True,
+    help="Only download the file with this name (e.g. a single photo from a pack); repeat for several.",
+)
+def download(backup_context, dryrun, all_prefixes, jobs, max_concurrency, max_rate, max_retries, file_names):
     """Download files from blob container to local dir.
+
+    Files already present locally with the same size are skipped, and
+    interrupted downloads resume where they left off. Files in packs are
+    restored individually, with ranged reads of the pack.
     """
     if not dryrun:
         backup_context.mkdir()
-    for key in backup_context.blob_container_paths:
-        if dryrun:
+    prefix = "" if all_prefixes else backup_context.dir_prefix
+    blobs = backup_context.expand_packs(backup_context.iter_blobs(prefix))
+    if file_names:
+        blobs = (blob for blob in blobs if posixpath.basename(blob.name) in file_names)
+    if dryrun:
+        for blob in blobs:
             click.echo(
                 "Dry run; would have downloaded blob storage object '{}' to '{}'".format(
-                    key, "{}/{}".format(backup_context.local_blob_dir, key)
-                )
-            )
-            continue
-        else:
-            click.echo(
-                "Downloading blob object '{}' to '{}'".format(
-                    key, "{}/{}".format(backup_context.local_blob_dir, key)
+                    blob.name, "{}/{}".format(backup_context.local_blob_dir, blob.name)
                 )
             )
-            blob_client = backup_context.container_client.get_blob_client(blob=key)
-            with open("{}/{}".format(backup_context.local_blob_dir, key), "wb") as download_file:
-                download_data = blob_client.download_blob()
-                download_file.write(download_data.readall())
+        return
+    # Each range of a blob takes a request slot of its own
+    scheduler = TransferScheduler(
+        jobs,
+        jobs * max_concurrency,
+        max_bytes_per_sec=max_rate * 1e6,
+        max_retries=max_retries,
+        metrics=backup_context.metrics,
+    )
+    progress = backup_context.download_blobs(blobs, jobs, max_concurrency, scheduler)
+    progress.echo_summary("Downloaded")
+    scheduler.echo_summary()
+    if progress.failed:
+        sys.exit(1)
 
 
 @cli.command()
 @pass_backup_context
-def lsblob(backup_context):
+@click.option(
+    "--max-age",
+    type=int,
+    default=None,
+    help="Use the catalog's cached blob listing if it's at most this many seconds old (needs --catalog).",
+)
+@format_option
+def lsblob(backup_context, max_age, output_format):
     """Print blob container contents for given year/month/device.
     """
-    for key in backup_context.blob_container_paths:
-        print(key)
+    backup_context.use_cached_listing(max_age)
+    backup_context.load_sources("blob")
+    if output_format == "table":
+        for key in backup_context.blob_container_paths:
+            print(key)
+        return
+    echo_records(
+        output_format,
+        ["name", "content_md5"],
+        (
+            (row["Path"], row["Hash"])
+            for row in backup_context.iter_source_rows("blob")
+        ),
+    )
 
 
 @cli.command()
 @pass_backup_context
-def lsdb(backup_context):
+@format_option
+def lsdb(backup_context, output_format):
     """Populate and print DB rows for given year/month/device.
     """
-    pd.set_option("display.max_rows", 1000)
-    print(pd.read_sql_query("SELECT * FROM files", backup_context.db))
+    backup_context.load_sources("dropbox", "workdir", "blob")
+    cursor = backup_context.dbcursor.execute("SELECT * FROM files")
+    columns = [description[0] for description in cursor.description]
+    if output_format != "table":
+        echo_records(output_format, columns, (tuple(row) for row in cursor))
+        return
+    fmt = "{:<40}" + "{:>14}" * (len(columns) - 1)
+    print(fmt.format(*columns))
+    for row in cursor:
+        print(fmt.format(*row))
+
+
+def echo_local_files(backup_context, location, output_format):
+    backup_context.load_sources(location)
+    rows = backup_context.iter_source_rows(location)
+    if output_format == "table":
+        for row in rows:
+            print(row["Filename"])
+        return
+    echo_records(
+        output_format,
+        ["filename", "path", "size", "mtime_ns"],
+        ((row["Filename"], row["Path"], row["Size"], row["MtimeNs"]) for row in rows),
+    )
 
 
 @cli.command()
 @pass_backup_context
-def lsdropbox(backup_context):
+@format_option
+def lsdropbox(backup_context, output_format):
     """Print Dropbox contents for given year/month/device.
     """
-    for name in backup_context.dropbox_filenames:
-        print(name)
+    echo_local_files(backup_context, "dropbox", output_format)
 
 
 @cli.command()
 @pass_backup_context
-def lsworkdir(backup_context):
+@format_option
+def lsworkdir(backup_context, output_format):
     """Print working dir contents for given year/month/device.
     """
-    for filename in backup_context.working_dir_filenames:
-        print(filename)
+    echo_local_files(backup_context, "workdir", output_format)
+
+
+def echo_plan(actions):
+    counts = collections.Counter(action.kind for action in actions)
+    click.echo(
+        "Plan: {} to copy, {} to upload, {} to verify, {} to delete".format(
+            counts["copy"], counts["upload"], counts["verify"], counts["delete"]
+        )
+    )
+    for action in actions:
+        click.echo("  {:<8}{:<40}{}".format(action.kind, action.file_name, action.dest or action.src))
 
 
 @cli.command()
@@ -510,35 +3648,368 @@ def lsworkdir(backup_context):
     prompt="Dry run?",
     type=click.BOOL,
     default=True,
-    help="Print steps rather than execute them.",
+    help="Print the plan rather than execute it.",
+)
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of files to copy, and to upload, concurrently.",
+)
+@click.option(
+    "--block-size",
+    default=8,
+    show_default=True,
+    help="Block size in MiB used when uploading large files in chunks.",
+)
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Number of blocks to upload in parallel for each video file.",
+)
+@click.option(
+    "--max-rate",
+    default=0.0,
+    show_default=True,
+    help="Cap on the total transfer rate in MB/s (0 for no cap).",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    help="Number of times to retry a throttled or timed out request.",
+)
+@click.option(
+    "--verify",
+    is_flag=True,
+    default=False,
+    help="Also check files uploaded by earlier runs against their blob's Content-MD5.",
+)
+@click.option(
+    "--delete",
+    is_flag=True,
+    default=False,
+    help="Also delete Dropbox files once they're backed up and verified.",
 )
-def workflow(backup_context, dryrun):
+def workflow(ctx, dryrun, jobs, block_size, max_concurrency, max_rate, max_retries, verify, delete):
     """Runs all commands for a typical backup workflow.
+
+    The copies, uploads (and optionally verifies and deletes) needed are
+    planned up front, so a dry run shows every step. Each file is uploaded
+    as soon as it has been copied, while later files are still copying.
     """
-    backup_context.invoke(mkdir)
-    backup_context.invoke(difflocal)
+    backup_context = ctx.obj
+    ctx.invoke(mkdir)
+    ctx.invoke(difflocal)
     # TODO - bail out if there's nothing in the dropbox folder, since
     # there's nothing else we can do
-    click.confirm(
-        "About to copy files to workdir - do you want to continue?", abort=True
-    )
-    backup_context.forward(cp)
+    actions = backup_context.plan_sync(verify=verify, delete=delete)
+    echo_plan(actions)
     if dryrun:
-        print("Skipping blob container preview step since dryrun mode is on...")
-        # NOTE: This is skipped when in a dryrun, since no files were moved on
-        # disk in earlier steps, so we can't look at the disk or DB to display
-        # what we would actually be doing here...
-        # IDEA: What if copying or deleting files triggered an update to
-        # the DB, so that we could print what the current state would be?
-        # And the code paths that actually do modify files could either
-        # query the DB to figure out what to do, or a single function could
-        # "sync" the disk with the desired layout expressed in the DB state...
-    else:
-        click.confirm("About to upload files to blob container - do you want to continue?", abort=True)
-        # Reinitialize DB with updated paths, since we may have just moved
-        # files into the workdir
-        backup_context.obj.init_db()
-        backup_context.forward(upload)
+        click.echo("Dry run; nothing was changed.")
+        return
+    if not actions:
+        click.echo("Nothing to do.")
+        return
+    click.confirm("About to run this plan - do you want to continue?", abort=True)
+    scheduler = TransferScheduler(
+        jobs,
+        jobs * max_concurrency,
+        max_bytes_per_sec=max_rate * 1e6,
+        max_retries=max_retries,
+        metrics=backup_context.metrics,
+    )
+    progress = backup_context.execute_plan(
+        actions, jobs, max_concurrency, block_size * 1024 * 1024, scheduler
+    )
+    for kind, verb in [("copy", "Copied"), ("upload", "Uploaded"), ("verify", "Verified"), ("delete", "Deleted")]:
+        if progress[kind].total_files:
+            progress[kind].echo_summary(verb)
+    scheduler.echo_summary()
+    backup_context.update_dedup_index()
+    if any(kind_progress.failed for kind_progress in progress.values()):
+        sys.exit(1)
+    if not delete:
         click.echo(
             "All done - to delete your files from Dropbox, run the rm-dropbox-files command."
         )
+
+
+@cli.command()
+@pass_backup_context
+@click.option(
+    "--settle-seconds",
+    default=5.0,
+    show_default=True,
+    help="How long a new file's size and mtime must hold steady before it's backed up.",
+)
+@click.option(
+    "--poll-interval",
+    default=30.0,
+    show_default=True,
+    help="Seconds between checks for new files if nothing wakes the watcher sooner (always, without inotify).",
+)
+@click.option(
+    "--jobs",
+    default=2,
+    show_default=True,
+    help="Number of files to copy and upload concurrently.",
+)
+@click.option(
+    "--queue-size",
+    default=16,
+    show_default=True,
+    help="Maximum number of new files queued or in flight at once.",
+)
+@click.option(
+    "--block-size",
+    default=8,
+    show_default=True,
+    help="Block size in MiB used when uploading large files in chunks.",
+)
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Number of blocks to upload in parallel for each video file.",
+)
+@click.option(
+    "--max-rate",
+    default=0.0,
+    show_default=True,
+    help="Cap on the total transfer rate in MB/s (0 for no cap).",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    help="Number of times to retry a throttled or timed out request.",
+)
+def watch(backup_context, settle_seconds, poll_interval, jobs, queue_size, block_size, max_concurrency, max_rate, max_retries):
+    """Continuously back up new Camera Uploads files.
+
+    Each new photo/video is copied into the working dir of the month in its
+    name and uploaded as soon as Dropbox has finished writing it. Files
+    already in Camera Uploads when watching starts are left alone; use
+    workflow or batch for those. Stop with Ctrl-C.
+    """
+    click.echo(
+        "Watching {} for new files; press Ctrl-C to stop".format(
+            backup_context.dropbox_camera_uploads_dir
+        )
+    )
+    scheduler = TransferScheduler(
+        jobs,
+        jobs * max_concurrency,
+        max_bytes_per_sec=max_rate * 1e6,
+        max_retries=max_retries,
+        metrics=backup_context.metrics,
+    )
+    try:
+        backup_context.watch(
+            settle_seconds, poll_interval, jobs, queue_size, max_concurrency, block_size * 1024 * 1024, scheduler
+        )
+    except KeyboardInterrupt:
+        click.echo("Stopped watching")
+    scheduler.echo_summary()
+
+
+def parse_year_month(ctx, param, value):
+    try:
+        parsed = datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise click.BadParameter("expected YYYY-MM, e.g. 2023-01")
+    return parsed.year, parsed.month
+
+
+def month_range(first, last):
+    # Yield ("YYYY", "MM") for each month from first to last inclusive
+    year, month = first
+    while (year, month) <= last:
+        yield "{:04}".format(year), "{:02}".format(month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+@cli.command()
+@click.pass_context
+@click.option(
+    "--from",
+    "first_month",
+    required=True,
+    callback=parse_year_month,
+    help="The first year-month to process (e.g. 2023-01).",
+)
+@click.option(
+    "--to",
+    "last_month",
+    required=True,
+    callback=parse_year_month,
+    help="The last year-month to process (e.g. 2024-06).",
+)
+@click.option(
+    "--devices",
+    default=None,
+    help="Comma-separated device names to process (defaults to --device).",
+)
+@click.option(
+    "--step",
+    "steps",
+    multiple=True,
+    type=click.Choice(["difflocal", "cp", "upload", "diffblob"]),
+    default=["cp", "upload"],
+    show_default=True,
+    help="A command to run for each year/month/device; repeat for several.",
+)
+@click.option(
+    "--dryrun",
+    prompt="Dry run?",
+    type=click.BOOL,
+    default=True,
+    help="Do not actually copy or upload files.",
+)
+@click.option(
+    "--jobs",
+    default=4,
+    show_default=True,
+    help="Number of files to copy, and to upload, concurrently.",
+)
+@click.option(
+    "--block-size",
+    default=8,
+    show_default=True,
+    help="Block size in MiB used when uploading large files in chunks.",
+)
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    help="Number of blocks to upload in parallel for each video file.",
+)
+@click.option(
+    "--max-rate",
+    default=0.0,
+    show_default=True,
+    help="Cap on the total transfer rate in MB/s (0 for no cap).",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    show_default=True,
+    help="Number of times to retry a throttled or timed out request.",
+)
+def batch(ctx, first_month, last_month, devices, steps, dryrun, jobs, block_size, max_concurrency, max_rate, max_retries):
+    """Runs commands for a range of months and devices in one pass.
+
+    Dropbox is walked and the blob container is listed once, and the files
+    are then partitioned into their photos/{year}/{month}/{device}/ prefixes.
+    The cp and upload steps are planned for every partition and run as one
+    pipelined pass sharing the same pools and transfer limits, so each file
+    is uploaded as soon as it has been copied, whichever partition it's in.
+    The difflocal steps run for each partition before that pass and the
+    diffblob steps after it. A failure doesn't stop the other partitions,
+    and the partitions with failures are listed at the end.
+
+    Example usage:\n
+      drop2blob batch --from 2023-01 --to 2024-06 --devices iPhone14
+    """
+    backup_context = ctx.obj
+    devices = devices.split(",") if devices else [backup_context.device]
+    months = list(month_range(first_month, last_month))
+    if len(months) > 1 and "NikonCoolpix" in devices:
+        raise click.UsageError(
+            "NikonCoolpix files are matched by name rather than date, so they can only be processed one month at a time."
+        )
+    # Other devices' files are only told apart by date, so the same files
+    # would be backed up under each of them
+    if len([device for device in devices if device != "NikonCoolpix"]) > 1:
+        raise click.UsageError(
+            "Camera Uploads files are matched by date rather than device, so only one device (plus NikonCoolpix) can be processed at a time."
+        )
+    partitions = [
+        backup_context.make_partition(year, month, device)
+        for year, month in months
+        for device in devices
+    ]
+    backup_context.share_sources(partitions)
+    failed = collections.OrderedDict()
+
+    def run_reports(report_steps):
+        for partition in partitions:
+            for step in report_steps:
+                click.echo("=== {} ({}) ===".format(partition.dir_prefix, step))
+                # Commands find their BackupContext via ctx.obj
+                ctx.obj = partition
+                try:
+                    ctx.invoke(cli.get_command(ctx, step))
+                except (click.Abort, click.ClickException):
+                    raise
+                except Exception as e:
+                    click.echo("{} failed: {}".format(step, e))
+                    failed.setdefault(partition.dir_prefix, step)
+                finally:
+                    ctx.obj = backup_context
+
+    run_reports([step for step in steps if step == "difflocal"])
+    plans = []
+    for partition in partitions:
+        try:
+            actions = partition.plan_sync()
+        except Exception as e:
+            click.echo("Failed to plan {}: {}".format(partition.dir_prefix, e))
+            failed.setdefault(partition.dir_prefix, "plan")
+            continue
+        # Without the cp step only files already in the workdir are
+        # uploaded, as the upload command would
+        copied = {action.file_name for action in actions if action.kind == "copy"}
+        actions = [
+            action
+            for action in actions
+            if (action.kind == "copy" and "cp" in steps)
+            or (action.kind == "upload" and "upload" in steps and ("cp" in steps or action.file_name not in copied))
+        ]
+        if actions:
+            plans.append((partition, actions))
+    for partition, actions in plans:
+        click.echo("=== {} ===".format(partition.dir_prefix))
+        echo_plan(actions)
+    if dryrun:
+        if plans:
+            click.echo("Dry run; nothing was copied or uploaded.")
+    elif plans:
+        for partition, actions in plans:
+            if any(action.kind == "copy" for action in actions):
+                partition.mkdir()
+        scheduler = TransferScheduler(
+            jobs,
+            jobs * max_concurrency,
+            max_bytes_per_sec=max_rate * 1e6,
+            max_retries=max_retries,
+            metrics=backup_context.metrics,
+        )
+        failed_actions = []
+        progress = backup_context.execute_transfers(
+            plans, jobs, max_concurrency, block_size * 1024 * 1024, scheduler, failed_actions=failed_actions
+        )
+        for kind, verb in [("copy", "Copied"), ("upload", "Uploaded")]:
+            if progress[kind].total_files:
+                progress[kind].echo_summary(verb)
+        scheduler.echo_summary()
+        # Write the partitions' new blobs to the dedup index as one delta
+        for partition, _ in plans:
+            for md5, blob_name in partition.new_blob_md5s.items():
+                backup_context.new_blob_md5s.setdefault(md5, blob_name)
+            partition.new_blob_md5s = {}
+        backup_context.update_dedup_index()
+        failed_kinds = {(partition, action.kind) for partition, action in failed_actions}
+        for partition, _ in plans:
+            for kind, step in [("copy", "cp"), ("upload", "upload")]:
+                if (partition, kind) in failed_kinds:
+                    failed.setdefault(partition.dir_prefix, step)
+                    break
+    run_reports([step for step in steps if step == "diffblob"])
+    if failed:
+        click.echo("{} of {} partition(s) failed:".format(len(failed), len(partitions)))
+        for dir_prefix, step in failed.items():
+            click.echo("  {} ({})".format(dir_prefix, step))
+        sys.exit(1)
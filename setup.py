@@ -8,7 +8,6 @@ setup(
     install_requires=[
         'azure-storage-blob',
         'click',
-        'pandas',
     ],
     entry_points='''
         [console_scripts]
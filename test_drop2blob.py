@@ -1,7 +1,17 @@
+import hashlib
+import json
+import os
+import pstats
 import pytest
+import shutil
+import subprocess
+import sys
+from azure.core.exceptions import ResourceNotFoundError
 from click.testing import CliRunner
+from types import SimpleNamespace
 from unittest.mock import Mock
-from drop2blob import cli
+import drop2blob
+from drop2blob import BackupContext, DirectoryWatcher, PlannedAction, TransferScheduler, cli
 
 @pytest.fixture
 def mock_backup_context():
@@ -33,4 +43,1405 @@ def test_lsblob(mock_backup_context, monkeypatch):
     assert result.exit_code == 0
     assert 'path1' in result.output
     assert 'path2' in result.output
-    assert 'path3' in result.output
\ No newline at end of file
+    assert 'path3' in result.output
+
+class FakeBlob(object):
+    def __init__(self, name, data=b"", content_md5=None):
+        self.name = name
+        self.size = len(data)
+        self.etag = '"0x{:x}"'.format(hash(data) & 0xffffffff)
+        self.last_modified = None
+        self.content_settings = SimpleNamespace(content_md5=content_md5)
+
+
+class FakeItemPaged(object):
+    def __init__(self, items, page_size=2):
+        self.items = items
+        self.page_size = page_size
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self):
+        for start in range(0, len(self.items), self.page_size):
+            yield iter(self.items[start:start + self.page_size])
+
+
+class FakeDownloader(object):
+    def __init__(self, data):
+        self.data = data
+
+    def readinto(self, stream):
+        # Like a parallel download, write the chunks out of order at their
+        # offsets from where the stream started
+        start = stream.tell()
+        half = len(self.data) // 2
+        stream.seek(start + half)
+        stream.write(self.data[half:])
+        stream.seek(start)
+        stream.write(self.data[:half])
+        return len(self.data)
+
+    def readall(self):
+        return self.data
+
+
+class FakeContainerClient(object):
+    def __init__(self, blobs=None):
+        self.blobs = dict(blobs or {})
+        self.list_blobs_calls = []
+        self.download_calls = []
+        self.md5s = {}
+        self.staged = {}
+        self.copies = []
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        self.list_blobs_calls.append(name_starts_with)
+        return FakeItemPaged([
+            FakeBlob(name, data, self.md5s.get(name, hashlib.md5(data).digest()))
+            for name, data in sorted(self.blobs.items())
+            if name.startswith(name_starts_with or "")
+        ])
+
+    def download_blob(self, blob, offset=None, length=None, **kwargs):
+        self.download_calls.append((blob, offset, length))
+        data = self.blobs[blob]
+        offset = offset or 0
+        return FakeDownloader(data[offset:] if length is None else data[offset:offset + length])
+
+    def upload_blob(self, name, data, overwrite=False, content_settings=None, **kwargs):
+        if name.endswith('fail.jpg'):
+            raise IOError('upload failed')
+        self.blobs[name] = data if isinstance(data, bytes) else data.read()
+        self.md5s[name] = content_settings.content_md5 if content_settings else None
+
+    def delete_blob(self, name, **kwargs):
+        if name not in self.blobs:
+            raise ResourceNotFoundError('not found')
+        del self.blobs[name]
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+
+class FakeBlobClient(object):
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        self.container.staged.setdefault(self.name, {})[block_id] = data
+
+    def get_block_list(self, block_list_type='committed'):
+        staged = self.container.staged.get(self.name, {})
+        return [], [SimpleNamespace(id=block_id) for block_id in staged]
+
+    def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        staged = self.container.staged.pop(self.name)
+        self.container.blobs[self.name] = b''.join(staged[block_id] for block_id in block_list)
+        self.container.md5s[self.name] = content_settings.content_md5
+
+    @property
+    def url(self):
+        return 'https://account.blob.core.windows.net/ctr/' + self.name
+
+    def download_blob(self, **kwargs):
+        if self.name not in self.container.blobs:
+            raise ResourceNotFoundError('not found')
+        data = self.container.blobs[self.name]
+        return SimpleNamespace(readall=lambda: data, properties=SimpleNamespace(etag='"1"'))
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        self.container.blobs[self.name] = data
+        return {'etag': '"2"'}
+
+    def get_blob_properties(self):
+        if self.name not in self.container.blobs:
+            raise ResourceNotFoundError('not found')
+        content_md5 = self.container.md5s.get(self.name, hashlib.md5(self.container.blobs[self.name]).digest())
+        return SimpleNamespace(content_settings=SimpleNamespace(content_md5=content_md5))
+
+    def start_copy_from_url(self, source_url, **kwargs):
+        source_name = source_url.split('/ctr/', 1)[1]
+        self.container.blobs[self.name] = self.container.blobs[source_name]
+        self.container.copies.append((source_name, self.name))
+        return {'copy_status': 'success'}
+
+
+@pytest.fixture
+def fake_container(tmp_path, monkeypatch):
+    container = FakeContainerClient()
+    service = Mock()
+    service.get_container_client.return_value = container
+    monkeypatch.setattr(
+        'drop2blob.make_blob_service_client',
+        lambda s, **client_options: service,
+    )
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'Dropbox' / 'Camera Uploads').mkdir(parents=True)
+    return container
+
+
+def invoke(*args, input=None):
+    return CliRunner().invoke(
+        cli, [
+            '--connection-string', 'fake_connection_string',
+            '--blob-container-name', 'ctr',
+            '--year', '2024',
+            '--month', '05',
+            '--device', 'iPhone14',
+        ] + list(args),
+        input=input,
+    )
+
+
+def test_lsdropbox_does_not_list_container(fake_container, tmp_path):
+    (tmp_path / 'Dropbox' / 'Camera Uploads' / '2024-05-01 10.00.00.jpg').write_bytes(b'x')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] = b'y'
+
+    result = invoke('lsdropbox')
+
+    assert result.exit_code == 0, result.output
+    assert '2024-05-01 10.00.00.jpg' in result.output
+    assert fake_container.list_blobs_calls == []
+
+
+def test_lsblob_lists_only_dir_prefix(fake_container):
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] = b'y'
+    fake_container.blobs['photos/2023/01/iPhone14/2023-01-02 10.00.00.jpg'] = b'z'
+
+    result = invoke('lsblob')
+
+    assert result.exit_code == 0, result.output
+    assert '2024-05-02 10.00.00.jpg' in result.output
+    assert '2023-01-02' not in result.output
+    assert fake_container.list_blobs_calls == ['photos/2024/05/iPhone14/']
+
+
+def test_upload_parallel_reports_failures(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'jpg')
+    (workdir / '2024-05-01 11.00.00 fail.jpg').write_bytes(b'bad')
+    (workdir / 'video' / '2024-05-01 12.00.00.mov').write_bytes(b'mov')
+
+    result = invoke('upload', '--dryrun', 'false', '--jobs', '2')
+
+    assert result.exit_code == 1, result.output
+    assert 'Uploaded 2 file(s), 1 failed' in result.output
+    assert "FAILED '2024-05-01 11.00.00 fail.jpg'" in result.output
+    assert fake_container.blobs == {
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg': b'jpg',
+        'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov': b'mov',
+    }
+
+
+def test_a_vanished_file_only_fails_its_own_upload_or_copy(fake_container, tmp_path):
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    present = tmp_path / '2024-05-01 10.00.00.jpg'
+    present.write_bytes(b'jpg')
+    gone = tmp_path / '2024-05-02 10.00.00.jpg'
+
+    progress = ctx.upload_files(
+        [(present.name, present, 'photos/a.jpg'), (gone.name, gone, 'photos/b.jpg')],
+        fake_container, 2, 1, 1024, TransferScheduler(2, 2),
+    )
+    assert progress.succeeded == [present.name]
+    assert [file_name for file_name, _ in progress.failed] == [gone.name]
+
+    (tmp_path / 'copies').mkdir()
+    progress = ctx.copy_files(
+        [(present.name, present, tmp_path / 'copies' / 'a.jpg'), (gone.name, gone, tmp_path / 'copies' / 'b.jpg')],
+        2, False,
+    )
+    assert (progress.succeeded, progress.done_bytes) == ([present.name], 3)
+    assert [file_name for file_name, _ in progress.failed] == [gone.name]
+
+
+def test_download_skips_present_files_and_resumes_partials(fake_container, tmp_path):
+    present = 'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'
+    partial = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    fake_container.blobs[present] = b'jpg'
+    fake_container.blobs[partial] = b'0123456789'
+    local_blob_dir = tmp_path / 'Pictures' / 'blob' / 'ctr'
+    (local_blob_dir / 'photos/2024/05/iPhone14/video').mkdir(parents=True)
+    (local_blob_dir / present).write_bytes(b'jpg')
+    etag = FakeBlob(partial, b'0123456789').etag.strip('"')
+    part_path = local_blob_dir / 'photos/2024/05/iPhone14/video' / '.2024-05-01 12.00.00.mov.{}.part'.format(etag)
+    part_path.write_bytes(b'0123')
+    # Same size as its blob, but a different version
+    rewritten = 'photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'
+    fake_container.blobs[rewritten] = b'new'
+    (local_blob_dir / rewritten).write_bytes(b'old')
+
+    result = invoke('download', '--dryrun', 'false')
+
+    assert result.exit_code == 0, result.output
+    assert (local_blob_dir / partial).read_bytes() == b'0123456789'
+    assert (local_blob_dir / rewritten).read_bytes() == b'new'
+    assert not part_path.exists()
+    assert sorted(fake_container.download_calls) == [(rewritten, 0, 3), (partial, 4, 6)]
+
+
+def test_download_only_reads_the_listing_a_few_blobs_ahead(fake_container, monkeypatch):
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    listed = []
+    ahead = []
+
+    def listing():
+        for i in range(20):
+            listed.append(i)
+            yield FakeBlob('photos/2024/05/iPhone14/{:02d}.jpg'.format(i), b'jpg')
+
+    def download(blob, max_concurrency, scheduler):
+        ahead.append(len(listed) - int(blob.name[-6:-4]))
+        return blob.size
+
+    monkeypatch.setattr(ctx, 'download_blob_to_file', download)
+    progress = ctx.download_blobs(listing(), 2, 1, TransferScheduler(2, 2))
+
+    assert (progress.total_files, len(progress.succeeded)) == (20, 20)
+    # Two queued per thread, plus the one read to find the end of a batch
+    assert max(ahead) <= 2 * 2 + 1
+
+
+def test_download_discards_a_corrupt_partial_download(fake_container, tmp_path):
+    name = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    fake_container.blobs[name] = b'0123456789'
+    local_dir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos/2024/05/iPhone14/video'
+    local_dir.mkdir(parents=True)
+    etag = FakeBlob(name, b'0123456789').etag.strip('"')
+    part_path = local_dir / '.2024-05-01 12.00.00.mov.{}.part'.format(etag)
+    part_path.write_bytes(b'XXXX')
+
+    result = invoke('download', '--dryrun', 'false')
+
+    assert result.exit_code == 1
+    assert "doesn't match its Content-MD5" in result.output
+    assert not part_path.exists()
+    assert not (local_dir / '2024-05-01 12.00.00.mov').exists()
+
+
+def test_download_retries_only_the_failed_range(fake_container, tmp_path, monkeypatch):
+    name = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    fake_container.blobs[name] = b'0123456789'
+    monkeypatch.setattr(drop2blob, 'DOWNLOAD_RANGE_SIZE', 4)
+    download_blob = fake_container.download_blob
+    failures = [ConnectionError('reset')]
+
+    def flaky_download_blob(blob, offset=None, length=None, **kwargs):
+        if offset == 4 and failures:
+            fake_container.download_calls.append((blob, offset, length))
+            raise failures.pop()
+        return download_blob(blob, offset=offset, length=length, **kwargs)
+
+    monkeypatch.setattr(fake_container, 'download_blob', flaky_download_blob)
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    blob = next(iter(fake_container.list_blobs()))
+
+    transferred = ctx.download_blob_to_file(blob, 2, TransferScheduler(2, 2, retry_base_seconds=0))
+
+    assert transferred == 10
+    assert (ctx.local_blob_dir / name).read_bytes() == b'0123456789'
+    assert sorted(fake_container.download_calls) == [
+        (name, 0, 4), (name, 4, 4), (name, 4, 4), (name, 8, 2),
+    ]
+
+
+def test_download_lets_the_scheduler_grow_to_every_range_in_flight(fake_container, monkeypatch):
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'jpg'
+    schedulers = []
+
+    def make_scheduler(*args, **kwargs):
+        schedulers.append(TransferScheduler(*args, **kwargs))
+        return schedulers[-1]
+
+    monkeypatch.setattr('drop2blob.TransferScheduler', make_scheduler)
+
+    result = invoke('download', '--dryrun', 'false', '--jobs', '3', '--max-concurrency', '4', input='y\n')
+
+    assert result.exit_code == 0, result.output
+    assert (schedulers[0].limit, schedulers[0].max_limit) == (3, 12)
+
+
+def test_catalog_only_rescans_changed_dirs(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / 'old').mkdir()
+    (uploads_dir / 'old' / '2024-05-01 10.00.00.jpg').write_bytes(b'x')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] = b'y'
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14', catalog=True)
+    assert list(ctx.dropbox_filenames) == ['2024-05-01 10.00.00.jpg']
+    assert list(ctx.blob_container_filenames) == ['2024-05-02 10.00.00.jpg']
+    ctx.db.close()
+
+    (uploads_dir / '2024-05-03 10.00.00.jpg').write_bytes(b'z')
+    scanned = []
+    real_scandir = os.scandir
+    monkeypatch.setattr('os.scandir', lambda path: scanned.append(path) or real_scandir(path))
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14', catalog=True)
+
+    assert list(ctx.dropbox_filenames) == ['2024-05-03 10.00.00.jpg', '2024-05-01 10.00.00.jpg']
+    assert scanned == [str(uploads_dir)]
+    blob_row = ctx.db.execute(
+        "SELECT * FROM entries WHERE Location = 'blob'"
+    ).fetchone()
+    assert blob_row['Hash'] == hashlib.md5(b'y').hexdigest()
+
+
+def test_catalog_tree_lookups_stay_within_the_tree(tmp_path):
+    catalog = drop2blob.Catalog(drop2blob.sqlite3.connect(':memory:'))
+    catalog.db.row_factory = drop2blob.sqlite3.Row
+    for name in ['05/a.jpg', '05/sub/b.jpg', '05 old/c.jpg', '050/d.jpg']:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b'x')
+    for root_dir in ['05', '05 old', '050']:
+        catalog.scan_tree('workdir', tmp_path / root_dir)
+
+    assert [row['Filename'] for row in catalog.get_tree_entries('workdir', tmp_path / '05')] == ['a.jpg', 'b.jpg']
+    catalog.forget_tree('workdir', str(tmp_path / '05'))
+    assert [row['Filename'] for row in catalog.db.execute('SELECT Filename FROM entries ORDER BY Path')] == [
+        'c.jpg', 'd.jpg',
+    ]
+    assert catalog.db.execute('SELECT COUNT(*) FROM dirs').fetchone()[0] == 2
+
+
+def test_catalog_rescan_forgets_a_cached_subdir_that_has_gone(tmp_path):
+    catalog = drop2blob.Catalog(drop2blob.sqlite3.connect(':memory:'))
+    for name in ['05/a.jpg', '05/sub/b.jpg']:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b'x')
+    catalog.scan_tree('workdir', tmp_path / '05')
+    # Remove the subdir without changing its parent's mtime, so the rescan
+    # takes the parent's subdirs from the catalog
+    stat = (tmp_path / '05').stat()
+    shutil.rmtree(tmp_path / '05' / 'sub')
+    os.utime(tmp_path / '05', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    catalog.scan_tree('workdir', tmp_path / '05')
+
+    assert [row[0] for row in catalog.db.execute('SELECT Filename FROM entries')] == ['a.jpg']
+    assert catalog.db.execute('SELECT COUNT(*) FROM dirs').fetchone()[0] == 1
+
+
+def test_lsblob_answers_from_cached_listing(fake_container):
+    key = 'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'
+    fake_container.blobs[key] = b'photo'
+    assert invoke('--catalog', 'lsblob').output.split('\n')[0] == key
+
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] = b'photo 2'
+    result = invoke('--catalog', 'lsblob', '--max-age', '3600')
+    assert result.exit_code == 0, result.output
+    assert result.output == key + '\n'
+    assert fake_container.list_blobs_calls == ['photos/2024/05/iPhone14/']
+
+    # A stale cache is refreshed from the container
+    result = invoke('--catalog', 'lsblob', '--max-age', '-1')
+    assert len(result.output.splitlines()) == 2
+    assert invoke('lsblob', '--max-age', '60').exit_code != 0
+    # Deleting the only local copy is never decided from a cached listing
+    assert invoke('--catalog', 'rm-dropbox-files', '--dryrun', 'true', '--max-age', '3600').exit_code == 2
+
+
+def test_cached_blob_listings_seek_to_their_prefix(fake_container):
+    names = [
+        'photos/2024/05/iPhone14',
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov',
+        'photos/2024/05/iPhone140/2024-05-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14\U0010ffff',
+    ]
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14', catalog=True)
+    for name in names:
+        ctx.catalog.record_blob(name, 1, None)
+
+    assert [blob.name for blob in ctx.catalog.iter_blobs(ctx.dir_prefix)] == names[1:3]
+    assert [blob.name for blob in ctx.catalog.iter_blobs('')] == names
+    assert drop2blob.prefix_condition('Path', 'a\U0010ffff') == ('Path >= ? AND Path < ?', ('a\U0010ffff', 'b'))
+    under_prefix, params = drop2blob.prefix_condition('Path', ctx.dir_prefix)
+    plan = ctx.db.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM entries WHERE Location = 'blob' AND " + under_prefix, params
+    ).fetchall()
+    assert 'Path>? AND Path<?' in plan[0][-1]
+
+
+def test_sources_stream_into_the_catalog_a_batch_at_a_time(fake_container, tmp_path, monkeypatch):
+    monkeypatch.setattr('drop2blob.SOURCE_BATCH_SIZE', 2)
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    names = ['2024-05-0{} 10.00.00.jpg'.format(i) for i in range(1, 6)]
+    for name in names:
+        (uploads_dir / name).write_bytes(b'photo')
+        fake_container.blobs['photos/2024/05/iPhone14/' + name] = name.encode()
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14', catalog=True)
+
+    # Loading a source doesn't read back its whole listing
+    listed = ctx.iter_blobs(ctx.dir_prefix)
+    assert next(listed).name == 'photos/2024/05/iPhone14/' + names[0]
+    assert ctx.catalog.get_listing_age(ctx.dir_prefix) is None
+    assert list(ctx.blob_container_filenames) == names
+    assert ctx.get_blob_md5(names[2]) == hashlib.md5(names[2].encode()).hexdigest()
+    # Commands can update the DB while iterating a source
+    for name in ctx.dropbox_filenames:
+        ctx.record_uploaded_blob(name + '.copy', 'photos/2024/05/iPhone14/' + name + '.copy', 5, None)
+    assert len(list(ctx.blob_container_paths)) == 10
+    ctx.db.close()
+
+    # Blobs that are gone are dropped from the catalog once a listing completes
+    del fake_container.blobs['photos/2024/05/iPhone14/' + names[0]]
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14', catalog=True)
+    assert list(ctx.blob_container_filenames) == names[1:]
+    assert [row['Filename'] for row in ctx.db.execute(
+        "SELECT Filename FROM entries WHERE Location = 'blob' ORDER BY Path"
+    )] == names[1:]
+
+
+def test_machine_readable_output_formats(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'same')
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'same')
+    (uploads_dir / '2024-05-02 10.00.00.jpg').write_bytes(b'new, "quoted"')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'same'
+
+    result = invoke('difflocal', '--format', 'ndjson')
+    assert [json.loads(line) for line in result.output.splitlines()] == [
+        {'filename': '2024-05-01 10.00.00.jpg', 'status': 'diff_ok'},
+        {'filename': '2024-05-02 10.00.00.jpg', 'status': 'dropbox_only'},
+    ]
+    result = invoke('diffblob', '--verify', '--format', 'csv')
+    assert result.output.splitlines() == [
+        'filename,status',
+        '2024-05-01 10.00.00.jpg,checksum_ok',
+        '2024-05-02 10.00.00.jpg,dropbox_only',
+    ]
+    assert json.loads(invoke('lsdb', '--format', 'json').output) == [
+        {'Filename': '2024-05-01 10.00.00.jpg', 'InDropbox': 1, 'InWorkingDir': 1, 'InBlob': 1},
+        {'Filename': '2024-05-02 10.00.00.jpg', 'InDropbox': 1, 'InWorkingDir': 0, 'InBlob': 0},
+    ]
+    records = json.loads(invoke('lsdropbox', '--format', 'json').output)
+    assert [(r['filename'], r['size']) for r in records] == [
+        ('2024-05-01 10.00.00.jpg', 4), ('2024-05-02 10.00.00.jpg', 13),
+    ]
+    assert json.loads(invoke('lsworkdir', '--format', 'json').output)[0]['path'] == str(
+        workdir / '2024-05-01 10.00.00.jpg'
+    )
+    assert json.loads(invoke('lsblob', '--format', 'ndjson').output) == {
+        'name': 'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+        'content_md5': hashlib.md5(b'same').hexdigest(),
+    }
+
+
+def test_copy_file_falls_back_when_copy_file_range_copies_nothing(tmp_path, monkeypatch):
+    src = tmp_path / 'src.jpg'
+    src.write_bytes(b'photo')
+    monkeypatch.setattr(drop2blob, 'fcntl', None)
+    monkeypatch.setattr(drop2blob.os, 'copy_file_range', lambda src_fd, dest_fd, count: 0, raising=False)
+
+    drop2blob.copy_file(src, tmp_path / 'dest.jpg')
+
+    assert (tmp_path / 'dest.jpg').read_bytes() == b'photo'
+
+
+def test_load_sources_handles_quotes_in_filenames(fake_container, tmp_path):
+    name = "2024-05-01 Bill's birthday.jpg"
+    (tmp_path / 'Dropbox' / 'Camera Uploads' / name).write_bytes(b'x')
+    fake_container.blobs['photos/2024/05/iPhone14/' + name] = b'x'
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+
+    ctx.load_sources('dropbox', 'workdir', 'blob')
+
+    row = ctx.get_file_db_row(name)
+    assert (row['InDropbox'], row['InWorkingDir'], row['InBlob']) == (1, 0, 1)
+
+
+def test_scan_matches_extensions_case_insensitively(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / 'sub').mkdir()
+    for name in ['2024-05-01 10.00.00.JPG', 'sub/2024-05-02 10.00.00.mov',
+                 '2024-05-03 10.00.00.txt', '2024-06-01 10.00.00.jpg']:
+        (uploads_dir / name).write_bytes(b'1234')
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+
+    assert list(ctx.dropbox_filenames) == ['2024-05-01 10.00.00.JPG', '2024-05-02 10.00.00.mov']
+    scanned = ctx.get_scanned_file('dropbox', '2024-05-02 10.00.00.mov')
+    assert scanned.path == str(uploads_dir / 'sub' / '2024-05-02 10.00.00.mov')
+    assert scanned.size == 4
+
+
+def test_workdir_videos_outside_video_dir_are_found_where_scanned(fake_container, tmp_path):
+    # Older versions of cp only moved lowercase .mov files into video/
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'NikonCoolpix'
+    (workdir / 'video').mkdir(parents=True)
+    (uploads_dir / 'DSCN0001.MOV').write_bytes(b'mov')
+    (workdir / 'DSCN0001.MOV').write_bytes(b'mov')
+
+    result = invoke('--device', 'NikonCoolpix', 'difflocal', '--format', 'csv')
+    assert result.exit_code == 0, result.output
+    assert 'DSCN0001.MOV,diff_ok' in result.output
+
+    result = invoke('--device', 'NikonCoolpix', 'upload', '--dryrun', 'false')
+    assert result.exit_code == 0, result.output
+    assert fake_container.blobs['photos/2024/05/NikonCoolpix/video/DSCN0001.MOV'] == b'mov'
+
+
+def test_upload_sets_md5_and_diffblob_verify_compares_it(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'jpg')
+    (workdir / 'video' / '2024-05-01 12.00.00.mov').write_bytes(b'm' * (2 * 1024 * 1024))
+    result = invoke('upload', '--dryrun', 'false', '--block-size', '1')
+    assert result.exit_code == 0, result.output
+    video_key = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    assert fake_container.md5s[video_key] == hashlib.md5(b'm' * (2 * 1024 * 1024)).digest()
+
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'corrupt'
+    fake_container.md5s['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = hashlib.md5(b'corrupt').digest()
+    result = invoke('diffblob', '--verify')
+
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[1].split() == ['2024-05-01', '10.00.00.jpg', '❌', 'checksum', 'NOT', 'OK', '-', 'files', 'differ!']
+    assert lines[2].split() == ['2024-05-01', '12.00.00.mov', '👍', 'checksum', 'OK']
+
+
+def test_compare_local_files_checks_size_and_caches_matches(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    contents = {
+        '2024-05-01 a.jpg': (b'same', b'same'),
+        '2024-05-01 b.jpg': (b'long', b'longer'),
+        '2024-05-01 c.jpg': (b'abcd', b'abce'),
+    }
+    for name, (dropbox_data, workdir_data) in contents.items():
+        (uploads_dir / name).write_bytes(dropbox_data)
+        (workdir / name).write_bytes(workdir_data)
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    ctx.load_sources('dropbox', 'workdir')
+
+    assert ctx.compare_local_files(sorted(contents)) == {
+        '2024-05-01 a.jpg': True,
+        '2024-05-01 b.jpg': False,
+        '2024-05-01 c.jpg': False,
+    }
+    compared = []
+    monkeypatch.setattr('drop2blob.files_identical', lambda a, b: compared.append(a) or False)
+    assert ctx.compare_local_files(['2024-05-01 a.jpg', '2024-05-01 c.jpg']) == {
+        '2024-05-01 a.jpg': True,
+        '2024-05-01 c.jpg': False,
+    }
+    assert compared == [str(uploads_dir / '2024-05-01 c.jpg')]
+
+
+def test_cp_copies_atomically(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'jpg')
+    (uploads_dir / '2024-05-01 12.00.00.mov').write_bytes(b'mov')
+    os.utime(uploads_dir / '2024-05-01 10.00.00.jpg', (1000000000, 1000000000))
+
+    result = invoke('cp', '--dryrun', 'false', '--jobs', '2')
+
+    assert result.exit_code == 0, result.output
+    assert (workdir / '2024-05-01 10.00.00.jpg').read_bytes() == b'jpg'
+    assert (workdir / '2024-05-01 10.00.00.jpg').stat().st_mtime == 1000000000
+    assert (workdir / 'video' / '2024-05-01 12.00.00.mov').read_bytes() == b'mov'
+
+    (uploads_dir / '2024-05-02 10.00.00.jpg').write_bytes(b'new')
+
+    def interrupted_copy(src_file, dest_file):
+        dest_file.write(b'ne')
+        raise IOError('disk full')
+
+    monkeypatch.setattr('drop2blob.copy_file_data', interrupted_copy)
+    result = invoke('cp', '--dryrun', 'false')
+
+    assert result.exit_code == 1, result.output
+    assert "FAILED '2024-05-02 10.00.00.jpg': disk full" in result.output
+    assert sorted(p.name for p in workdir.iterdir()) == ['2024-05-01 10.00.00.jpg', 'video']
+
+
+def test_workflow_plans_then_pipelines_copy_upload_and_delete(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'new')
+    (workdir / '2024-05-02 10.00.00.jpg').write_bytes(b'copied earlier')
+    (uploads_dir / '2024-05-03 10.00.00.jpg').write_bytes(b'backed up')
+    (workdir / '2024-05-03 10.00.00.jpg').write_bytes(b'backed up')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-03 10.00.00.jpg'] = b'backed up'
+
+    result = invoke('workflow', '--dryrun', 'true', '--delete')
+    assert result.exit_code == 0, result.output
+    assert 'Plan: 1 to copy, 2 to upload, 0 to verify, 2 to delete' in result.output
+    assert (uploads_dir / '2024-05-01 10.00.00.jpg').exists()
+    assert not (workdir / '2024-05-01 10.00.00.jpg').exists()
+
+    fake_container.list_blobs_calls.clear()
+    result = invoke('workflow', '--dryrun', 'false', '--delete', input='y\n')
+    assert result.exit_code == 0, result.output
+    assert fake_container.list_blobs_calls == ['photos/2024/05/iPhone14/']
+    assert (workdir / '2024-05-01 10.00.00.jpg').read_bytes() == b'new'
+    assert fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] == b'new'
+    assert fake_container.blobs['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] == b'copied earlier'
+    assert list(uploads_dir.iterdir()) == []
+    assert 'Deleted 2 file(s), 0 failed' in result.output
+
+
+def test_workflow_delete_resumes_an_unfinished_manifest_instead_of_overwriting_it(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    for name, data in [('2024-05-01 10.00.00.jpg', b'one'), ('2024-05-02 10.00.00.jpg', b'two')]:
+        (uploads_dir / name).write_bytes(data)
+        (workdir / name).write_bytes(data)
+        fake_container.blobs['photos/2024/05/iPhone14/' + name] = data
+    # Left by an interrupted rm-dropbox-files
+    pending = uploads_dir / '2024-05-01 10.00.00.jpg'
+    stat = pending.stat()
+    (workdir / '.rm-dropbox-manifest.jsonl').write_text('{}\n' + json.dumps({
+        'file': pending.name, 'path': str(pending), 'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns, 'md5': hashlib.md5(b'one').hexdigest(),
+    }) + '\n')
+
+    result = invoke('workflow', '--dryrun', 'false', '--delete', input='y\n')
+
+    assert result.exit_code == 0, result.output
+    assert 'Resuming delete of 1 Dropbox file(s)' in result.output
+    assert list(uploads_dir.iterdir()) == []
+    assert 'Deleted 2 file(s), 0 failed' in result.output
+    assert not (workdir / '.rm-dropbox-manifest.jsonl').exists()
+    manifests = sorted(p for p in workdir.iterdir() if p.name.startswith('.rm-dropbox-manifest-'))
+    records = [json.loads(line) for p in manifests for line in p.read_text().splitlines()]
+    assert {'deleted': ['2024-05-01 10.00.00.jpg']} in records
+    assert {'deleted': ['2024-05-02 10.00.00.jpg']} in records
+
+
+def test_workflow_passes_jobs_and_max_retries_through(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'new')
+    max_retries = []
+    delete_jobs = []
+    real_init = TransferScheduler.__init__
+    real_delete = BackupContext.delete_dropbox_files
+
+    def init(self, *args, **kwargs):
+        max_retries.append(kwargs.get('max_retries'))
+        real_init(self, *args, **kwargs)
+
+    def delete_dropbox_files(self, file_names, batch_size, jobs, **kwargs):
+        delete_jobs.append(jobs)
+        return real_delete(self, file_names, batch_size, jobs, **kwargs)
+
+    monkeypatch.setattr(TransferScheduler, '__init__', init)
+    monkeypatch.setattr(BackupContext, 'delete_dropbox_files', delete_dropbox_files)
+
+    result = invoke('workflow', '--dryrun', 'false', '--delete', '--jobs', '3', '--max-retries', '2', input='y\ny\n')
+
+    assert result.exit_code == 0, result.output
+    assert max_retries == [2]
+    assert delete_jobs == [3]
+    assert list(uploads_dir.iterdir()) == []
+
+
+def test_execute_plan_fails_only_the_actions_of_a_vanished_file(fake_container, tmp_path):
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    present = tmp_path / '2024-05-01 10.00.00.jpg'
+    present.write_bytes(b'jpg')
+    gone = tmp_path / '2024-05-02 10.00.00.jpg'
+    PlannedAction = drop2blob.PlannedAction
+
+    progress = ctx.execute_plan([
+        PlannedAction('copy', gone.name, gone, tmp_path / 'copy.jpg'),
+        PlannedAction('upload', gone.name, tmp_path / 'copy.jpg', 'photos/b.jpg'),
+        PlannedAction('upload', present.name, present, 'photos/a.jpg'),
+    ], 2, 1, 1024, TransferScheduler(2, 2))
+
+    assert progress['upload'].succeeded == [present.name]
+    assert [file_name for file_name, _ in progress['copy'].failed] == [gone.name]
+    assert [file_name for file_name, _ in progress['upload'].failed] == [gone.name]
+
+
+def test_rm_dropbox_files_checks_hashes_and_resumes_from_manifest(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    for name, data in [('2024-05-01 10.00.00.jpg', b'one'), ('2024-05-02 10.00.00.jpg', b'two')]:
+        (uploads_dir / name).write_bytes(data)
+        (workdir / name).write_bytes(data)
+        fake_container.blobs['photos/2024/05/iPhone14/' + name] = data
+    fake_container.md5s['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg'] = hashlib.md5(b'corrupt').digest()
+
+    result = invoke('rm-dropbox-files', '--dryrun', 'false')
+    assert result.exit_code == 1
+    assert "'2024-05-02 10.00.00.jpg': the workdir copy and the blob differ" in result.output
+    assert len(list(uploads_dir.iterdir())) == 2
+
+    del fake_container.md5s['photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg']
+    result = invoke('rm-dropbox-files', '--dryrun', 'false', '--batch-size', '1')
+    assert result.exit_code == 0, result.output
+    assert list(uploads_dir.iterdir()) == []
+    manifests = [p for p in workdir.iterdir() if p.name.startswith('.rm-dropbox-manifest-')]
+    assert len(manifests) == 1
+    records = [json.loads(line) for line in manifests[0].read_text().splitlines()]
+    assert [r.get('file') for r in records[1:3]] == ['2024-05-01 10.00.00.jpg', '2024-05-02 10.00.00.jpg']
+    assert records[3:] == [{'deleted': ['2024-05-01 10.00.00.jpg']}, {'deleted': ['2024-05-02 10.00.00.jpg']}]
+
+    # An interrupted delete is picked up again from its manifest
+    pending = uploads_dir / '2024-05-03 10.00.00.jpg'
+    pending.write_bytes(b'three')
+    stat = pending.stat()
+    (workdir / '.rm-dropbox-manifest.jsonl').write_text('{}\n' + json.dumps({
+        'file': pending.name, 'path': str(pending), 'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns, 'md5': hashlib.md5(b'three').hexdigest(),
+    }) + '\n')
+    result = invoke('rm-dropbox-files', '--dryrun', 'false')
+    assert result.exit_code == 0, result.output
+    assert 'Resuming delete of 1 Dropbox file(s)' in result.output
+    assert not pending.exists()
+
+    # A file that changed after it was verified is skipped, and doesn't
+    # leave the manifest stuck
+    changed = uploads_dir / '2024-05-04 10.00.00.jpg'
+    changed.write_bytes(b'four')
+    (workdir / '.rm-dropbox-manifest.jsonl').write_text('{}\n' + json.dumps({
+        'file': changed.name, 'path': str(changed), 'size': 3,
+        'mtime_ns': 0, 'md5': hashlib.md5(b'old').hexdigest(),
+    }) + '\n')
+    for _ in range(2):
+        result = invoke('rm-dropbox-files', '--dryrun', 'false')
+        assert result.exit_code == 0, result.output
+        assert changed.read_bytes() == b'four'
+    assert 'Resuming' not in result.output
+    assert not (workdir / '.rm-dropbox-manifest.jsonl').exists()
+
+
+def test_rm_dropbox_files_doesnt_let_an_undeletable_file_hold_up_later_runs(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+
+    def back_up(name, data):
+        (uploads_dir / name).write_bytes(data)
+        (workdir / name).write_bytes(data)
+        fake_container.blobs['photos/2024/05/iPhone14/' + name] = data
+
+    back_up('2024-05-01 a.jpg', b'one')
+    back_up('2024-05-02 stuck.jpg', b'two')
+    real_remove = os.remove
+
+    def remove(path):
+        if os.path.basename(path) == '2024-05-02 stuck.jpg':
+            raise PermissionError('permission denied')
+        real_remove(path)
+
+    monkeypatch.setattr('drop2blob.os.remove', remove)
+
+    result = invoke('rm-dropbox-files', '--dryrun', 'false')
+    assert result.exit_code == 1
+    assert "Failed to delete" in result.output
+    assert not (workdir / '.rm-dropbox-manifest.jsonl').exists()
+
+    back_up('2024-05-03 c.jpg', b'three')
+    result = invoke('rm-dropbox-files', '--dryrun', 'false')
+    assert result.exit_code == 1
+    assert 'Resuming' not in result.output
+    assert sorted(p.name for p in uploads_dir.iterdir()) == ['2024-05-02 stuck.jpg']
+
+
+def test_rm_dropbox_files_keeps_files_whose_blob_has_no_content_md5(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    for name, data in [('2024-05-01 10.00.00.jpg', b'photo'), ('2024-05-01 12.00.00.mov', b'video')]:
+        (uploads_dir / name).write_bytes(data)
+        (workdir / ('video/' if name.endswith('.mov') else '') / name).write_bytes(data)
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'photo'
+    # Block uploads by older versions never set a Content-MD5
+    fake_container.blobs['photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'] = b'video'
+    fake_container.md5s['photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'] = None
+
+    result = invoke('rm-dropbox-files', '--dryrun', 'false')
+
+    assert result.exit_code == 0, result.output
+    assert "Skipping rm of Dropbox file '2024-05-01 12.00.00.mov'; its blob has no Content-MD5" in result.output
+    assert [p.name for p in uploads_dir.iterdir()] == ['2024-05-01 12.00.00.mov']
+
+
+def test_verify_notices_files_rewritten_in_place_with_a_catalog(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    name = '2024-05-01 10.00.00.jpg'
+    (uploads_dir / name).write_bytes(b'good')
+    (workdir / name).write_bytes(b'good')
+    fake_container.blobs['photos/2024/05/iPhone14/' + name] = b'good'
+    assert invoke('--catalog', 'rm-dropbox-files', '--dryrun', 'true').exit_code == 0
+
+    # Rewriting a file in place doesn't change its dir's mtime, so the
+    # catalog's row for it goes stale
+    dir_stat = workdir.stat()
+    (workdir / name).write_bytes(b'bad!')
+    os.utime(str(workdir), ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+    result = invoke('--catalog', 'diffblob', '--verify', '--format', 'csv')
+    assert 'checksum_mismatch' in result.output
+    result = invoke('--catalog', 'rm-dropbox-files', '--dryrun', 'false')
+    assert result.exit_code == 1
+    assert 'the Dropbox file and its workdir copy differ' in result.output
+    assert (uploads_dir / name).exists()
+
+
+def test_block_upload_resumes_from_journal(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    (workdir / 'video').mkdir(parents=True)
+    video = workdir / 'video' / '2024-05-01 12.00.00.mov'
+    mib = 1024 * 1024
+    video.write_bytes(b'a' * mib + b'b' * mib + b'c' * 10)
+    key = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+
+    def fail_third_block(block_id, data, **kwargs):
+        if data.startswith(b'c'):
+            raise IOError('connection reset')
+        staged[block_id] = data
+
+    staged = fake_container.staged.setdefault(key, {})
+    blob_client = fake_container.get_blob_client(key)
+    fake_container.get_blob_client = lambda name: blob_client
+    blob_client.stage_block = fail_third_block
+    with pytest.raises(IOError):
+        ctx.upload_file(fake_container, video, key, 1, mib, TransferScheduler(1, 1))
+    assert len(staged) == 2
+
+    sent = []
+    blob_client.stage_block = lambda block_id, data, **kwargs: sent.append(data) or staged.update({block_id: data})
+    md5 = ctx.upload_file(fake_container, video, key, 2, mib, TransferScheduler(2, 2))
+
+    assert sent == [b'c' * 10]
+    assert fake_container.blobs[key] == video.read_bytes()
+    assert md5 == hashlib.md5(video.read_bytes()).hexdigest()
+    assert not (workdir / 'video' / '.2024-05-01 12.00.00.mov.upload-journal').exists()
+
+
+def test_block_upload_starts_over_once_staged_blocks_expire(fake_container, tmp_path):
+    video = tmp_path / '2024-05-01 12.00.00.mov'
+    mib = 1024 * 1024
+    video.write_bytes(b'a' * mib + b'b' * 10)
+    key = 'photos/2024/05/iPhone14/video/2024-05-01 12.00.00.mov'
+    journal = tmp_path / '.2024-05-01 12.00.00.mov.upload-journal'
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    blob_client = fake_container.get_blob_client(key)
+    fake_container.get_blob_client = lambda name: blob_client
+    blob_client.stage_block = Mock(side_effect=IOError('connection reset'))
+    with pytest.raises(IOError):
+        ctx.upload_file(fake_container, video, key, 1, mib, TransferScheduler(1, 1))
+    journal.write_text(journal.read_text() + 'expired-block\n')
+
+    # The service has since discarded the uncommitted blocks (and the blob)
+    blob_client.get_block_list = Mock(side_effect=ResourceNotFoundError('not found'))
+    del blob_client.stage_block
+    ctx.upload_file(fake_container, video, key, 1, mib, TransferScheduler(1, 1))
+
+    assert fake_container.blobs[key] == video.read_bytes()
+    assert not journal.exists()
+
+
+def test_upload_dedup_copies_identical_content_server_side(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-02 11.00.00.jpg').write_bytes(b'shared photo')
+    (workdir / '2024-05-03 11.00.00.jpg').write_bytes(b'new photo')
+    fake_container.blobs['photos/2024/04/iPad/IMG_0001.jpg'] = b'shared photo'
+
+    result = invoke('upload', '--dryrun', 'false', '--dedup', 'copy')
+
+    assert result.exit_code == 0, result.output
+    key = 'photos/2024/05/iPhone14/2024-05-02 11.00.00.jpg'
+    assert fake_container.copies == [('photos/2024/04/iPad/IMG_0001.jpg', key)]
+    assert fake_container.blobs[key] == b'shared photo'
+    assert fake_container.blobs['photos/2024/05/iPhone14/2024-05-03 11.00.00.jpg'] == b'new photo'
+    index = json.loads(fake_container.blobs['.drop2blob/content-md5-index.json'])
+    assert index == {
+        hashlib.md5(b'shared photo').hexdigest(): 'photos/2024/04/iPad/IMG_0001.jpg',
+        hashlib.md5(b'new photo').hexdigest(): 'photos/2024/05/iPhone14/2024-05-03 11.00.00.jpg',
+    }
+
+    # Later runs use the saved index rather than listing the whole container
+    fake_container.list_blobs_calls.clear()
+    (workdir / '2024-05-04 11.00.00.jpg').write_bytes(b'new photo')
+    result = invoke('upload', '--dryrun', 'false', '--dedup', 'skip')
+    assert result.exit_code == 0, result.output
+    assert fake_container.list_blobs_calls == ['photos/2024/05/iPhone14/', '.drop2blob/content-md5-index.d/']
+    assert 'photos/2024/05/iPhone14/2024-05-04 11.00.00.jpg' not in fake_container.blobs
+    assert "identical content is already stored as 'photos/2024/05/iPhone14/2024-05-03 11.00.00.jpg'" in result.output
+
+
+def test_plain_upload_adds_a_delta_to_an_existing_dedup_index(fake_container, tmp_path, monkeypatch):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    index_name = '.drop2blob/content-md5-index.json'
+    fake_container.blobs[index_name] = b'{"0123": "photos/2024/04/iPhone14/old.jpg"}'
+    entries = {}
+    for i in range(3):
+        name = '2024-05-0{} 11.00.00.jpg'.format(i + 1)
+        (workdir / name).write_bytes(name.encode())
+        entries[hashlib.md5(name.encode()).hexdigest()] = 'photos/2024/05/iPhone14/' + name
+
+        result = invoke('upload', '--dryrun', 'false')
+        assert result.exit_code == 0, result.output
+
+    # Plain uploads never read or rewrite the main index blob
+    assert fake_container.blobs[index_name] == b'{"0123": "photos/2024/04/iPhone14/old.jpg"}'
+    assert index_name not in [blob for blob, _, _ in fake_container.download_calls]
+    deltas = sorted(name for name in fake_container.blobs if name.startswith('.drop2blob/content-md5-index.d/'))
+    assert sorted(json.loads(fake_container.blobs[name]).popitem() for name in deltas) == sorted(entries.items())
+
+    # Deltas are merged on load, and folded into the main blob once there
+    # are enough of them
+    monkeypatch.setattr('drop2blob.DedupIndex.COMPACT_DELTAS', 3)
+    index = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14').load_dedup_index()
+    assert index.blob_names == dict(entries, **{'0123': 'photos/2024/04/iPhone14/old.jpg'})
+    assert json.loads(fake_container.blobs[index_name]) == index.blob_names
+    assert not any(name.startswith('.drop2blob/content-md5-index.d/') for name in fake_container.blobs)
+
+
+def test_upload_packs_small_files_and_download_restores_one_with_a_ranged_read(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'small one')
+    (workdir / '2024-05-02 10.00.00.jpg').write_bytes(b'small two')
+    (workdir / '2024-05-03 10.00.00.jpg').write_bytes(b'x' * 2048)
+
+    result = invoke('upload', '--dryrun', 'false', '--pack-threshold', '1')
+
+    assert result.exit_code == 0, result.output
+    assert 'Packed 2 file(s), 0 failed' in result.output
+    packs = sorted(name for name in fake_container.blobs if '/packs/' in name)
+    assert len(packs) == 2
+    pack_name, index_name = packs[1], packs[0]
+    assert index_name == pack_name[:-len('.tar')] + '.index.json'
+    assert 'photos/2024/05/iPhone14/2024-05-03 10.00.00.jpg' in fake_container.blobs
+    assert 'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg' not in fake_container.blobs
+
+    # Listings and diffs show the packed files rather than the pack
+    result = invoke('lsblob')
+    assert result.output.splitlines() == [
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-03 10.00.00.jpg',
+    ]
+    result = invoke('diffblob', '--verify', '--format', 'csv')
+    assert result.exit_code == 0, result.output
+    assert result.output.count('checksum_ok') == 3
+
+    (workdir / '2024-05-02 10.00.00.jpg').unlink()
+    fake_container.download_calls.clear()
+    result = invoke('download', '--dryrun', 'false', '--file', '2024-05-02 10.00.00.jpg')
+
+    assert result.exit_code == 0, result.output
+    assert (workdir / '2024-05-02 10.00.00.jpg').read_bytes() == b'small two'
+    # Only the restored file's bytes were read from the pack
+    assert [(blob, length) for blob, _, length in fake_container.download_calls] == [
+        (pack_name, len(b'small two')),
+    ]
+
+
+def test_upload_sends_the_large_files_even_when_a_pack_fails(fake_container, tmp_path, monkeypatch):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'small one')
+    (workdir / '2024-05-03 10.00.00.jpg').write_bytes(b'x' * 2048)
+
+    def upload_pack(self, pack_name, members, max_concurrency, block_size, scheduler):
+        raise IOError('pack upload failed')
+
+    monkeypatch.setattr('drop2blob.BackupContext.upload_pack', upload_pack)
+
+    result = invoke('upload', '--dryrun', 'false', '--pack-threshold', '1')
+
+    assert result.exit_code == 1
+    assert 'Packed 0 file(s), 1 failed' in result.output
+    assert list(fake_container.blobs) == ['photos/2024/05/iPhone14/2024-05-03 10.00.00.jpg']
+
+
+def test_upload_fails_only_the_file_that_cant_be_stated_when_packing(fake_container, tmp_path, monkeypatch):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'small one')
+    (workdir / '2024-05-02 gone.jpg').write_bytes(b'small two')
+    getsize = os.path.getsize
+
+    def flaky_getsize(path):
+        if str(path).endswith('gone.jpg'):
+            raise FileNotFoundError(path)
+        return getsize(path)
+
+    monkeypatch.setattr('drop2blob.os.path.getsize', flaky_getsize)
+
+    result = invoke('upload', '--dryrun', 'false', '--pack-threshold', '1')
+
+    assert result.exit_code == 1
+    assert 'Packed 1 file(s)' in result.output
+    assert "Failed to upload '2024-05-02 gone.jpg'" in result.output
+
+
+def test_upload_dedup_fails_only_the_file_that_cant_be_stated(fake_container, tmp_path, monkeypatch):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-01 10.00.00.jpg').write_bytes(b'one')
+    (workdir / '2024-05-02 gone.jpg').write_bytes(b'two')
+    stat = os.stat
+
+    def flaky_stat(path, *args, **kwargs):
+        if str(path).endswith('gone.jpg'):
+            raise FileNotFoundError(path)
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr('drop2blob.os.stat', flaky_stat)
+
+    result = invoke('upload', '--dryrun', 'false', '--dedup', 'copy')
+
+    assert result.exit_code == 1
+    assert "Failed to read '2024-05-02 gone.jpg'" in result.output
+    assert 'Deduplicated 0 file(s), 1 failed' in result.output
+    assert 'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg' in fake_container.blobs
+    assert 'photos/2024/05/iPhone14/2024-05-02 gone.jpg' not in fake_container.blobs
+
+
+class ServerBusyError(Exception):
+    status_code = 503
+    error_code = 'ServerBusy'
+
+
+def test_scheduler_retries_throttled_requests_and_backs_off(monkeypatch):
+    monkeypatch.setattr('drop2blob.time.sleep', lambda seconds: None)
+    scheduler = TransferScheduler(8, 8, retry_base_seconds=0)
+    responses = [ServerBusyError(), ServerBusyError(), 'ok']
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert scheduler.call(request) == 'ok'
+    # Both failures came from one burst, so the limit was only halved once
+    assert (scheduler.limit, scheduler.throttled, scheduler.retries) == (4, 2, 2)
+    for _ in range(4):
+        scheduler.call(lambda: None)
+    assert scheduler.limit == 5
+
+    with pytest.raises(IOError):
+        scheduler.call(Mock(side_effect=IOError('not retryable')))
+    with pytest.raises(ServerBusyError):
+        TransferScheduler(1, 1, max_retries=1).call(Mock(side_effect=ServerBusyError()))
+
+
+def test_scheduler_caps_bytes_per_sec(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('drop2blob.time.sleep', sleeps.append)
+    scheduler = TransferScheduler(4, 4, max_bytes_per_sec=1000)
+    for _ in range(3):
+        scheduler.call(lambda: None, num_bytes=500)
+    assert len(sleeps) == 2
+    assert sleeps[-1] == pytest.approx(1.0, abs=0.05)
+
+
+def test_batch_shares_one_listing_across_months(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-04-01 10.00.00.jpg').write_bytes(b'april')
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'may'
+
+    result = invoke(
+        'batch', '--from', '2024-04', '--to', '2024-05', '--dryrun', 'false',
+        input='y\ny\n',
+    )
+
+    assert result.exit_code == 0, result.output
+    assert fake_container.list_blobs_calls == ['photos/2024/']
+    assert fake_container.blobs['photos/2024/04/iPhone14/2024-04-01 10.00.00.jpg'] == b'april'
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024'
+    assert (workdir / '04' / 'iPhone14' / '2024-04-01 10.00.00.jpg').exists()
+    assert (workdir / '05' / 'iPhone14' / '2024-05-01 10.00.00.jpg').exists()
+def test_batch_transfers_every_partition_in_one_pass(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-04-01 10.00.00.jpg').write_bytes(b'april')
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+    passes = []
+    real_execute_transfers = BackupContext.execute_transfers
+
+    def execute_transfers(self, plans, *args, **kwargs):
+        passes.append([(partition.dir_prefix, [a.kind for a in actions]) for partition, actions in plans])
+        return real_execute_transfers(self, plans, *args, **kwargs)
+
+    monkeypatch.setattr(BackupContext, 'execute_transfers', execute_transfers)
+
+    result = invoke(
+        'batch', '--from', '2024-04', '--to', '2024-05', '--dryrun', 'false',
+        input='y\ny\n',
+    )
+
+    assert result.exit_code == 0, result.output
+    assert passes == [[
+        ('photos/2024/04/iPhone14/', ['copy', 'upload']),
+        ('photos/2024/05/iPhone14/', ['copy', 'upload']),
+    ]]
+    assert sorted(fake_container.blobs) == [
+        'photos/2024/04/iPhone14/2024-04-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+    ]
+
+
+def test_batch_dry_run_prints_each_partitions_plan(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-04-01 10.00.00.jpg').write_bytes(b'april')
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+
+    result = invoke('batch', '--from', '2024-04', '--to', '2024-05', '--step', 'upload', '--dryrun', 'true')
+
+    assert result.exit_code == 0, result.output
+    # Without the cp step, files not yet in the workdir aren't uploaded
+    assert 'Plan: ' not in result.output
+    assert fake_container.blobs == {}
+
+    result = invoke('batch', '--from', '2024-04', '--to', '2024-05', '--dryrun', 'true')
+
+    assert result.exit_code == 0, result.output
+    assert '=== photos/2024/05/iPhone14/ ===\nPlan: 1 to copy, 1 to upload' in result.output
+    assert 'Dry run; nothing was copied or uploaded.' in result.output
+    assert fake_container.blobs == {}
+    assert not (tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '04').exists()
+
+
+def test_batch_carries_on_after_a_failed_partition(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-04-01 10.00.00 fail.jpg').write_bytes(b'april')
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+
+    result = invoke(
+        'batch', '--from', '2024-04', '--to', '2024-05', '--dryrun', 'false',
+        input='y\ny\n',
+    )
+
+    assert result.exit_code == 1
+    assert fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] == b'may'
+    assert '1 of 2 partition(s) failed:\n  photos/2024/04/iPhone14/ (upload)' in result.output
+
+
+def test_batch_passes_max_retries_to_the_scheduler(fake_container, tmp_path, monkeypatch):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+    max_retries = []
+    real_init = TransferScheduler.__init__
+
+    def init(self, *args, **kwargs):
+        max_retries.append(kwargs.get('max_retries'))
+        real_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(TransferScheduler, '__init__', init)
+
+    result = invoke(
+        'batch', '--from', '2024-05', '--to', '2024-05', '--dryrun', 'false', '--max-retries', '0', input='y\n',
+    )
+
+    assert result.exit_code == 0, result.output
+    assert max_retries == [0]
+    assert fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] == b'may'
+
+
+def test_execute_transfers_reports_failures_by_partition(fake_container, tmp_path):
+    ctx = BackupContext('conn', 'ctr', '2024', '05', 'iPhone14')
+    partitions = [ctx.make_partition('2024', '05', device) for device in ('iPhone14', 'NikonCoolpix')]
+    src = tmp_path / 'DSCN0001.JPG'
+    src.write_bytes(b'nikon')
+    # The same file name in both partitions, only one of whose uploads fails
+    plans = [
+        (partition, [PlannedAction('upload', 'DSCN0001.JPG', path, partition.dir_prefix + 'DSCN0001.JPG')])
+        for partition, path in zip(partitions, [tmp_path / 'missing.JPG', src])
+    ]
+    failed_actions = []
+
+    progress = ctx.execute_transfers(plans, 2, 1, 1024 * 1024, TransferScheduler(2, 2), failed_actions=failed_actions)
+
+    assert [name for name, _ in progress['upload'].failed] == ['DSCN0001.JPG']
+    assert [(partition.dir_prefix, action.kind) for partition, action in failed_actions] == [
+        ('photos/2024/05/iPhone14/', 'upload'),
+    ]
+    assert fake_container.blobs['photos/2024/05/NikonCoolpix/DSCN0001.JPG'] == b'nikon'
+
+
+def test_share_sources_hands_each_partition_its_own_blobs(fake_container):
+    for name in [
+        'photos/2024/04/iPad/2024-04-01 10.00.00.jpg',
+        'photos/2024/04/iPhone14/2024-04-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg',
+    ]:
+        fake_container.blobs[name] = b'x'
+    ctx = BackupContext('conn', 'ctr', '2024', '04', 'iPhone14')
+    partitions = [ctx.make_partition('2024', month, 'iPhone14') for month in ('05', '04')]
+
+    ctx.share_sources(partitions)
+
+    assert fake_container.list_blobs_calls == ['photos/2024/']
+    assert list(partitions[0].blob_container_paths) == [
+        'photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg',
+        'photos/2024/05/iPhone14/2024-05-02 10.00.00.jpg',
+    ]
+    assert list(partitions[1].blob_container_paths) == ['photos/2024/04/iPhone14/2024-04-01 10.00.00.jpg']
+
+
+def test_batch_rejects_several_date_matched_devices(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'may')
+
+    result = invoke(
+        'batch', '--from', '2024-05', '--to', '2024-05', '--devices', 'iPhone14,iPad', '--dryrun', 'false',
+    )
+
+    assert result.exit_code == 2
+    assert 'only one device' in result.output
+    assert fake_container.blobs == {}
+
+
+def test_watch_backs_up_new_files_once_settled(fake_container, tmp_path):
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    (uploads_dir / '2024-05-01 10.00.00.jpg').write_bytes(b'old')
+    backup_context = BackupContext('fake', 'ctr', '2024', '05', 'iPhone14')
+    cycles = []
+
+    def should_stop():
+        cycles.append(None)
+        if len(cycles) == 2:
+            (uploads_dir / '2024-06-02 10.00.00.jpg').write_bytes(b'new')
+            (uploads_dir / 'notes.txt').write_bytes(b'ignored')
+        return len(cycles) > 4
+
+    backup_context.watch(0, 0.01, 2, 4, 1, 1024, TransferScheduler(2, 2), should_stop=should_stop)
+
+    assert list(fake_container.blobs) == ['photos/2024/06/iPhone14/2024-06-02 10.00.00.jpg']
+    assert fake_container.list_blobs_calls == ['photos/2024/06/iPhone14/']
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024'
+    assert (workdir / '06' / 'iPhone14' / '2024-06-02 10.00.00.jpg').read_bytes() == b'new'
+    assert not (workdir / '05' / 'iPhone14' / '2024-05-01 10.00.00.jpg').exists()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_watch_only_rescans_the_tree_without_inotify(fake_container, tmp_path, monkeypatch, inotify):
+    if not inotify:
+        monkeypatch.setattr('drop2blob.sys.platform', 'darwin')
+    elif DirectoryWatcher(tmp_path).fd is None:
+        pytest.skip('inotify is not available')
+    uploads_dir = tmp_path / 'Dropbox' / 'Camera Uploads'
+    walks = []
+    real_walk_files = drop2blob.walk_files
+    monkeypatch.setattr('drop2blob.walk_files', lambda root_dir: walks.append(root_dir) or real_walk_files(root_dir))
+    backup_context = BackupContext('fake', 'ctr', '2024', '05', 'iPhone14')
+    cycles = []
+
+    def should_stop():
+        cycles.append(None)
+        if len(cycles) == 2:
+            (uploads_dir / 'sub').mkdir()
+            (uploads_dir / 'sub' / '2024-06-02 10.00.00.jpg').write_bytes(b'new')
+            (uploads_dir / '2024-06-03 10.00.00.jpg').write_bytes(b'newer')
+        return len(cycles) > 6
+
+    backup_context.watch(0, 0.01, 2, 4, 1, 1024, TransferScheduler(2, 2), should_stop=should_stop)
+
+    assert sorted(fake_container.blobs) == [
+        'photos/2024/06/iPhone14/2024-06-02 10.00.00.jpg',
+        'photos/2024/06/iPhone14/2024-06-03 10.00.00.jpg',
+    ]
+    # With inotify the tree is walked once at startup (and new dirs once)
+    top_level_walks = [w for w in walks if str(w) == str(uploads_dir)]
+    if inotify:
+        assert len(top_level_walks) == 1
+    else:
+        assert len(top_level_walks) > 2
+
+
+def test_watch_command_runs_the_watcher_until_interrupted(fake_container, monkeypatch):
+    calls = []
+
+    def fake_watch(self, settle_seconds, poll_interval, jobs, queue_size, max_concurrency, block_size, scheduler):
+        calls.append((settle_seconds, poll_interval, jobs, queue_size, max_concurrency, block_size))
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr('drop2blob.BackupContext.watch', fake_watch)
+    result = invoke('watch', '--settle-seconds', '1', '--jobs', '3', '--block-size', '2')
+
+    assert result.exit_code == 0, result.output
+    assert calls == [(1.0, 30.0, 3, 16, 4, 2 * 1024 * 1024)]
+    assert 'Stopped watching' in result.output
+
+
+def test_metrics_report(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    for i in range(3):
+        (workdir / '2024-05-0{} 10.00.00.jpg'.format(i + 1)).write_bytes(b'jpg')
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-01 10.00.00.jpg'] = b'jpg'
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-09 10.00.00.jpg'] = b'old'
+    fake_container.blobs['photos/2024/05/iPhone14/2024-05-10 10.00.00.jpg'] = b'old'
+    report_path = tmp_path / 'metrics.json'
+
+    result = invoke('--metrics', str(report_path), 'upload', '--dryrun', 'false')
+
+    assert result.exit_code == 0, result.output
+    report = json.loads(report_path.read_text())
+    assert report['command'] == 'upload'
+    assert report['counters'] == {'list_blobs_pages': 2, 'bytes_uploaded': 6}
+    assert report['latency_seconds']['upload']['count'] == 2
+    assert set(report['phases']) == {'scan:workdir', 'db:InWorkingDir', 'list:blob', 'db:InBlob', 'upload'}
+
+
+def test_metrics_timed_leaves_out_the_callers_time(monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(drop2blob.time, 'perf_counter', lambda: next(clock))
+    metrics = drop2blob.Metrics()
+
+    for _ in metrics.timed('scan', ['a', 'b']):
+        next(clock)
+
+    # One tick to produce each item and to find the end, none for the loop body
+    assert metrics.phases['scan'] == {'seconds': 3, 'calls': 1}
+
+
+def test_profile_includes_worker_threads(fake_container, tmp_path):
+    workdir = tmp_path / 'Pictures' / 'blob' / 'ctr' / 'photos' / '2024' / '05' / 'iPhone14'
+    workdir.mkdir(parents=True)
+    (workdir / '2024-05-02 11.00.00.jpg').write_bytes(b'photo')
+    profile_path = tmp_path / 'upload.prof'
+
+    result = invoke('--profile', str(profile_path), 'upload', '--dryrun', 'false')
+
+    assert result.exit_code == 0, result.output
+    stats = pstats.Stats(str(profile_path))
+    # upload_file only runs in the upload pool's threads
+    assert any(name == 'upload_file' for _, _, name in stats.stats)
+
+
+def test_local_commands_do_not_import_azure_or_pandas(tmp_path):
+    (tmp_path / 'Dropbox' / 'Camera Uploads').mkdir(parents=True)
+    script = (
+        "import sys, drop2blob\n"
+        "from click.testing import CliRunner\n"
+        "for args in (['--help'], ['--connection-string', 'x', '--blob-container-name', 'ctr',\n"
+        "        '--year', '2024', '--month', '05', '--device', 'iPhone14', 'lsdropbox']):\n"
+        "    assert CliRunner().invoke(drop2blob.cli, args).exit_code == 0\n"
+        "print(sorted(m for m in ('azure.storage.blob', 'pandas') if m in sys.modules))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, HOME=str(tmp_path)),
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+
+    assert output.decode().strip() == '[]'